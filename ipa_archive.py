@@ -1,68 +1,176 @@
 #!/usr/bin/env python3
-from typing import TYPE_CHECKING, Iterable
+from typing import ContextManager, Generator, Iterable, Iterator, \
+    NamedTuple, TextIO
 from multiprocessing import Pool
+from queue import Empty, Queue
 from pathlib import Path
-from urllib.parse import quote
+from urllib.parse import quote, urlencode, urljoin, urlsplit
 from urllib.request import Request, urlopen, urlretrieve
+from urllib.error import HTTPError, URLError
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from array import array
+from io import BytesIO
+from base64 import b64decode, b64encode
+from http.client import HTTPConnection, HTTPSConnection, HTTPException, \
+    BadStatusLine, responses
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from sys import stderr
+from email.utils import parsedate_to_datetime
+from threading import get_ident
+from zipfile import BadZipFile
 import plistlib
+import shutil
 import sqlite3
+import socket
+import asyncio
+import hashlib
+import random
+import struct
+import mmap
 import json
 import gzip
+import zlib
+import time
+import ssl
 import os
 import re
 
-import warnings
-with warnings.catch_warnings():  # hide macOS LibreSSL warning
-    warnings.filterwarnings('ignore')
-    from remotezip import RemoteZip  # pip install remotezip
-
-if TYPE_CHECKING:
-    from zipfile import ZipInfo
+try:
+    import fcntl  # POSIX only, without it only a single writer is safe
+except ImportError:
+    fcntl = None
+try:
+    from PIL import Image  # optional, only for `optimize-images`
+except ImportError:
+    Image = None
+try:
+    import brotli  # optional, `export json` writes .br variants
+except ImportError:
+    brotli = None
 
 
 USE_ZIP_FILESIZE = False
 re_info_plist = re.compile(r'Payload/([^/]+)/Info.plist')
 # re_links = re.compile(r'''<a\s[^>]*href=["']([^>]+\.ipa)["'][^>]*>''')
+# e.g., point to a local `tools/fake_archive.py` for testing
+ARCHIVE_ORG = os.environ.get('ARCHIVE_ORG', 'https://archive.org').rstrip('/')
+ARCHIVE_ORG_METADATA = os.environ.get(
+    'ARCHIVE_ORG_METADATA', ARCHIVE_ORG + '/metadata')
 re_archive_url = re.compile(
-    r'https?://archive.org/(?:metadata|details|download)/([^/]+)(?:/.*)?')
+    r'(?:https?://archive.org|' + re.escape(ARCHIVE_ORG) + ')'
+    r'/(?:metadata|details|download)/([^/]+)(?:/.*)?')
+re_content_range = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
 CACHE_DIR = Path(__file__).parent / 'data'
 CACHE_DIR.mkdir(exist_ok=True)
 
 
 def main():
     CacheDB().init()
+    recoverPackDir()
     parser = ArgumentParser()
     cli = parser.add_subparsers(metavar='command', dest='cmd', required=True)
 
     cmd = cli.add_parser('add', help='Add urls to cache')
-    cmd.add_argument('urls', metavar='URL', nargs='+',
+    cmd.add_argument('urls', metavar='URL', nargs='*',
                      help='Search URLs for .ipa links')
+    cmd.add_argument('-search', '--search', metavar='QUERY',
+                     help='Add all archive.org items matching the search'
+                     ' query (e.g., "ipa AND mediatype:software")')
+    cmd.add_argument('-workers', type=int, default=8,
+                     help='Max. parallel file list downloads (search only)')
 
     cmd = cli.add_parser('update', help='Update all urls')
+    cmd.add_argument('-workers', type=int, default=8,
+                     help='Max. parallel metadata downloads')
     cmd.add_argument('urls', metavar='URL', nargs='*', help='URLs or index')
 
     cmd = cli.add_parser('run', help='Download and process pending urls')
     cmd.add_argument('-force', '-f', action='store_true',
                      help='Reindex local data / populate DB.'
                      'Make sure to export fsize before!')
+    cmd.add_argument('-async', dest='use_async', action='store_true',
+                     help='Use asyncio engine with pooled HTTP connections')
+    cmd.add_argument('-concurrency', type=int, default=64,
+                     help='Max. parallel connections (async only)')
+    cmd.add_argument('-per-host', type=int, default=8,
+                     help='Max. parallel connections per host (async only)')
+    cmd.add_argument('-max-rate', type=float, default=50,
+                     help='Max. ipa files per second and host. Halved when'
+                     ' throttled (HTTP 429 / 503, connection errors)')
+    cmd.add_argument('-max-attempts', type=int, default=5,
+                     help='Retry transient errors before setting done=3')
+    cmd.add_argument('-retry-delay', type=float, default=60,
+                     help='Seconds before first retry (doubles each time)')
+    cmd.add_argument('-max-wait', type=float, default=120,
+                     help='Exit if no retry is due within this many seconds'
+                     ' (later retries are left for the next run)')
+    cmd.add_argument('-coordinator', metavar='URL',
+                     help='Claim work from a `coordinator` instead of the'
+                     ' local DB (e.g., http://10.0.0.1:8030)')
     cmd.add_argument('pk', metavar='PK', type=int,
                      nargs='*', help='Primary key')
 
+    cmd = cli.add_parser('coordinator',
+                         help='Serve the pending queue to remote `run`s')
+    cmd.add_argument('-host', default='127.0.0.1',
+                     help='Bind address (no authentication!)')
+    cmd.add_argument('-port', type=int, default=8030)
+    cmd.add_argument('-lease', type=float, default=LEASE_SECONDS,
+                     help='Seconds until unfinished claims are requeued')
+    cmd.add_argument('-max-attempts', type=int, default=5,
+                     help='Retry transient errors before setting done=3')
+    cmd.add_argument('-retry-delay', type=float, default=60,
+                     help='Seconds before first retry (doubles each time)')
+
     cmd = cli.add_parser('export', help='Export data')
-    cmd.add_argument('export_type', choices=['json', 'fsize'],
-                     help='Export to json or temporary-filesize file')
+    cmd.add_argument('export_type', choices=[
+        'json', 'packed', 'fsize', 'files'],
+        help='Export to json, columnar binary (ipa.pack),'
+        ' temporary-filesize file or per-file layout (plist & images)')
+    cmd.add_argument('-incremental', '-i', action='store_true',
+                     help='Only regenerate changed shards in data/ipa/')
+    cmd.add_argument('-processes', type=int, default=os.cpu_count() or 4,
+                     help='Parallel compression of .gz / .br (json only)')
+    cmd.add_argument('-dir', type=Path, default=CACHE_DIR,
+                     help='Target directory (files only)')
+    cmd.add_argument('-ext', nargs='+', choices=BLOB_EXTENSIONS,
+                     default=BLOB_EXTENSIONS,
+                     help='Only export these file types (files only)')
+
+    cmd = cli.add_parser('migrate', help='Change plist & image storage')
+    cmd.add_argument('storage', choices=['pack', 'files'],
+                     help='Pack files + index in data/pack/ (re-run to'
+                     ' compact) or one file per blob in data/<bucket>/')
 
     cmd = cli.add_parser('err', help='Handle problematic entries')
-    cmd.add_argument('err_type', choices=['reset'], help='Set done=0 to retry')
+    cmd.add_argument('err_type', choices=['reset', 'release'],
+                     help='reset: set done=0 to retry errors. release: requeue'
+                     ' rows claimed by workers (done=2), if none is running')
 
     cmd = cli.add_parser('get', help='Lookup value')
     cmd.add_argument('get_type', choices=['url', 'img', 'ipa'],
                      help='Get data field or download image.')
+    cmd.add_argument('-workers', type=int, default=8,
+                     help='Parallel segment downloads (ipa only)')
     cmd.add_argument('pk', metavar='PK', type=int,
                      nargs='+', help='Primary key')
 
+    cmd = cli.add_parser('optimize-images',
+                         help='Convert .png icons to small .jpg (Pillow)')
+    cmd.add_argument('-size', type=int, default=128,
+                     help='Max. width and height in px')
+    cmd.add_argument('-processes', type=int, default=os.cpu_count() or 4)
+
+    cmd = cli.add_parser('stats', help='Summary of last run and DB state')
+    cmd.add_argument('-top', type=int, default=5,
+                     help='Number of slowest hosts and collections')
+
+    cli.add_parser('explain', help='Print query plans of hot DB queries')
+
     cmd = cli.add_parser('set', help='(Re)set value')
     cmd.add_argument('set_type', choices=['err'], help='Data field/column')
     cmd.add_argument('pk', metavar='PK', type=int,
@@ -71,16 +179,19 @@ def main():
     args = parser.parse_args()
 
     if args.cmd == 'add':
+        if not args.urls and not args.search:
+            parser.error('add: URL or -search QUERY required')
         for url in args.urls:
             addNewUrl(url)
-        print('done.')
+        if args.search:
+            addSearchResults(args.search, workers=args.workers)
+        else:
+            print('done.')
 
     elif args.cmd == 'update':
         queue = args.urls or CacheDB().getUpdateUrlIds(sinceNow='-7 days')
         if queue:
-            for i, url in enumerate(queue):
-                updateUrl(url, i + 1, len(queue))
-            print('done.')
+            updateUrls(queue, workers=args.workers)
         else:
             print('Nothing to do.')
 
@@ -95,18 +206,44 @@ def main():
             if args.force:
                 print('Resetting done state ...')
                 DB.setAllUndone(whereDone=1)
-            processPending()
+            retry = RetryPolicy(args.max_attempts, args.retry_delay,
+                                maxWait=args.max_wait)
+            if args.use_async:
+                processPendingAsync(concurrency=args.concurrency,
+                                    perHost=args.per_host,
+                                    maxRate=args.max_rate, retry=retry,
+                                    coordinator=args.coordinator)
+            else:
+                processPending(maxRate=args.max_rate, retry=retry,
+                               coordinator=args.coordinator)
+
+    elif args.cmd == 'coordinator':
+        serveCoordinator(args.host, args.port, lease=args.lease,
+                         retry=RetryPolicy(args.max_attempts,
+                                           args.retry_delay))
 
     elif args.cmd == 'err':
+        DB = CacheDB()
         if args.err_type == 'reset':
             print('Resetting error state ...')
-            CacheDB().setAllUndone(whereDone=3)
+            DB.setAllUndone(whereDone=3)
+            LeaseQueue(DB).requeueDead()
+        elif args.err_type == 'release':
+            print(f'Requeued {DB.releaseLeases(None)} claimed rows')
 
     elif args.cmd == 'export':
         if args.export_type == 'json':
-            export_json()
+            export_json(incremental=args.incremental,
+                        processes=args.processes)
+        elif args.export_type == 'packed':
+            export_packed()
         elif args.export_type == 'fsize':
             export_filesize()
+        elif args.export_type == 'files':
+            export_files(args.dir, args.ext)
+
+    elif args.cmd == 'migrate':
+        migrateBlobStore(args.storage)
 
     elif args.cmd == 'get':
         DB = CacheDB()
@@ -121,11 +258,16 @@ def main():
         elif args.get_type == 'ipa':
             dir = Path('ipa_download')
             dir.mkdir(exist_ok=True)
-            for pk in args.pk:
-                url = DB.getUrl(pk)
-                print(pk, ': load ipa', url)
-                urlretrieve(url, dir / f'{pk}.ipa', printProgress)
-                print(end='\r')
+            downloadIpas(args.pk, dir, workers=args.workers)
+
+    elif args.cmd == 'optimize-images':
+        optimizeImages(maxSize=args.size, processes=args.processes)
+
+    elif args.cmd == 'stats':
+        printStats(top=args.top)
+
+    elif args.cmd == 'explain':
+        printQueryPlans()
 
     elif args.cmd == 'set':
         DB = CacheDB()
@@ -134,6 +276,10 @@ def main():
                 print(pk, ': set done=4')
                 DB.setPermanentError(pk)
 
+    if args.cmd in ('run', 'update', 'export'):
+        # after large writes, not in every short-lived connection
+        CacheDB().optimize()
+
 
 ###############################################
 # Database
@@ -143,8 +289,55 @@ class CacheDB:
     def __init__(self) -> None:
         self._db = sqlite3.connect(CACHE_DIR / 'ipa_cache.db')
         self._db.execute('pragma busy_timeout=5000')
+        # readers (e.g., export) do not block the writer and vice versa
+        self._db.execute('pragma journal_mode=WAL')
+        self._db.execute('pragma synchronous=NORMAL')
+        self._batch = None  # type: tuple[int, float]|None
+        self._batchStart = 0.0
+        self._uncommitted = 0
+        self.commitTimes = []  # type: list[float]
+        self.committedRows = 0
+        self.metrics = None  # type: Metrics|None
+
+    # Schema migrations (`PRAGMA user_version`)
 
     def init(self):
+        ''' Create DB or migrate to latest schema version '''
+        migrations = [
+            self._migrateBaseline,
+            self._migrateChangeTracking,
+            self._migrateUrlValidators,
+            self._migrateCrc32,
+            self._migrateRetryQueue,
+            self._migrateDoneIndex,
+            self._migrateSortTitle,
+            self._migrateLeases,
+        ]
+        x = self._db.execute('PRAGMA user_version')
+        version = x.fetchone()[0]
+        if version > len(migrations):
+            raise RuntimeError(f'DB schema version {version} is newer than '
+                               f'supported ({len(migrations)})')
+        isNew = version == 0
+        while version < len(migrations):
+            # each step is atomic (DDL is transactional in sqlite). Re-read
+            # version, another worker may have migrated in the meantime
+            self._db.execute('BEGIN IMMEDIATE')
+            x = self._db.execute('PRAGMA user_version')
+            current = x.fetchone()[0]
+            if current >= len(migrations):
+                self._db.rollback()
+                break
+            if not isNew:
+                print(f'Migrating DB to schema version {current + 1} ...',
+                      file=stderr)
+            migrations[current]()
+            version = current + 1
+            self._db.execute(f'PRAGMA user_version={version}')
+            self._db.commit()
+
+    def _migrateBaseline(self) -> None:
+        ''' v1: original schema (urls and idx) '''
         self._db.execute('''
             CREATE TABLE IF NOT EXISTS urls(
                 pk INTEGER PRIMARY KEY,
@@ -171,9 +364,196 @@ class CacheDB:
             );
         ''')
 
+    def _columns(self, table: str) -> 'set[str]':
+        x = self._db.execute(f'PRAGMA table_info({table})')
+        return set(row[1] for row in x)
+
+    # v2 - v5 were added before versioning. Unversioned DBs of that time
+    # may already have (some of) these columns.
+
+    def _migrateChangeTracking(self) -> None:
+        ''' v2: `idx_changes` for incremental export (filled by triggers) '''
+        self._db.execute('''CREATE TABLE IF NOT EXISTS idx_changes(
+            seq INTEGER PRIMARY KEY,
+            pk INTEGER NOT NULL
+        );''')
+        self._db.execute('''
+            CREATE TRIGGER IF NOT EXISTS idx_changes_insert AFTER INSERT ON idx
+            BEGIN
+                INSERT INTO idx_changes (pk) VALUES (NEW.pk);
+            END;''')
+        self._db.execute('''
+            CREATE TRIGGER IF NOT EXISTS idx_changes_update AFTER UPDATE OF
+                base_url, path_name, done, fsize,
+                min_os, platform, title, bundle_id, version ON idx
+            BEGIN
+                INSERT INTO idx_changes (pk) VALUES (NEW.pk);
+            END;''')
+        self._db.execute('''
+            CREATE TRIGGER IF NOT EXISTS idx_changes_delete AFTER DELETE ON idx
+            BEGIN
+                INSERT INTO idx_changes (pk) VALUES (OLD.pk);
+            END;''')
+
+    def _migrateUrlValidators(self) -> None:
+        ''' v3: `etag`, `last_modified` and `list_sha1` for `update` '''
+        columns = self._columns('urls')
+        for column in ('etag', 'last_modified', 'list_sha1'):
+            if column not in columns:
+                self._db.execute(f'ALTER TABLE urls ADD COLUMN {column} TEXT;')
+
+    def _migrateCrc32(self) -> None:
+        ''' v4: crc32 of ipa file for duplicate detection '''
+        if 'crc32' not in self._columns('idx'):
+            self._db.execute('ALTER TABLE idx ADD COLUMN crc32 TEXT;')
+            self._backfillCrc32()
+        self._db.execute('''CREATE INDEX IF NOT EXISTS idx_crc32_fsize
+            ON idx(crc32, fsize);''')
+
+    def _migrateRetryQueue(self) -> None:
+        ''' v5: `attempts` and `next_attempt` for transient errors '''
+        columns = self._columns('idx')
+        if 'attempts' not in columns:
+            self._db.execute('''ALTER TABLE idx
+                ADD COLUMN attempts INTEGER DEFAULT 0;''')
+        if 'next_attempt' not in columns:
+            self._db.execute('''ALTER TABLE idx
+                ADD COLUMN next_attempt INTEGER DEFAULT NULL;''')
+        self._db.execute('''CREATE INDEX IF NOT EXISTS idx_next_attempt
+            ON idx(next_attempt) WHERE next_attempt IS NOT NULL;''')
+
+    def _migrateDoneIndex(self) -> None:
+        '''
+        v6: `count(done=)`, `GROUP BY done` and the pending queue
+        (`done=? AND pk>? ORDER BY pk`, rowid is part of every index).
+        '''
+        self._db.execute('CREATE INDEX IF NOT EXISTS idx_done ON idx(done);')
+        self._db.execute('''CREATE INDEX IF NOT EXISTS idx_fsize
+            ON idx(fsize) WHERE fsize>0;''')
+        # else the planner prefers idx_done over the (small) retry index
+        self._db.execute('ANALYZE;')
+
+    def _migrateSortTitle(self) -> None:
+        '''
+        v7: `sort_title` (title or file name) + covering index in export
+        order. Maintained by triggers, not `GENERATED ALWAYS AS (…) STORED`
+        because sqlite never uses an index with generated columns as
+        covering index (and stored columns require a table rebuild).
+        '''
+        self._db.execute('ALTER TABLE idx ADD COLUMN sort_title TEXT;')
+        sortTitle = '''TRIM(IFNULL(title,
+            REPLACE(path_name,RTRIM(path_name,REPLACE(path_name,'/','')),'')
+        ))'''
+        self._db.execute(f'UPDATE idx SET sort_title={sortTitle};')
+        for name, event in (('insert', 'INSERT'),
+                            ('update', 'UPDATE OF title, path_name')):
+            self._db.execute(f'''
+                CREATE TRIGGER idx_sort_title_{name} AFTER {event} ON idx
+                BEGIN
+                    UPDATE idx SET sort_title={sortTitle} WHERE pk=NEW.pk;
+                END;''')
+        # all columns of `enumJsonIpa`, pk last to match ORDER BY
+        self._db.execute('''CREATE INDEX idx_export ON idx(done,
+            sort_title COLLATE NOCASE, min_os, platform, version, pk,
+            bundle_id, base_url, path_name, fsize);''')
+        self._db.execute('ANALYZE;')
+
+    def _migrateLeases(self) -> None:
+        '''
+        v8: done=2 (in progress) with `lease_owner` and `lease_until`.
+        The lease is cleared on any other state. Claiming and requeueing
+        (0 <-> 2) is not exported and thus not tracked in `idx_changes`.
+        '''
+        self._db.execute('ALTER TABLE idx ADD COLUMN lease_owner TEXT;')
+        self._db.execute('ALTER TABLE idx ADD COLUMN lease_until INTEGER;')
+        self._db.execute('''
+            CREATE TRIGGER idx_lease_clear AFTER UPDATE OF done ON idx
+            WHEN NEW.done != 2 AND NEW.lease_owner IS NOT NULL
+            BEGIN
+                UPDATE idx SET lease_owner=NULL, lease_until=NULL
+                WHERE pk=NEW.pk;
+            END;''')
+        self._db.execute('DROP TRIGGER IF EXISTS idx_changes_update;')
+        self._db.execute('''
+            CREATE TRIGGER idx_changes_update AFTER UPDATE OF
+                base_url, path_name, done, fsize,
+                min_os, platform, title, bundle_id, version ON idx
+            WHEN NOT (OLD.done IN (0, 2) AND NEW.done IN (0, 2))
+            BEGIN
+                INSERT INTO idx_changes (pk) VALUES (NEW.pk);
+            END;''')
+        # pending queue and lease expiry
+        self._db.execute('''CREATE INDEX idx_lease_until
+            ON idx(lease_until) WHERE done=2;''')
+
     def __del__(self) -> None:
         self._db.close()
 
+    def optimize(self) -> None:
+        ''' Keep planner statistics up-to-date (usually a no-op) '''
+        self._db.execute('PRAGMA optimize;')
+
+    def _backfillCrc32(self) -> None:
+        ''' Read crc32 from cached file lists in `url_cache` '''
+        x = self._db.execute('SELECT pk FROM urls;')
+        for (baseUrlId,) in x.fetchall():
+            json_file = pathToListJson(baseUrlId)
+            if json_file.exists():
+                self._db.executemany('''UPDATE idx SET crc32=?
+                    WHERE base_url=? AND path_name=?;''', (
+                    (crc, baseUrlId, path) for path, _, crc
+                    in readListArchiveOrg(json_file)))
+
+    # Transactions
+
+    @contextmanager
+    def batchedWrites(self, *, maxRows: int = 200, maxDelay: float = 2.0):
+        '''
+        Group writes into transactions of up to `maxRows` rows or `maxDelay`
+        seconds. Uncommitted rows are lost on crash (but can be reindexed).
+        '''
+        self._batch = (maxRows, maxDelay)
+        self._batchStart = time.monotonic()
+        try:
+            yield self
+        finally:
+            self._batch = None
+            self.commit()
+
+    def _commit(self) -> None:
+        self._uncommitted += 1
+        if not self._batch or self._uncommitted >= self._batch[0]:
+            self.commit()
+        else:
+            self.commitIfDue()
+
+    def commitIfDue(self) -> None:
+        ''' Commit if batch is older than `maxDelay`. '''
+        if self._uncommitted and (not self._batch or time.monotonic()
+                                  - self._batchStart >= self._batch[1]):
+            self.commit()
+
+    def commit(self) -> None:
+        start = time.monotonic()
+        self._db.commit()
+        self.commitTimes.append(time.monotonic() - start)
+        if self.metrics:
+            self.metrics.observe('db_commit', self.commitTimes[-1])
+        self.committedRows += self._uncommitted
+        self._batchStart = time.monotonic()
+        self._uncommitted = 0
+
+    def commitStats(self) -> str:
+        ''' Summary of commit latency '''
+        times = sorted(self.commitTimes)
+        if not times:
+            return 'DB: no commits'
+        avg = sum(times) / len(times)
+        p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+        return f'DB: {self.committedRows} writes in {len(times)} commits, ' \
+            f'latency avg {avg * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms, ' \
+            f'max {times[-1] * 1000:.1f} ms'
+
     # Get URL
 
     def getIdForBaseUrl(self, url: str) -> 'int|None':
@@ -198,12 +578,18 @@ class CacheDB:
         base, path = x.fetchone()
         return base + '/' + quote(path)
 
+    def getIpaFile(self, uid: int) -> 'tuple[int, str, int, str|None]':
+        ''' :returns: `(base_url, path_name, fsize, crc32)` '''
+        x = self._db.execute('''SELECT base_url, path_name, fsize, crc32
+            FROM idx WHERE pk=?;''', [uid])
+        return x.fetchone()
+
     # Insert URL
 
     def insertBaseUrl(self, base: str) -> int:
         try:
             x = self._db.execute('INSERT INTO urls (url) VALUES (?);', [base])
-            self._db.commit()
+            self._commit()
             return x.lastrowid  # type: ignore
         except sqlite3.IntegrityError:
             x = self._db.execute('SELECT pk FROM urls WHERE url = ?;', [base])
@@ -212,12 +598,16 @@ class CacheDB:
     def insertIpaUrls(
         self, baseUrlId: int, entries: 'Iterable[tuple[str, int, str]]'
     ) -> int:
-        ''' :entries: must be iterable of `(path_name, filesize, crc32)` '''
-        self._db.executemany('''
-        INSERT OR IGNORE INTO idx (base_url, path_name, fsize) VALUES (?,?,?);
-        ''', ((baseUrlId, path, size) for path, size, _crc in entries))
-        self._db.commit()
-        return self._db.total_changes
+        '''
+        :entries: must be iterable of `(path_name, filesize, crc32)`
+        :returns: number of inserted rows
+        '''
+        x = self._db.executemany('''
+        INSERT OR IGNORE INTO idx (base_url, path_name, fsize, crc32)
+        VALUES (?,?,?,?);''', ((baseUrlId, path, size, crc)
+                               for path, size, crc in entries))
+        self._commit()
+        return x.rowcount  # unlike total_changes, without trigger writes
 
     # Update URL
 
@@ -230,21 +620,80 @@ class CacheDB:
     def markBaseUrlUpdated(self, uid: int) -> None:
         self._db.execute('''
             UPDATE urls SET date=strftime('%s','now') WHERE pk=?''', [uid])
-        self._db.commit()
+        self._commit()
 
-    def updateIpaUrl(self, baseUrlId: int, entry: 'tuple[str, int, str]') \
-            -> 'int|None':
-        ''' :entry: must be `(path_name, filesize, crc32)` '''
-        uid = self.getId(baseUrlId, entry[0])
-        if uid:
-            self._db.execute('UPDATE idx SET done=0, fsize=? WHERE pk=?;',
-                             [entry[1], uid])
-            self._db.commit()
-            return uid
-        if self.insertIpaUrls(baseUrlId, [entry]) > 0:
-            x = self._db.execute('SELECT MAX(pk) FROM idx;')
-            return x.fetchone()[0]
-        return None
+    def getListValidators(self, uid: int) -> 'ListValidators':
+        x = self._db.execute('''SELECT etag, last_modified, list_sha1
+            FROM urls WHERE pk=?''', [uid])
+        return ListValidators(*(x.fetchone() or (None, None, None)))
+
+    def setListValidators(self, uid: int, val: 'ListValidators') -> None:
+        self._db.execute('''UPDATE urls SET etag=?, last_modified=?,
+            list_sha1=? WHERE pk=?''', [*val, uid])
+        self._commit()
+
+    def reconcileIpaUrls(
+        self, baseUrlId: int, entries: 'Iterable[tuple[str, int, str]]',
+        changedPaths: 'set[str]'
+    ) -> 'tuple[list[tuple[int, str]], list[tuple[int, str]]]':
+        '''
+        Sync `idx` with the full file list of `baseUrlId` in one transaction.
+        Missing entries are set done=4 and entries with a different size or
+        crc32 (or in `changedPaths`) are reset to done=0. New entries are
+        added.
+        :entries: must be iterable of `(path_name, filesize, crc32)`
+        :returns: `(removed, added)` lists of `(pk, path_name)`.
+            Cache files of all removed (and reset) pks must be deleted.
+        '''
+        self._db.execute('''CREATE TEMP TABLE IF NOT EXISTS list_update(
+            path_name TEXT PRIMARY KEY, fsize INTEGER, crc32 TEXT,
+            changed INTEGER);''')
+        self._db.execute('DELETE FROM list_update;')
+        self._db.executemany('''INSERT OR REPLACE INTO list_update
+            (path_name, fsize, crc32, changed) VALUES (?,?,?,?);''', (
+            (path, size, crc, path in changedPaths)
+            for path, size, crc in entries))
+
+        x = self._db.execute('''SELECT pk, path_name FROM idx
+            WHERE base_url=? AND done!=4 AND path_name NOT IN (
+                SELECT path_name FROM list_update)
+            ORDER BY pk;''', [baseUrlId])
+        removed = x.fetchall()
+        x = self._db.execute('''SELECT pk, path_name FROM idx
+            INNER JOIN list_update USING (path_name) WHERE base_url=?
+            AND (changed OR idx.fsize != list_update.fsize
+                OR idx.crc32 != list_update.crc32)
+            ORDER BY pk;''', [baseUrlId])
+        reset = x.fetchall()
+        # fill in crc32 for rows added before it was stored
+        self._db.execute('''UPDATE idx SET crc32=(SELECT crc32 FROM list_update
+            WHERE list_update.path_name=idx.path_name)
+            WHERE base_url=? AND crc32 IS NULL;''', [baseUrlId])
+
+        self._db.executemany('''
+            UPDATE idx SET done=4, min_os=NULL, platform=NULL, title=NULL,
+            bundle_id=NULL, version=NULL WHERE pk=?;''', (
+            (pk,) for pk, _ in removed))
+        self._db.executemany('''
+            UPDATE idx SET done=0, min_os=NULL, platform=NULL, title=NULL,
+            bundle_id=NULL, version=NULL, attempts=0, next_attempt=NULL,
+            (fsize, crc32)=(
+                SELECT fsize, crc32 FROM list_update
+                WHERE list_update.path_name=idx.path_name)
+            WHERE pk=?;''', ((pk,) for pk, _ in reset))
+
+        x = self._db.execute('SELECT IFNULL(MAX(pk), 0) FROM idx;')
+        maxPk = x.fetchone()[0]
+        self._db.execute('''INSERT INTO idx (base_url, path_name, fsize, crc32)
+            SELECT ?, path_name, fsize, crc32 FROM list_update WHERE path_name
+                NOT IN (SELECT path_name FROM idx WHERE base_url=?)
+            ORDER BY path_name;''', [baseUrlId, baseUrlId])
+        x = self._db.execute('''SELECT pk, path_name FROM idx
+            WHERE base_url=? AND pk>? ORDER BY pk;''', [baseUrlId, maxPk])
+        added = x.fetchall()
+        self._db.execute('DELETE FROM list_update;')
+        self._commit()
+        return removed + reset, reset + added
 
     # Export JSON
 
@@ -255,15 +704,38 @@ class CacheDB:
             rv[pk] = url
         return rv
 
-    def enumJsonIpa(self, *, done: int) -> Iterable[tuple]:
-        yield from self._db.execute('''
-            SELECT pk, platform, IFNULL(min_os, 0),
-                TRIM(IFNULL(title,
-                    REPLACE(path_name,RTRIM(path_name,REPLACE(path_name,'/','')),'')
-                )) as tt, IFNULL(bundle_id, ""),
-                version, base_url, path_name, fsize / 1024
-            FROM idx WHERE done=?
-            ORDER BY tt COLLATE NOCASE, min_os, platform, version;''', [done])
+    def enumJsonIpa(self, *, done: int, bucket: 'int|None' = None) \
+            -> Iterable[tuple]:
+        ''' :bucket: if set, only `pk // 1000 == bucket` ordered by pk '''
+        query = '''
+            SELECT pk, platform, IFNULL(min_os, 0), sort_title,
+                IFNULL(bundle_id, ""), version, base_url, path_name,
+                fsize / 1024
+            FROM idx WHERE done=?'''
+        if bucket is None:
+            yield from self._db.execute(query + '''
+            ORDER BY sort_title COLLATE NOCASE, min_os, platform, version, pk;
+            ''', [done])
+        else:
+            yield from self._db.execute(query + '''
+            AND pk BETWEEN ? AND ? ORDER BY pk;''', [
+                done, bucket * 1000, bucket * 1000 + 999])
+
+    def jsonBuckets(self) -> 'set[int]':
+        x = self._db.execute('SELECT DISTINCT pk / 1000 FROM idx;')
+        return set(row[0] for row in x)
+
+    def jsonChanges(self) -> 'tuple[int, set[int]]':
+        ''' :returns: `(last_seq, {bucket, ...})` for all changed rows '''
+        x = self._db.execute('SELECT IFNULL(MAX(seq), 0) FROM idx_changes;')
+        seq = x.fetchone()[0]
+        x = self._db.execute('''SELECT DISTINCT pk / 1000 FROM idx_changes
+            WHERE seq <= ?;''', [seq])
+        return seq, set(row[0] for row in x)
+
+    def clearJsonChanges(self, *, upToSeq: int) -> None:
+        self._db.execute('DELETE FROM idx_changes WHERE seq <= ?;', [upToSeq])
+        self._commit()
 
     # Filesize
 
@@ -273,7 +745,7 @@ class CacheDB:
     def setFilesize(self, uid: int, size: int) -> None:
         if size > 0:
             self._db.execute('UPDATE idx SET fsize=? WHERE pk=?;', [size, uid])
-            self._db.commit()
+            self._commit()
 
     # Process Pending
 
@@ -281,75 +753,193 @@ class CacheDB:
         x = self._db.execute('SELECT COUNT() FROM idx WHERE done=?;', [done])
         return x.fetchone()[0]
 
-    def getPendingQueue(self, *, done: int, batchsize: int) \
-            -> 'list[tuple[int, str, str]]':
+    def countByDone(self) -> 'dict[int, int]':
+        x = self._db.execute('SELECT done, COUNT() FROM idx GROUP BY done;')
+        return dict(x.fetchall())
+
+    def getPendingQueue(self, *, done: int, batchsize: int, afterPk: int = 0) \
+            -> 'list[tuple[int, str, str, int]]':
         # url || "/" || REPLACE(REPLACE(path_name, '#', '%23'), '?', '%3F')
-        x = self._db.execute('''SELECT idx.pk, url, path_name
+        x = self._db.execute('''SELECT idx.pk, url, path_name, fsize
+            FROM idx INNER JOIN urls ON urls.pk=base_url
+            WHERE done=? AND idx.pk>? AND (next_attempt IS NULL
+                OR next_attempt <= strftime('%s','now'))
+            ORDER BY idx.pk LIMIT ?;''', [done, afterPk, batchsize])
+        return x.fetchall()
+
+    # Leases (done=2, see `LeaseQueue`)
+
+    def claimPending(self, owner: str, *, limit: int, lease: float) \
+            -> 'list[tuple[int, str, str, int]]':
+        '''
+        Atomically set up to `limit` pending rows (incl. due retries) to
+        done=2 for `owner`. Expired leases of other workers are requeued.
+        '''
+        now = int(time.time())
+        self._db.execute('''UPDATE idx SET done=0
+            WHERE done=2 AND lease_until < ?;''', [now])
+        x = self._db.execute('''UPDATE idx SET done=2, lease_owner=?,
+            lease_until=? WHERE pk IN (SELECT pk FROM idx WHERE done=0
+                AND (next_attempt IS NULL OR next_attempt <= ?)
+                ORDER BY pk LIMIT ?)
+            RETURNING pk;''', [owner, now + round(lease), now, limit])
+        pks = [row[0] for row in x.fetchall()]
+        self._uncommitted += len(pks)
+        self.commit()  # visible to other workers
+        x = self._db.execute(f'''SELECT idx.pk, url, path_name, fsize
             FROM idx INNER JOIN urls ON urls.pk=base_url
-            WHERE done=? LIMIT ?;''', [done, batchsize])
+            WHERE idx.pk IN ({','.join('?' * len(pks))})
+            ORDER BY idx.pk;''', pks)
+        return x.fetchall()
+
+    def renewLeases(self, owner: str, *, lease: float) -> None:
+        self._db.execute('''UPDATE idx SET lease_until=?
+            WHERE done=2 AND lease_owner=?;''', [
+            int(time.time()) + round(lease), owner])
+        self.commit()
+
+    def releaseLeases(self, owner: 'str|None') -> int:
+        ''' Requeue all rows still claimed by `owner` (or by anyone) '''
+        x = self._db.execute('''UPDATE idx SET done=0
+            WHERE done=2 AND IFNULL(lease_owner=?, 1);''', [owner])
+        self.commit()
+        return x.rowcount
+
+    def holdsLease(self, uid: int, owner: str) -> bool:
+        x = self._db.execute('''SELECT 1 FROM idx
+            WHERE pk=? AND done=2 AND lease_owner=?;''', [uid, owner])
+        return x.fetchone() is not None
+
+    def nextLeaseExpiry(self, *, exceptOwner: str) -> 'int|None':
+        ''' :returns: unix time when a lease of another worker expires '''
+        x = self._db.execute('''SELECT MIN(lease_until) FROM idx
+            WHERE done=2 AND lease_owner!=?;''', [exceptOwner])
+        return x.fetchone()[0]
+
+    def leaseOwners(self) -> 'list[tuple[str, int, int]]':
+        ''' :returns: `[(owner, row count, earliest lease_until), ...]` '''
+        x = self._db.execute('''SELECT lease_owner, COUNT(), MIN(lease_until)
+            FROM idx WHERE done=2 GROUP BY lease_owner ORDER BY 3;''')
         return x.fetchall()
 
+    # Retry queue
+
+    def nextRetryDue(self) -> 'int|None':
+        ''' :returns: unix time of next retry (in the future) '''
+        x = self._db.execute('''SELECT MIN(next_attempt) FROM idx
+            WHERE next_attempt > strftime('%s','now') AND done=0;''')
+        return x.fetchone()[0]
+
+    def countRetries(self) -> int:
+        x = self._db.execute('''SELECT COUNT() FROM idx
+            WHERE next_attempt IS NOT NULL AND done=0;''')
+        return x.fetchone()[0]
+
+    def getAttempts(self, uid: int) -> int:
+        x = self._db.execute('SELECT attempts FROM idx WHERE pk=?;', [uid])
+        return (x.fetchone() or [0])[0] or 0
+
+    def scheduleRetry(self, uid: int, delay: float) -> None:
+        self._db.execute('''UPDATE idx SET done=0,
+            attempts=IFNULL(attempts, 0) + 1,
+            next_attempt=CAST(strftime('%s','now') AS INTEGER) + ?
+            WHERE pk=?;''', [round(delay), uid])
+        self._commit()
+
+    def findDoneDuplicate(self, uid: int) -> 'int|None':
+        ''' :returns: pk of a done entry with same crc32 and fsize '''
+        x = self._db.execute('''SELECT dup.pk FROM idx
+            INNER JOIN idx dup ON dup.crc32=idx.crc32 AND dup.fsize=idx.fsize
+            WHERE idx.pk=? AND idx.fsize>0 AND dup.done=1 AND dup.pk!=idx.pk
+            LIMIT 1;''', [uid])
+        row = x.fetchone()
+        return row[0] if row else None
+
+    def copyMetadata(self, uid: int, srcUid: int) -> None:
+        self._db.execute('''UPDATE idx SET
+            (done, min_os, platform, title, bundle_id, version) = (
+                SELECT done, min_os, platform, title, bundle_id, version
+                FROM idx WHERE pk=?), attempts=0, next_attempt=NULL
+            WHERE pk=?;''', [srcUid, uid])
+        self._commit()
+
     def setAllUndone(self, *, whereDone: int) -> None:
-        self._db.execute('UPDATE idx SET done=0 WHERE done=?;', [whereDone])
-        self._db.commit()
+        self._db.execute('''UPDATE idx SET done=0, attempts=0,
+            next_attempt=NULL WHERE done=?;''', [whereDone])
+        self._commit()
 
     # Finalize / Postprocessing
 
     def setError(self, uid: int, *, done: int) -> None:
-        self._db.execute('UPDATE idx SET done=? WHERE pk=?;', [done, uid])
-        self._db.commit()
+        self._db.execute('''UPDATE idx SET done=?, next_attempt=NULL
+            WHERE pk=?;''', [done, uid])
+        self._commit()
 
     def setPermanentError(self, uid: int) -> None:
         '''
         Set done=4 and all file related columns to NULL.
-        Will also delete all plist, and image files for {uid} in CACHE_DIR
+        Will also delete all plist, and image files for {uid} in blob storage
         '''
         self._db.execute('''
             UPDATE idx SET done=4, min_os=NULL, platform=NULL, title=NULL,
             bundle_id=NULL, version=NULL WHERE pk=?;''', [uid])
-        self._db.commit()
-        for ext in ['.plist', '.png', '.jpg']:
-            fname = diskPath(uid, ext)
-            if fname.exists():
-                os.remove(fname)
-
-    def setDone(self, uid: int) -> None:
-        plist_path = diskPath(uid, '.plist')
-        if not plist_path.exists():
-            return
-        with open(plist_path, 'rb') as fp:
-            try:
-                plist = plistlib.load(fp)
-            except Exception as e:
-                print(f'ERROR: [{uid}] PLIST: {e}', file=stderr)
-                self.setError(uid, done=3)
-                return
-
-        bundleId = plist.get('CFBundleIdentifier')
-        title = plist.get('CFBundleDisplayName') or plist.get('CFBundleName')
-        v_short = str(plist.get('CFBundleShortVersionString', ''))
-        v_long = str(plist.get('CFBundleVersion', ''))
-        version = v_short or v_long
-        if version != v_long and v_long:
-            version += f' ({v_long})'
-        minOS = [int(x) for x in plist.get('MinimumOSVersion', '0').split('.')]
-        minOS += [0, 0, 0]  # ensures at least 3 components are given
-        platforms = sum(1 << int(x) for x in plist.get('UIDeviceFamily', []))
-        if not platforms and minOS[0] in [0, 1, 2, 3]:
-            platforms = 1 << 1  # fallback to iPhone for old versions
+        self._commit()
+        deleteCacheFiles([uid])
 
+    def setDone(self, uid: int, info: 'IpaInfo') -> None:
         self._db.execute('''
             UPDATE idx SET
-                done=1, min_os=?, platform=?, title=?, bundle_id=?, version=?
+                done=1, min_os=?, platform=?, title=?, bundle_id=?, version=?,
+                attempts=0, next_attempt=NULL
             WHERE pk=?;''', [
-            (minOS[0] * 10000 + minOS[1] * 100 + minOS[2]) or None,
-            platforms or None,
-            title or None,
-            bundleId or None,
-            version or None,
-            uid,
+            info.min_os, info.platform, info.title, info.bundle_id,
+            info.version, uid,
         ])
-        self._db.commit()
+        self._commit()
+
+    # Debug
+
+    def queryPlans(self) -> 'list[tuple[str, str, list[tuple[int, str]]]]':
+        '''
+        Run the hot read queries once (with sample arguments) and collect
+        the actual SQL via trace callback.
+        :returns: list of `(method, sql, [(depth, plan_step), ...])`
+        '''
+        x = self._db.execute('SELECT IFNULL(MAX(pk), 0) FROM idx;')
+        uid = x.fetchone()[0]
+        calls = {
+            'count': lambda: self.count(done=0),
+            'countByDone': self.countByDone,
+            'getPendingQueue': lambda: self.getPendingQueue(
+                done=0, batchsize=100),
+            'nextRetryDue': self.nextRetryDue,
+            'nextLeaseExpiry': lambda: self.nextLeaseExpiry(exceptOwner=''),
+            'findDoneDuplicate': lambda: self.findDoneDuplicate(uid),
+            'enumFilesize': lambda: next(iter(self.enumFilesize()), None),
+            'enumJsonIpa': lambda: next(iter(self.enumJsonIpa(done=1)), None),
+            'enumJsonIpa(bucket)': lambda: next(
+                iter(self.enumJsonIpa(done=1, bucket=uid // 1000)), None),
+            'jsonBuckets': self.jsonBuckets,
+        }
+        queries = []  # type: list[tuple[str, str]]
+        for name, fn in calls.items():
+            self._db.set_trace_callback(lambda sql, name=name: queries.append(
+                (name, ' '.join(sql.split()))))
+            fn()
+        self._db.set_trace_callback(None)
+
+        rv = []
+        for name, sql in queries:
+            if not sql.upper().startswith('SELECT'):
+                continue
+            depth = {0: -1}
+            plan = []
+            for nid, parent, _, detail in self._db.execute(
+                    'EXPLAIN QUERY PLAN ' + sql):
+                depth[nid] = depth.get(parent, -1) + 1
+                plan.append((depth[nid], detail))
+            rv.append((name, sql, plan))
+        return rv
 
 
 ###############################################
@@ -360,11 +950,99 @@ def addNewUrl(url: str) -> None:
     archiveId = extractArchiveOrgId(url)
     if not archiveId:
         return
-    baseUrlId = CacheDB().insertBaseUrl(urlForArchiveOrgId(archiveId))
+    DB = CacheDB()
+    baseUrlId = DB.insertBaseUrl(urlForArchiveOrgId(archiveId))
     json_file = pathToListJson(baseUrlId)
-    entries = downloadListArchiveOrg(archiveId, json_file)
-    inserted = CacheDB().insertIpaUrls(baseUrlId, entries)
-    print(f'new links added: {inserted} of {len(entries)}')
+    if not json_file.exists():
+        validators = fetchListArchiveOrg(archiveId, json_file)
+        if validators:
+            DB.setListValidators(baseUrlId, validators)
+    total = writeListCache(readListArchiveOrg(json_file),
+                           pathToListCache(baseUrlId))
+    # insert in listing order (pk order = processing order)
+    inserted = DB.insertIpaUrls(baseUrlId, readListArchiveOrg(json_file))
+    print(f'new links added: {inserted} of {total}')
+
+
+def addSearchResults(query: str, *, workers: int = 8,
+                     pageSize: int = 1000) -> None:
+    '''
+    Add all archive.org items matching `query` which contain .ipa files.
+    File lists are downloaded in parallel while paging through the search
+    results, DB writes happen in the main thread in batched transactions.
+    '''
+    start = time.monotonic()
+    DB = CacheDB()
+    counts = {'added': 0, 'known': 0, 'no-ipa': 0, 'failed': 0}
+    links = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool, \
+            DB.batchedWrites(maxRows=1000):
+        futures = {}
+        seen = set()  # type: set[str]
+        for archiveId in searchArchiveOrg(query, pageSize=pageSize):
+            if archiveId in seen:
+                continue
+            seen.add(archiveId)
+            if DB.getIdForBaseUrl(urlForArchiveOrgId(archiveId)):
+                counts['known'] += 1
+                continue
+            futures[pool.submit(_fetchSearchResult, archiveId)] = archiveId
+        print(f'{len(futures)} new items found ({counts["known"]} known)')
+
+        for i, future in enumerate(as_completed(futures)):
+            archiveId = futures[future]
+            try:
+                tmp_file, validators, entries = future.result()
+            except Exception as e:
+                print(f'[{i + 1}/{len(futures)}] [ERROR] {archiveId}: {e}',
+                      file=stderr)
+                counts['failed'] += 1
+                continue
+            if not entries:
+                os.remove(tmp_file)
+                counts['no-ipa'] += 1
+                continue
+            baseUrlId = DB.insertBaseUrl(urlForArchiveOrgId(archiveId))
+            os.replace(tmp_file, pathToListJson(baseUrlId))
+            writeListCache(entries, pathToListCache(baseUrlId))
+            if validators:
+                DB.setListValidators(baseUrlId, validators)
+            inserted = DB.insertIpaUrls(baseUrlId, entries)
+            links += inserted
+            counts['added'] += 1
+            print(f'[{i + 1}/{len(futures)}] {archiveId}: '
+                  f'{inserted} links added')
+
+    elapsed = time.monotonic() - start
+    fetched = len(futures) - counts['failed']
+    print(f'done. {links} links in {elapsed:.1f}s, '
+          f'{fetched / elapsed * 60:.0f} collections/min: '
+          + ', '.join(f'{v} {k}' for k, v in counts.items()))
+
+
+def _fetchSearchResult(archiveId: str) \
+        -> 'tuple[Path, ListValidators|None, list[tuple[str, int, str|None]]]':
+    ''' Download and parse file list (runs in worker thread) '''
+    tmp_file = CACHE_DIR / 'url_cache' / f'search_{archiveId}.json.gz'
+    validators = fetchListArchiveOrg(archiveId, tmp_file)
+    return tmp_file, validators, list(readListArchiveOrg(tmp_file))
+
+
+def searchArchiveOrg(query: str, *, pageSize: int = 1000) -> 'Iterator[str]':
+    ''' Page through the scrape API (cursor based). :returns: identifiers '''
+    cursor = None
+    while True:
+        params = {'q': query, 'fields': 'identifier', 'count': pageSize}
+        if cursor:
+            params['cursor'] = cursor
+        with urlopen(f'{ARCHIVE_ORG}/services/search/v1/scrape?'
+                     + urlencode(params), timeout=60) as page:
+            data = json.load(page)
+        for item in data.get('items', []):
+            yield item['identifier']
+        cursor = data.get('cursor')
+        if not cursor:
+            return
 
 
 def extractArchiveOrgId(url: str) -> 'str|None':
@@ -376,7 +1054,7 @@ def extractArchiveOrgId(url: str) -> 'str|None':
 
 
 def urlForArchiveOrgId(archiveId: str) -> str:
-    return f'https://archive.org/download/{archiveId}'
+    return f'{ARCHIVE_ORG}/download/{archiveId}'
 
 
 def pathToListJson(baseUrlId: int, *, tmp: bool = False) -> Path:
@@ -385,80 +1063,346 @@ def pathToListJson(baseUrlId: int, *, tmp: bool = False) -> Path:
     return CACHE_DIR / 'url_cache' / f'{baseUrlId}.json.gz'
 
 
-def downloadListArchiveOrg(
-    archiveId: str, json_file: Path, *, force: bool = False
-) -> 'list[tuple[str, int, str]]':
-    ''' :returns: List of `(path_name, file_size, crc32)` '''
-    # store json for later
-    if force or not json_file.exists():
-        json_file.parent.mkdir(exist_ok=True)
-        print(f'load: {archiveId}')
-        req = Request(f'https://archive.org/metadata/{archiveId}/files')
-        req.add_header('Accept-Encoding', 'deflate, gzip')
-        with urlopen(req) as page:
+def fetchListArchiveOrg(
+    archiveId: str, json_file: Path, validators: 'ListValidators|None' = None
+) -> 'ListValidators|None':
+    '''
+    Download file list. If `validators` are set, use a conditional request.
+    :returns: `None` if not modified (HTTP 304)
+    '''
+    json_file.parent.mkdir(exist_ok=True)
+    print(f'load: {archiveId}')
+    req = Request(f'{ARCHIVE_ORG_METADATA}/{archiveId}/files')
+    req.add_header('Accept-Encoding', 'deflate, gzip')
+    if validators and validators.etag:
+        req.add_header('If-None-Match', validators.etag)
+    if validators and validators.last_modified:
+        req.add_header('If-Modified-Since', validators.last_modified)
+    # hash of the content. The gzip header (mtime) may change for the
+    # same list, which would defeat the "unchanged" check in `update`
+    sha1 = hashlib.sha1()
+    unzip = None
+    try:
+        with urlopen(req, timeout=60) as page:
             with open(json_file, 'wb') as fp:
                 while True:
                     block = page.read(8096)
                     if not block:
                         break
                     fp.write(block)
-    # read saved json from disk
-    with gzip.open(json_file, 'rb') as fp:
-        data = json.load(fp)
-    # process and add to DB
-    return [(x['name'], int(x.get('size', 0)), x.get('crc32'))
-            for x in data['result']
-            if x['source'] == 'original' and x['name'].endswith('.ipa')]
+                    if unzip is None:
+                        unzip = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                            if block[:2] == b'\x1f\x8b' else False
+                    sha1.update(unzip.decompress(block) if unzip else block)
+            return ListValidators(page.headers.get('ETag'),
+                                  page.headers.get('Last-Modified'),
+                                  sha1.hexdigest())
+    except HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+
+def readListArchiveOrg(json_file: Path) \
+        -> 'Iterator[tuple[str, int, str|None]]':
+    '''
+    Stream saved json from disk (without loading the whole document).
+    :returns: `(path_name, file_size, crc32)` of all original .ipa files
+    '''
+    with gzip.open(json_file, 'rt', encoding='utf-8') as fp:
+        stream = JsonStream(fp)
+        for key in stream.iterObject():
+            if key != 'result':
+                stream.value()
+                continue
+            for x in stream.iterArray():
+                if x['source'] == 'original' and x['name'].endswith('.ipa'):
+                    yield x['name'], int(x.get('size', 0)), x.get('crc32')
+
+
+class JsonStream:
+    '''
+    Minimal incremental JSON reader. Containers are iterated one child at
+    a time, everything else is decoded with `json` (C scanner).
+    '''
+    re_space = re.compile(r'[ \t\n\r]*')
+    # separator and whitespace around it (fast path for containers)
+    re_next = re.compile(r'[ \t\n\r]*([,\]}])[ \t\n\r]*')
+    re_number_tail = re.compile(r'[-+.eE0-9]*')
+
+    def __init__(self, fp: 'TextIO', chunkSize: int = 1 << 16) -> None:
+        self._fp = fp
+        self._chunkSize = chunkSize
+        self._scan = json.JSONDecoder().scan_once
+        self._buf = ''
+        self._pos = 0
+
+    def _fill(self) -> bool:
+        chunk = self._fp.read(self._chunkSize)
+        if not chunk:
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        ''' Skip whitespace. :returns: next char or `''` at EOF '''
+        while True:
+            self._pos = self.re_space.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError(f'JSON: expected {chars!r}, got {char!r}')
+        self._pos += 1
+        return char
+
+    def _next(self, chars: str) -> str:
+        ''' :returns: next separator (and skip it) '''
+        match = self.re_next.match(self._buf, self._pos)
+        if not match or match.end() == len(self._buf):
+            return self._expect(chars)
+        if match.group(1) not in chars:
+            raise ValueError(f'JSON: expected {chars!r}, '
+                             f'got {match.group(1)!r}')
+        self._pos = match.end()
+        return match.group(1)
+
+    def value(self) -> object:
+        ''' Decode next value (completely) '''
+        self._peek()
+        while True:
+            try:
+                value, end = self._scan(self._buf, self._pos)
+            except (json.JSONDecodeError, StopIteration) as e:
+                if self._fill():
+                    continue
+                raise ValueError(f'JSON: invalid value ({e!r})') from None
+            # a number at the end of the buffer may continue in next chunk
+            # (also if split right after '.', 'e' or '-')
+            if self._buf[self._pos] in '-0123456789':
+                tail = self.re_number_tail.match(self._buf, end).end()
+                if tail == len(self._buf) and self._fill():
+                    continue
+            self._pos = end
+            return value
+
+    def iterObject(self) -> 'Iterator[str]':
+        ''' Yield keys. Caller must consume each value before next key. '''
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f'JSON: expected key, got {key!r}')
+            self._expect(':')
+            yield key
+            if self._next(',}') == '}':
+                return
+
+    def iterArray(self) -> 'Iterator[object]':
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self._next(',]') == ']':
+                return
 
 
 ###############################################
-# [update] Re-index existing URL caches
+# [update] Compact file list cache
 ###############################################
+# data/url_cache/<base_url>.lst  normalized `(path_name, fsize, crc32)` of
+# all .ipa files in `<base_url>.json.gz`, sorted by path_name (utf-8).
+#   LIST_MAGIC, then per entry: u16 record length,
+#   record = path_name \0 u64 fsize, 8 bytes crc32 (hex, \0 if unknown)
+# NUL sorts first, thus sorting records == sorting by path_name.
 
-def updateUrl(url_or_uid: 'str|int', proc_i: int, proc_total: int):
-    baseUrlId, url = _lookupBaseUrl(url_or_uid)
-    if not baseUrlId or not url:
-        print(f'[ERROR] Ignoring "{url_or_uid}". Not found in DB', file=stderr)
-        return
+LIST_MAGIC = b'IPALIST\x01'
+LIST_LENGTH = struct.Struct('<H')
+LIST_ENTRY = struct.Struct('<Q8s')
 
-    archiveId = extractArchiveOrgId(url) or ''  # guaranteed to return str
-    print(f'Updating [{proc_i}/{proc_total}] {archiveId}')
 
-    old_json_file = pathToListJson(baseUrlId)
-    new_json_file = pathToListJson(baseUrlId, tmp=True)
-    old_entries = set(downloadListArchiveOrg(archiveId, old_json_file))
-    new_entries = set(downloadListArchiveOrg(archiveId, new_json_file))
-    old_diff = old_entries - new_entries
-    new_diff = new_entries - old_entries
+def pathToListCache(baseUrlId: int, *, tmp: bool = False) -> Path:
+    return pathToListJson(baseUrlId, tmp=tmp).with_suffix('').with_suffix(
+        '.lst')
+
+
+def writeListCache(entries: 'Iterable[tuple[str, int, str|None]]',
+                   dest: Path) -> int:
+    ''' Sort and store entries. :returns: number of entries '''
+    records = sorted(set(
+        name.encode() + b'\0' + LIST_ENTRY.pack(size, (crc or '').encode())
+        for name, size, crc in entries))
+    tmp = dest.with_name(dest.name + '.tmp')
+    with open(tmp, 'wb') as fp:
+        fp.write(LIST_MAGIC)
+        for record in records:
+            fp.write(LIST_LENGTH.pack(len(record)))
+            fp.write(record)
+    os.replace(tmp, dest)
+    return len(records)
+
+
+def readListCache(path: Path) -> 'Iterator[tuple[str, int, str|None]]':
+    ''' :returns: `(path_name, file_size, crc32)` sorted by path_name '''
+    with open(path, 'rb') as fp:
+        if fp.read(len(LIST_MAGIC)) != LIST_MAGIC:
+            raise ValueError(f'Not a file list cache: {path}')
+        while True:
+            head = fp.read(LIST_LENGTH.size)
+            if not head:
+                return
+            record = fp.read(LIST_LENGTH.unpack(head)[0])
+            end = len(record) - LIST_ENTRY.size
+            size, crc = LIST_ENTRY.unpack_from(record, end)
+            yield (record[:end - 1].decode(), size,
+                   crc.rstrip(b'\0').decode() or None)
+
+
+def ensureListCache(baseUrlId: int) -> Path:
+    ''' Create list cache from json (for file lists of older versions) '''
+    path = pathToListCache(baseUrlId)
+    if not path.exists():
+        writeListCache(readListArchiveOrg(pathToListJson(baseUrlId)), path)
+    return path
+
+
+def diffListCaches(
+    old: 'Iterable[tuple[str, int, str|None]]',
+    new: 'Iterable[tuple[str, int, str|None]]',
+) -> 'Iterator[tuple[tuple|None, tuple|None]]':
+    '''
+    Linear merge of two sorted file lists.
+    :returns: `(old, new)` pairs which differ (`None` if missing)
+    '''
+    oldIter, newIter = iter(old), iter(new)
+    a, b = next(oldIter, None), next(newIter, None)
+    while a or b:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a, None
+            a = next(oldIter, None)
+        elif a is None or b[0] < a[0]:
+            yield None, b
+            b = next(newIter, None)
+        else:
+            if a != b:
+                yield a, b
+            a, b = next(oldIter, None), next(newIter, None)
+
 
+###############################################
+# [update] Re-index existing URL caches
+###############################################
+
+class ListValidators(NamedTuple):
+    etag: 'str|None'
+    last_modified: 'str|None'
+    list_sha1: 'str|None'
+
+
+def updateUrls(queue: 'list[str|int]', *, workers: int = 8) -> None:
+    '''
+    Download file lists in parallel (conditional requests) and apply
+    changes one by one in the main thread.
+    '''
+    start = time.monotonic()
     DB = CacheDB()
-    if old_diff or new_diff:
-        c_del = 0
-        c_new = 0
-        for old_entry in old_diff:  # no need to sort
-            uid = DB.getId(baseUrlId, old_entry[0])
-            if uid:
-                print(f'  rm: [{uid}] {old_entry}')
-                DB.setPermanentError(uid)
-                c_del += 1
-            else:
-                print(f'  [ERROR] could not find old entry {old_entry[0]}',
+    counts = {'fetched': 0, 'not-modified': 0, 'changed': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for url_or_uid in queue:
+            baseUrlId, url = _lookupBaseUrl(url_or_uid)
+            if not baseUrlId or not url:
+                print(f'[ERROR] Ignoring "{url_or_uid}". Not found in DB',
                       file=stderr)
-        for new_entry in sorted(new_diff):
-            uid = DB.updateIpaUrl(baseUrlId, new_entry)
-            if uid:
-                print(f'  add: [{uid}] {new_entry}')
-                c_new += 1
+                continue
+            archiveId = extractArchiveOrgId(url) or ''  # guaranteed str
+            # without previous file list there is nothing to compare against
+            validators = DB.getListValidators(baseUrlId) \
+                if pathToListJson(baseUrlId).exists() else None
+            futures[pool.submit(
+                fetchListArchiveOrg, archiveId,
+                pathToListJson(baseUrlId, tmp=True), validators
+            )] = (baseUrlId, archiveId, validators)
+
+        for i, future in enumerate(as_completed(futures)):
+            baseUrlId, archiveId, validators = futures[future]
+            print(f'Updating [{i + 1}/{len(futures)}] {archiveId}')
+            try:
+                newValidators = future.result()
+            except Exception as e:
+                print(f'  [ERROR] {archiveId}: {e}', file=stderr)
+                counts['failed'] += 1
+                continue
+            if newValidators is None:
+                print('  not modified.')
+                counts['not-modified'] += 1
             else:
-                print(f'  [ERROR] updating {new_entry[0]}', file=stderr)
-        print(f'  updated -{c_del}/+{c_new} entries.')
+                counts['fetched'] += 1
+                if applyListUpdate(DB, baseUrlId, newValidators, validators):
+                    counts['changed'] += 1
+                DB.setListValidators(baseUrlId, newValidators)
+            DB.markBaseUrlUpdated(baseUrlId)
+
+    print(f'done. {len(futures)} urls in {time.monotonic() - start:.1f}s: '
+          + ', '.join(f'{v} {k}' for k, v in counts.items()))
+
+
+def applyListUpdate(
+    DB: CacheDB, baseUrlId: int,
+    newValidators: ListValidators, oldValidators: 'ListValidators|None'
+) -> bool:
+    ''' Diff new file list with previous one. :returns: `True` if changed '''
+    old_json_file = pathToListJson(baseUrlId)
+    new_json_file = pathToListJson(baseUrlId, tmp=True)
+    if not old_json_file.exists():
+        os.rename(new_json_file, old_json_file)
+        ensureListCache(baseUrlId)
+        print('  no previous file list.')
+        return False
+    if oldValidators and oldValidators.list_sha1 == newValidators.list_sha1:
+        os.remove(new_json_file)
+        print('  no changes.')
+        return False
+
+    old_list = ensureListCache(baseUrlId)
+    new_list = pathToListCache(baseUrlId, tmp=True)
+    writeListCache(readListArchiveOrg(new_json_file), new_list)
+    # new or same name but different size or checksum
+    changed = {}  # type: dict[str, tuple[str, int, str|None]]
+    for _, new in diffListCaches(readListCache(old_list),
+                                 readListCache(new_list)):
+        if new:
+            changed[new[0]] = new
+
+    removed, added = DB.reconcileIpaUrls(
+        baseUrlId, readListCache(new_list), set(changed))
+    deleteCacheFiles(pk for pk, _ in removed)
+    isChanged = bool(removed or added)
+    if isChanged:
+        for uid, path in removed:
+            print(f'  rm: [{uid}] {path}')
+        for uid, path in added:
+            print(f'  add: [{uid}] {changed.get(path, path)}')
+        print(f'  updated -{len(removed)}/+{len(added)} entries.')
         os.rename(new_json_file, old_json_file)
+        os.rename(new_list, old_list)
     else:
         print('  no changes.')
 
-    DB.markBaseUrlUpdated(baseUrlId)
-    if new_json_file.exists():
-        os.remove(new_json_file)
+    for tmp in (new_json_file, new_list):
+        if tmp.exists():
+            os.remove(tmp)
+    return isChanged
 
 
 def _lookupBaseUrl(url_or_index: 'str|int') -> 'tuple[int|None, str|None]':
@@ -478,157 +1422,1833 @@ def _lookupBaseUrl(url_or_index: 'str|int') -> 'tuple[int|None, str|None]':
 
 
 ###############################################
-# [run] Process pending urls from DB
+# [run] Scheduler: per-host rate limit & retries
 ###############################################
+RETRY_STATUS = {429: 'throttled', 503: 'throttled',
+                500: 'transient', 502: 'transient', 504: 'transient'}
+RATE_MIN = 0.1  # ipa files per second and host
+RATE_INCREASE = 1.0  # per second (i.e., `rate` successful responses)
+THROTTLE_WINDOW = 2.0  # slow down at most once per window (in seconds)
+# network problems only. Local errors (disk full, permissions) are reported
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, socket.timeout,
+                    socket.gaierror, HTTPException, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError)
 
-def processPending():
-    processed = 0
-    with Pool(processes=8) as pool:
-        while True:
-            DB = CacheDB()
-            pending = DB.count(done=0)
-            batch = DB.getPendingQueue(done=0, batchsize=100)
-            del DB
-            if not batch:
-                print('Queue empty. done.')
-                break
 
-            batch = [(processed + i + 1, pending - i - 1, *x)
-                     for i, x in enumerate(batch)]
-
-            result = pool.starmap_async(procSinglePending, batch).get()
-            processed += len(result)
-            DB = CacheDB()
-            for uid, success in result:
-                fsize = onceReadSizeFromFile(uid)
-                if fsize:
-                    DB.setFilesize(uid, fsize)
-                if success:
-                    DB.setDone(uid)
-                else:
-                    DB.setError(uid, done=3)
-            del DB
-    DB = CacheDB()
-    err_count = DB.count(done=3)
-    if err_count > 0:
-        print()
-        print('URLs with Error:', err_count)
-        for uid, base, path_name in DB.getPendingQueue(done=3, batchsize=10):
-            print(f' - [{uid}] {base}/{quote(path_name)}')
+class RetryPolicy(NamedTuple):
+    maxAttempts: int = 5
+    delay: float = 60  # before first retry, doubles with each attempt
+    maxDelay: float = 3600
+    maxWait: float = 120  # `run` exits if nothing else is due within
 
 
-def procSinglePending(
-    processed: int, pending: int, uid: int, base_url: str, path_name
-) -> 'tuple[int, bool]':
-    url = base_url + '/' + quote(path_name)
-    humanUrl = url.split('archive.org/download/')[-1]
-    print(f'[{processed}|{pending} queued]: load[{uid}] {humanUrl}')
+class LoadResult(NamedTuple):
+    uid: int
+    info: 'IpaInfo|None'
+    metrics: dict  # see `Metrics.pop()`
+    failure: 'str|None' = None  # 'throttled', 'transient' or 'broken'
+    retryAfter: float = 0
+
+
+def classifyError(e: BaseException) -> 'tuple[str, float]':
+    '''
+    Transient errors (throttling, connection problems) are retried later,
+    broken ones (bad zip, missing file, local I/O errors, etc.) are not.
+    :returns: `(failure, retry_after)`
+    '''
+    if isinstance(e, HTTPError):
+        headers = e.headers or {}
+        return RETRY_STATUS.get(e.code, 'broken'), parseRetryAfter(
+            headers.get('retry-after') or headers.get('Retry-After'))
+    if isinstance(e, URLError) and isinstance(e.reason, BaseException):
+        e = e.reason  # e.g., connection refused, DNS lookup failed
+    if isinstance(e, TRANSIENT_ERRORS):
+        return 'transient', 0
+    return 'broken', 0
+
+
+def parseRetryAfter(value: 'str|None') -> float:
+    ''' Seconds or HTTP-date. :returns: delay in seconds (or 0) '''
+    if not value:
+        return 0
     try:
-        return uid, loadIpa(uid, url)
-    except Exception as e:
-        print(f'ERROR: [{uid}] {e}', file=stderr)
-    return uid, False
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
 
 
-def onceReadSizeFromFile(uid: int) -> 'int|None':
-    size_path = diskPath(uid, '.size')
-    if size_path.exists():
-        with open(size_path, 'r') as fp:
-            size = int(fp.read())
-        os.remove(size_path)
-        return size
-    return None
+class HostLimiter:
+    '''
+    Token bucket (ipa files per second) for a single host. The rate is
+    halved on throttling and increases linearly with each success (AIMD).
+    '''
 
+    def __init__(self, maxRate: float, burst: int) -> None:
+        self.maxRate = maxRate
+        self.rate = maxRate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.blockedUntil = 0.0
+        self._updated = time.monotonic()
+        self._lastDecrease = 0.0
 
-###############################################
-# Process IPA zip
-###############################################
+    def wait(self) -> float:
+        ''' :returns: seconds until a token is available '''
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return max(0, self.blockedUntil - now, (1 - self.tokens) / self.rate)
 
-def loadIpa(uid: int, url: str, *,
-            overwrite: bool = False, image_only: bool = False) -> bool:
-    basename = diskPath(uid, '')
-    basename.parent.mkdir(exist_ok=True)
-    img_path = basename.with_suffix('.png')
-    plist_path = basename.with_suffix('.plist')
-    if not overwrite and plist_path.exists():
+    def take(self) -> bool:
+        if self.wait() > 0:
+            return False
+        self.tokens -= 1
         return True
 
-    with RemoteZip(url) as zip:
-        if USE_ZIP_FILESIZE:
-            filesize = zip.fp.tell() if zip.fp else 0
-            with open(basename.with_suffix('.size'), 'w') as fp:
-                fp.write(str(filesize))
-
-        app_name = None
-        artwork = False
-        zip_listing = zip.infolist()
-        has_payload_folder = False
-
-        for entry in zip_listing:
-            fn = entry.filename.lstrip('/')
-            has_payload_folder |= fn.startswith('Payload/')
-            plist_match = re_info_plist.match(fn)
-            if fn == 'iTunesArtwork':
-                extractZipEntry(zip, entry, img_path)
-                artwork = os.path.getsize(img_path) > 0
-            elif plist_match:
-                app_name = plist_match.group(1)
-                if not image_only:
-                    extractZipEntry(zip, entry, plist_path)
-
-        if not has_payload_folder:
-            print(f'ERROR: [{uid}] ipa has no "Payload/" root folder',
-                  file=stderr)
+    def success(self) -> None:
+        self.rate = min(self.maxRate, self.rate + RATE_INCREASE / self.rate)
 
-        # if no iTunesArtwork found, load file referenced in plist
-        if not artwork and app_name and plist_path.exists():
-            with open(plist_path, 'rb') as fp:
-                icon_names = iconNameFromPlist(plistlib.load(fp))
-                icon = expandImageName(zip_listing, app_name, icon_names)
-                if icon:
-                    extractZipEntry(zip, icon, img_path)
+    def throttled(self, retryAfter: float = 0) -> None:
+        now = time.monotonic()
+        # in-flight requests fail together, count them as one signal
+        if now - self._lastDecrease >= THROTTLE_WINDOW:
+            self._lastDecrease = now
+            self.rate = max(RATE_MIN, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+        self.blockedUntil = max(self.blockedUntil, now + retryAfter)
 
-    return plist_path.exists()
 
+class PendingScheduler:
+    '''
+    Hands out claimed rows (see `LeaseQueue`) in pk order, including due
+    retries. A row is only handed out if the token bucket of its host
+    allows. Transient failures are rescheduled by the queue.
+    '''
 
-def extractZipEntry(zip: 'RemoteZip', zipInfo: 'ZipInfo', dest_filename: Path):
-    with zip.open(zipInfo) as src:
-        with open(dest_filename, 'wb') as tgt:
-            tgt.write(src.read())
+    def __init__(self, source: 'LeaseQueue|CoordinatorClient', *,
+                 maxRate: float, burst: int) -> None:
+        self.source = source
+        self.maxRate = maxRate
+        self.burst = burst
+        self.hosts = {}  # type: dict[str, HostLimiter]
+        self.inFlight = {}  # type: dict[int, str]  # uid: host
+        self.retries = 0
+        self._held = []  # type: list[tuple[int, str, str, int]]
+        self._total = source.pending()
+        self._seen = set()  # type: set[int]
 
+    def progress(self, uid: int) -> 'tuple[int, int]':
+        '''
+        Count distinct rows, retries are not counted again.
+        :returns: `(processed, queued)` for log output
+        '''
+        self._seen.add(uid)
+        if len(self._seen) > self._total:  # rows added since start
+            self._total = len(self._seen) + self.source.pending()
+        return len(self._seen), self._total - len(self._seen)
 
-###############################################
-# Icon name extraction
-###############################################
-RESOLUTION_ORDER = ['3x', '2x', '180', '167', '152', '120']
+    def _limiter(self, baseUrl: str) -> 'tuple[str, HostLimiter]':
+        host = urlsplit(baseUrl).netloc
+        limiter = self.hosts.get(host)
+        if not limiter:
+            limiter = self.hosts[host] = HostLimiter(self.maxRate, self.burst)
+        return host, limiter
 
+    def take(self, count: int) -> 'list[tuple[int, str, str, int]]':
+        ''' :returns: up to `count` rows which may be processed now '''
+        self.source.renewIfDue()
+        if count <= 0:
+            return []
+        if len(self._held) < count:
+            self._held += self.source.claim(count - len(self._held))
+        rv = []
+        held = []
+        for row in self._held:
+            host, limiter = self._limiter(row[1])
+            if len(rv) < count and limiter.take():
+                self.inFlight[row[0]] = host
+                rv.append(row)
+            else:
+                held.append(row)
+        self._held = held
+        return rv
 
-def expandImageName(
-    zip_listing: 'list[ZipInfo]', appName: str, iconList: 'list[str]'
-) -> 'ZipInfo|None':
-    for iconName in iconList + ['Icon', 'icon']:
-        zipPath = f'Payload/{appName}/{iconName}'
-        matchingNames = [x.filename.split('/', 2)[-1] for x in zip_listing
-                         if x.filename.lstrip('/').startswith(zipPath)]
-        if len(matchingNames) > 0:
-            for bestName in sortedByResolution(matchingNames):
-                bestPath = f'Payload/{appName}/{bestName}'
-                for x in zip_listing:
-                    if x.filename.lstrip('/') == bestPath and x.file_size > 0:
-                        return x
-    return None
+    def finish(self, result: LoadResult) -> str:
+        '''
+        Update host rate and store result (or schedule retry).
+        :returns: `'done'`, `'error'`, `'retry'` or `'lost'` (lease expired)
+        '''
+        limiter = self.hosts[self.inFlight.pop(result.uid)]
+        if result.failure in ('throttled', 'transient'):
+            limiter.throttled(result.retryAfter)
+        else:
+            limiter.success()
+        status = self.source.finish(result)
+        self.retries += status == 'retry'
+        return status
 
+    def waitTime(self) -> 'float|None':
+        '''
+        :returns: seconds until `take()` may return rows again or `None`
+            if nothing is left (ignoring rows in flight).
+        '''
+        waits = [self._limiter(row[1])[1].wait() for row in self._held]
+        due = self.source.nextRetryDue()
+        if due is not None:
+            waits.append(max(0, due - time.time()))
+        return min(waits) if waits else None
 
-def unpackNameListFromPlistDict(bundleDict: 'dict|None') -> 'list[str]|None':
-    if not bundleDict:
-        return None
-    primaryDict = bundleDict.get('CFBundlePrimaryIcon', {})
-    icons = primaryDict.get('CFBundleIconFiles')
-    if not icons:
-        singular = primaryDict.get('CFBundleIconName')
-        if singular:
-            return [singular]
-    return icons
+    def summary(self) -> str:
+        return f'{self.retries} retries scheduled. Rate per host: ' \
+            + ', '.join(f'{host} {x.rate:.1f}/s'
+                        for host, x in self.hosts.items())
+
+
+def applyLoadResult(DB: 'CacheDB', result: LoadResult,
+                    retry: RetryPolicy) -> str:
+    '''
+    Store result. Transient failures are rescheduled (exponential backoff)
+    until `retry.maxAttempts` is reached.
+    :returns: `'done'`, `'error'` or `'retry'`
+    '''
+    if result.failure in ('throttled', 'transient'):
+        attempts = DB.getAttempts(result.uid)
+        if attempts < retry.maxAttempts:
+            delay = min(retry.maxDelay, retry.delay * 2 ** attempts)
+            delay = max(result.retryAfter, delay * random.uniform(.8, 1.2))
+            DB.scheduleRetry(result.uid, delay)
+            print(f'[{result.uid}] {result.failure}, retry '
+                  f'{attempts + 1}/{retry.maxAttempts} in {delay:.0f}s')
+            return 'retry'
+    applyPendingResult(DB, result.uid, result.info)
+    return 'done' if result.info else 'error'
+
+
+###############################################
+# [run] Work queue: leases for parallel workers
+###############################################
+# Rows are claimed by setting done=2 with `lease_owner` and `lease_until`.
+# Several `run`s (same machine via DB, or remote via `coordinator`) can
+# drain the queue in parallel. Leases are renewed while working, expired
+# leases (e.g., crashed worker) are requeued by the next claim. Leases of
+# dead processes on the same machine are requeued when `run` starts.
+
+LEASE_SECONDS = 600
+
+
+def workerId() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def isDeadLocalWorker(owner: str) -> bool:
+    ''' :returns: `True` if `owner` is a process on this machine, not alive '''
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:  # exists, other user
+        pass
+    return False
+
+
+class LeaseQueue:
+    ''' Claim pending rows from the local DB. '''
+
+    def __init__(self, DB: 'CacheDB', *, retry: RetryPolicy = RetryPolicy(),
+                 lease: float = LEASE_SECONDS, owner: 'str|None' = None) \
+            -> None:
+        self.DB = DB
+        self.retry = retry
+        self.lease = lease
+        self.owner = owner or workerId()
+        if not DB.metrics:
+            DB.metrics = Metrics()
+        self.metrics = DB.metrics
+        self.duplicates = 0
+        self._renewed = time.monotonic()
+
+    def pending(self) -> int:
+        return self.DB.count(done=0)
+
+    def requeueDead(self) -> None:
+        ''' Requeue leases of crashed workers on this machine '''
+        for owner, _, _ in self.DB.leaseOwners():
+            if owner != self.owner and isDeadLocalWorker(owner):
+                count = self.DB.releaseLeases(owner)
+                print(f'Requeued {count} rows of dead worker {owner}')
+
+    def claim(self, count: int) -> 'list[tuple[int, str, str, int]]':
+        '''
+        Claim up to `count` rows. Duplicates (same crc32 and size) are
+        copied right away and not returned.
+        '''
+        rv = []  # type: list[tuple[int, str, str, int]]
+        while len(rv) < count:
+            batch = self.DB.claimPending(
+                self.owner, limit=count - len(rv), lease=self.lease)
+            if not batch:
+                break
+            for row in batch:
+                with self.metrics.timed('dedupe'):
+                    isDuplicate = copyDuplicate(self.DB, row[0])
+                if isDuplicate:
+                    self.duplicates += 1
+                    self.metrics.count('duplicate')
+                else:
+                    rv.append(row)
+        self._renewed = time.monotonic()
+        return rv
+
+    def renewIfDue(self) -> None:
+        if time.monotonic() - self._renewed > self.lease / 3:
+            self.DB.renewLeases(self.owner, lease=self.lease)
+            self._renewed = time.monotonic()
+
+    def finish(self, result: LoadResult) -> str:
+        # lease expired and row was claimed again (or reset) meanwhile
+        if not self.DB.holdsLease(result.uid, self.owner):
+            print(f'[{result.uid}] lease lost, result of {self.owner} ignored')
+            return 'lost'
+        return applyLoadResult(self.DB, result, self.retry)
+
+    def nextRetryDue(self) -> 'int|None':
+        ''' :returns: unix time of next retry or expiry of a foreign lease '''
+        due = self.DB.nextRetryDue()
+        expiry = self.DB.nextLeaseExpiry(exceptOwner=self.owner)
+        if expiry is not None:  # requeued if lease_until < now
+            due = min(due or expiry + 1, expiry + 1)
+        return due
+
+    def release(self) -> None:
+        ''' Requeue all rows claimed by this worker (on exit) '''
+        self.DB.releaseLeases(self.owner)
+
+    def batch(self) -> 'ContextManager':
+        return self.DB.batchedWrites()
+
+    def flush(self) -> None:
+        self.DB.commitIfDue()
+
+    def summary(self) -> str:
+        return f'{self.DB.commitStats()}\n{self.duplicates} remote fetches ' \
+            'avoided (same crc32 and size)'
+
+
+class CoordinatorClient:
+    '''
+    Same interface as `LeaseQueue` but for a remote `coordinator`.
+    Plist and image files are loaded into the local blob storage first and
+    moved to the coordinator with the result.
+    '''
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip('/')
+        self.owner = workerId()
+        self.lease = LEASE_SECONDS
+        self.metrics = Metrics()
+        self.duplicates = 0
+        self._nextRetry = None  # type: int|None
+        self._renewed = time.monotonic()
+
+    def _request(self, action: str, **params) -> dict:
+        data = json.dumps(dict(params, worker=self.owner)).encode()
+        req = Request(f'{self.url}/{action}', data,
+                      {'Content-Type': 'application/json'})
+        with urlopen(req, timeout=60) as page:
+            return json.load(page)
+
+    def pending(self) -> int:
+        return self._request('status')['pending']
+
+    def requeueDead(self) -> None:
+        pass  # remote leases expire on the coordinator
+
+    def claim(self, count: int) -> 'list[tuple[int, str, str, int]]':
+        data = self._request('claim', count=count)
+        self.lease = data['lease']
+        self.duplicates += data['duplicates']
+        self._nextRetry = data['next_retry']
+        self._renewed = time.monotonic()
+        return [tuple(row) for row in data['rows']]  # type: ignore
+
+    def renewIfDue(self) -> None:
+        if time.monotonic() - self._renewed > self.lease / 3:
+            self._request('renew')
+            self._renewed = time.monotonic()
+
+    def finish(self, result: LoadResult) -> str:
+        store = blobStore()
+        blobs = {}
+        for ext in BLOB_EXTENSIONS:
+            data = store.read(result.uid, ext)
+            if data is not None:
+                blobs[ext] = b64encode(data).decode()
+        status = self._request(
+            'result', uid=result.uid, info=result.info,
+            failure=result.failure, retryAfter=result.retryAfter,
+            blobs=blobs)['status']
+        for ext in blobs:
+            store.delete(result.uid, ext)
+        return status
+
+    def nextRetryDue(self) -> 'int|None':
+        return self._nextRetry
+
+    def release(self) -> None:
+        try:
+            self._request('release')
+        except OSError:  # coordinator gone, leases expire anyway
+            pass
+
+    def batch(self) -> 'ContextManager':
+        return nullcontext()
+
+    def flush(self) -> None:
+        pass
+
+    def summary(self) -> str:
+        return f'{self.duplicates} duplicates copied by coordinator'
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    '''
+    JSON API for remote workers (`run -coordinator URL`). POST with
+    `{"worker": ID, ...}` to `/claim` (`count`), `/renew`, `/release` and
+    `/result` (`uid`, `info`, `failure`, `retryAfter`, `blobs`).
+    GET `/status` returns the number of rows per done state.
+    '''
+    DB = None  # type: CacheDB|None
+    retry = RetryPolicy()
+    lease = LEASE_SECONDS
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendJson(self, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        DB = self.DB
+        assert DB
+        if self.path != '/status':
+            return self.send_error(404)
+        self.sendJson({'pending': DB.count(done=0), 'done': {
+            str(k): v for k, v in DB.countByDone().items()}})
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        try:
+            params = json.loads(self.rfile.read(size) or b'{}')
+            worker = str(params['worker'])
+        except (ValueError, KeyError):
+            return self.send_error(400)
+        assert self.DB
+        queue = LeaseQueue(self.DB, retry=self.retry, lease=self.lease,
+                           owner=worker)
+        action = self.path.strip('/')
+        if action == 'status':
+            return self.do_GET()
+        elif action == 'claim':
+            rows = queue.claim(int(params.get('count', 1)))
+            print(f'{worker}: claimed {len(rows)} rows')
+            self.sendJson({'rows': rows, 'duplicates': queue.duplicates,
+                           'lease': self.lease,
+                           'next_retry': queue.nextRetryDue()})
+        elif action == 'renew':
+            self.DB.renewLeases(worker, lease=self.lease)
+            self.sendJson({})
+        elif action == 'release':
+            queue.release()
+            self.sendJson({})
+        elif action == 'result':
+            uid = int(params['uid'])
+            if not self.DB.holdsLease(uid, worker):
+                print(f'{worker}: [{uid}] lease lost, result ignored')
+                return self.sendJson({'status': 'lost'})
+            store = blobStore()
+            for ext, data in (params.get('blobs') or {}).items():
+                if ext in BLOB_EXTENSIONS:
+                    store.write(uid, ext, b64decode(data))
+            info = params.get('info')
+            status = queue.finish(LoadResult(
+                uid, IpaInfo(*info) if info else None, {},
+                params.get('failure'), params.get('retryAfter') or 0))
+            print(f'{worker}: [{uid}] {status}')
+            self.sendJson({'status': status})
+        else:
+            self.send_error(404)
+
+
+def serveCoordinator(host: str, port: int, *, retry: RetryPolicy,
+                     lease: float) -> None:
+    ''' Single-threaded, all DB writes happen in this process '''
+    DB = CacheDB()
+    CoordinatorHandler.DB = DB
+    CoordinatorHandler.retry = retry
+    CoordinatorHandler.lease = lease
+    server = HTTPServer((host, port), CoordinatorHandler)
+    # called between requests (every 0.5s)
+    server.service_actions = DB.commitIfDue  # type: ignore
+    print(f'Coordinator running on http://{host}:{port}')
+    with DB.batchedWrites():
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    server.server_close()
+
+
+###############################################
+# [run] Process pending urls from DB
+###############################################
+
+def processPending(processes: int = 8, *, maxRate: float = 50,
+                   retry: RetryPolicy = RetryPolicy(),
+                   coordinator: 'str|None' = None):
+    source = CoordinatorClient(coordinator) if coordinator else \
+        LeaseQueue(CacheDB(), retry=retry)
+    source.requeueDead()
+    queue = PendingScheduler(source, maxRate=maxRate, burst=processes * 2)
+    results = Queue()  # type: Queue[LoadResult]
+    metrics = source.metrics
+    try:
+        with Pool(processes=processes) as pool, source.batch():
+            while True:
+                # keep queue topped up. Claimed rows are done=2
+                batch = queue.take(processes * 2 - len(queue.inFlight))
+                for row in batch:
+                    failed = LoadResult(row[0], None, Metrics().pop(),
+                                        'broken')
+                    pool.apply_async(
+                        procSinglePending,
+                        (*queue.progress(row[0]), *row),
+                        callback=results.put,
+                        error_callback=lambda _, x=failed: results.put(x))
+                if not queue.inFlight:
+                    wait = queue.waitTime()
+                    if wait is None:
+                        print('Queue empty. done.')
+                        break
+                    if wait > retry.maxWait:
+                        print(f'Nothing due within {retry.maxWait:.0f}s'
+                              f' (next in {wait:.0f}s). done.')
+                        break
+                    if wait >= 1:
+                        print(f'Waiting {wait:.0f}s for retries / rate limit')
+                    source.flush()
+                    metrics.saveIfDue()
+                    time.sleep(min(wait, 60))
+                    continue
+                # single writer, results are applied in order of completion
+                try:
+                    result = results.get(
+                        timeout=min(queue.waitTime() or 1, 1))
+                except Empty:
+                    source.flush()
+                    metrics.saveIfDue()
+                    continue
+                metrics.merge(result.metrics)
+                with metrics.timed('db_apply'):
+                    metrics.count(queue.finish(result))
+                metrics.saveIfDue()
+    finally:
+        source.release()
+        metrics.save()
+    print(source.summary())
+    print(queue.summary())
+    del source
+    if not coordinator:
+        printErrorSummary()
+
+
+def applyPendingResult(DB: 'CacheDB', uid: int, info: 'IpaInfo|None') \
+        -> None:
+    if not info:
+        DB.setError(uid, done=3)
+        return
+    if info.filesize:
+        DB.setFilesize(uid, info.filesize)
+    DB.setDone(uid, info)
+
+
+def copyDuplicate(DB: 'CacheDB', uid: int) -> bool:
+    '''
+    If an identical ipa (crc32 + size) was processed already, copy its
+    plist, image and metadata instead of loading it again.
+    '''
+    srcUid = DB.findDoneDuplicate(uid)
+    store = blobStore()
+    if not srcUid or not store.exists(srcUid, '.plist'):
+        return False
+    store.copy(srcUid, uid)
+    DB.copyMetadata(uid, srcUid)
+    print(f'[{uid}] duplicate of [{srcUid}], copied')
+    return True
+
+
+def printErrorSummary() -> None:
+    DB = CacheDB()
+    retry_count = DB.countRetries()
+    if retry_count > 0:
+        print(f'{retry_count} URLs are queued for retry (run again later)')
+    claimed = DB.count(done=2)
+    if claimed > 0:
+        print(f'{claimed} URLs are claimed by other workers (see `stats`)')
+    err_count = DB.count(done=3)
+    if err_count > 0:
+        print()
+        print('URLs with Error:', err_count)
+        for uid, base, path_name, _ in DB.getPendingQueue(
+                done=3, batchsize=10):
+            print(f' - [{uid}] {base}/{quote(path_name)}')
+
+
+def procSinglePending(
+    processed: int, pending: int,
+    uid: int, base_url: str, path_name: str, fsize: int
+) -> LoadResult:
+    url = base_url + '/' + quote(path_name)
+    humanUrl = url.split('/download/', 1)[-1]
+    print(f'[{processed}|{pending} queued]: load[{uid}] {humanUrl}')
+    metrics = Metrics()
+    start = time.perf_counter()
+    info, failure, retryAfter = None, None, 0.0
+    try:
+        info = loadIpa(uid, url, fsize=fsize, metrics=metrics)
+    except Exception as e:
+        print(f'ERROR: [{uid}] {e}', file=stderr)
+        failure, retryAfter = classifyError(e)
+    metrics.item(base_url, time.perf_counter() - start, error=info is None)
+    return LoadResult(uid, info, metrics.pop(),
+                      failure or (None if info else 'broken'), retryAfter)
+
+
+def onceReadSizeFromFile(uid: int) -> 'int|None':
+    size_path = diskPath(uid, '.size')
+    if size_path.exists():
+        with open(size_path, 'r') as fp:
+            size = int(fp.read())
+        os.remove(size_path)
+        return size
+    return None
+
+
+###############################################
+# [run] Async engine with pooled HTTP connections
+###############################################
+
+def processPendingAsync(*, concurrency: int, perHost: int,
+                        maxRate: float = 50,
+                        retry: RetryPolicy = RetryPolicy(),
+                        coordinator: 'str|None' = None) -> None:
+    source = CoordinatorClient(coordinator) if coordinator else \
+        LeaseQueue(CacheDB(), retry=retry)
+    asyncio.run(_processPendingAsync(source, concurrency, perHost, maxRate,
+                                     retry.maxWait))
+    del source
+    if not coordinator:
+        printErrorSummary()
+
+
+async def _processPendingAsync(
+    source: 'LeaseQueue|CoordinatorClient', concurrency: int, perHost: int,
+    maxRate: float, maxWait: float
+) -> None:
+    http = AsyncHttpPool(limit=concurrency, perHost=perHost)
+    source.requeueDead()
+    queue = PendingScheduler(source, maxRate=maxRate, burst=concurrency * 2)
+    running = set()  # type: set[asyncio.Task]
+    metrics = source.metrics
+    try:
+        with source.batch():
+            while True:
+                # keep queue topped up. Claimed rows are done=2
+                batch = queue.take(concurrency * 2 - len(queue.inFlight))
+                for row in batch:
+                    running.add(asyncio.ensure_future(
+                        _asyncProcSinglePending(
+                            http, *queue.progress(row[0]), *row)))
+                if not running:
+                    wait = queue.waitTime()
+                    if wait is None:
+                        print('Queue empty. done.')
+                        break
+                    if wait > maxWait:
+                        print(f'Nothing due within {maxWait:.0f}s'
+                              f' (next in {wait:.0f}s). done.')
+                        break
+                    if wait >= 1:
+                        print(f'Waiting {wait:.0f}s for retries / rate limit')
+                    source.flush()
+                    metrics.saveIfDue()
+                    await asyncio.sleep(min(wait, 60))
+                    continue
+                finished, running = await asyncio.wait(
+                    running, timeout=min(queue.waitTime() or 1, 1),
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    result = task.result()
+                    metrics.merge(result.metrics)
+                    with metrics.timed('db_apply'):
+                        metrics.count(queue.finish(result))
+                source.flush()
+                metrics.saveIfDue()
+    finally:
+        source.release()
+        await http.close()
+        metrics.save()
+    print(source.summary())
+    print(queue.summary())
+
+
+async def _asyncProcSinglePending(
+    http: 'AsyncHttpPool', processed: int, pending: int,
+    uid: int, base_url: str, path_name: str, fsize: int
+) -> LoadResult:
+    url = base_url + '/' + quote(path_name)
+    humanUrl = url.split('/download/', 1)[-1]
+    print(f'[{processed}|{pending} queued]: load[{uid}] {humanUrl}')
+    metrics = Metrics()
+    start = time.perf_counter()
+    info, failure, retryAfter = None, None, 0.0
+    try:
+        info = await asyncLoadIpa(http, uid, url, fsize=fsize,
+                                  metrics=metrics)
+    except Exception as e:
+        print(f'ERROR: [{uid}] {e}', file=stderr)
+        failure, retryAfter = classifyError(e)
+    metrics.item(base_url, time.perf_counter() - start, error=info is None)
+    return LoadResult(uid, info, metrics.pop(),
+                      failure or (None if info else 'broken'), retryAfter)
+
+
+async def asyncLoadIpa(http: 'AsyncHttpPool', uid: int, url: str, *,
+                       overwrite: bool = False, image_only: bool = False,
+                       fsize: int = 0, metrics: 'Metrics|None' = None) \
+        -> 'IpaInfo|None':
+    ''' Same as `loadIpa()` but using the asyncio connection pool. '''
+    if not overwrite and blobStore().exists(uid, '.plist'):
+        return localIpaInfo(uid)
+    steps = ipaSteps(uid, image_only=image_only, fsize=fsize, metrics=metrics)
+    try:
+        ranges = next(steps)
+        while True:
+            url, chunks = await http.fetchRanges(url, ranges, metrics=metrics)
+            ranges = steps.send(chunks)
+    except StopIteration as ret:
+        return ret.value
+
+
+class AsyncHttpPool:
+    '''
+    Minimal HTTP/1.1 client with keep-alive connections. Open connections are
+    limited globally (`limit`) and per hostname (`perHost`).
+    '''
+
+    def __init__(self, *, limit: int, perHost: int, timeout: float = 60):
+        self._limit = asyncio.Semaphore(limit)
+        self._perHost = perHost
+        self._hostLimit = {}  # type: dict[str, asyncio.Semaphore]
+        self._idle = {}  # type: dict[tuple[str, str, int], list[tuple]]
+        self._noMultiRange = set()  # type: set[str]
+        self._ssl = ssl.create_default_context()
+        self._timeout = timeout
+
+    async def close(self) -> None:
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+    async def fetchRanges(self, url: str, ranges: 'list[tuple[int, int]]',
+                          *, metrics: 'Metrics|None' = None) \
+            -> 'tuple[str, list[tuple[int, bytes]]]':
+        ''' Async version of `fetchRanges()` '''
+        host = urlsplit(url).netloc
+        if len(ranges) > 1 and host in self._noMultiRange:
+            chunks = []
+            for rng in ranges:
+                url, chunk = await self.fetchRanges(url, [rng],
+                                                    metrics=metrics)
+                chunks += chunk
+            return url, chunks
+        for _ in range(5):  # max redirects
+            try:
+                status, headers, body = await self.request(
+                    url, {'Range': makeRangeHeader(ranges)},
+                    limit=rangeResponseLimit(ranges), metrics=metrics)
+            except ResponseTooLarge:
+                if len(ranges) == 1:
+                    raise
+                self._noMultiRange.add(host)  # server ignored multi-range
+                return await self.fetchRanges(url, ranges, metrics=metrics)
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                host = urlsplit(url).netloc
+                continue
+            if status in (200, 206):
+                return url, splitRangeResponse(status, headers, body, ranges)
+            raise HTTPError(url, status, responses.get(status, ''), headers,
+                            None)
+        raise HTTPError(url, status, 'Too many redirects', headers, None)
+
+    async def request(self, url: str, headers: 'dict[str, str]', *,
+                      limit: int, metrics: 'Metrics|None' = None) \
+            -> 'tuple[int, dict[str, str], bytes]':
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        host = parts.hostname or ''
+        key = (parts.scheme, host, parts.port or (443 if secure else 80))
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        head = f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n' \
+            'Accept-Encoding: identity\r\n' + ''.join(
+                f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+
+        hostLimit = self._hostLimit.get(host)
+        if not hostLimit:
+            hostLimit = asyncio.Semaphore(self._perHost)
+            self._hostLimit[host] = hostLimit
+        async with self._limit, hostLimit:
+            while True:
+                reader, writer, reused = await self._acquire(key, metrics)
+                try:
+                    status, rheaders, body, keepAlive = await asyncio.wait_for(
+                        self._roundtrip(reader, writer, head.encode(), limit),
+                        self._timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue  # server closed idle keep-alive connection
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keepAlive:
+                    self._idle.setdefault(key, []).append((reader, writer))
+                else:
+                    writer.close()
+                return status, rheaders, body
+
+    async def _acquire(self, key: 'tuple[str, str, int]',
+                       metrics: 'Metrics|None' = None) -> tuple:
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=self._ssl if scheme == 'https' else None),
+            self._timeout)
+        if metrics:
+            metrics.observe('connect', time.perf_counter() - start)
+        return reader, writer, False
+
+    @staticmethod
+    async def _roundtrip(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+        head: bytes, limit: int
+    ) -> 'tuple[int, dict[str, str], bytes, bool]':
+        writer.write(head)
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('connection closed by server')
+        version, status = line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        keepAlive = headers.get('connection', '').lower() != 'close' \
+            and version == 'HTTP/1.1'
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass  # ignore trailers
+                    break
+                if len(body) + size > limit:
+                    raise ResponseTooLarge(f'response exceeds {limit} bytes')
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif 'content-length' in headers:
+            size = int(headers['content-length'])
+            if size > limit:
+                raise ResponseTooLarge(f'response exceeds {limit} bytes')
+            body = await reader.readexactly(size)
+        elif status in ('204', '304'):
+            body = b''
+        else:
+            body = bytearray()
+            while True:  # read until connection is closed
+                chunk = await reader.read(1 << 16)
+                if not chunk:
+                    break
+                body += chunk
+                if len(body) > limit:
+                    raise ResponseTooLarge(f'response exceeds {limit} bytes')
+            keepAlive = False
+        return int(status), headers, bytes(body), keepAlive
+
+
+###############################################
+# [stats] Per-stage metrics
+###############################################
+# Written during `run` every METRICS_INTERVAL seconds:
+#   data/metrics.json  (read by `stats`)
+#   data/metrics.prom  (Prometheus text format, e.g., node_exporter textfile)
+# Stages: connect, tail, central_dir, entries (network, incl. waiting),
+#   parse_cd, extract, plist, store (worker), item (total per ipa),
+#   dedupe, db_apply, db_commit (main process)
+METRICS_INTERVAL = 10
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)  # upper bounds in seconds
+
+
+class Metrics:
+    '''
+    Timing histograms and byte counters per stage, plus per host and
+    collection totals. Workers send `pop()` results to be `merge()`d.
+    '''
+
+    def __init__(self) -> None:
+        # stage: [bucket counts (+Inf last), sum of seconds, bytes]
+        self.stages = {}  # type: dict[str, list]
+        # 'host'|'collection': key: [items, errors, seconds, bytes]
+        self.groups = {'host': {}, 'collection': {}}  # type: dict[str, dict]
+        self.counts = {}  # type: dict[str, int]
+        self.started = time.time()
+        self._lastSave = time.monotonic()
+
+    def observe(self, stage: str, seconds: float, size: int = 0) -> None:
+        rv = self.stages.get(stage)
+        if not rv:
+            rv = self.stages[stage] = [[0] * (len(METRICS_BUCKETS) + 1), 0, 0]
+        rv[0][bisect_left(METRICS_BUCKETS, seconds)] += 1
+        rv[1] += seconds
+        rv[2] += size
+
+    @contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def item(self, baseUrl: str, seconds: float, *, error: bool) -> None:
+        ''' Record totals of a single ipa file. '''
+        size = sum(x[2] for x in self.stages.values())
+        self.observe('item', seconds)
+        for kind, key in (('host', urlsplit(baseUrl).netloc),
+                          ('collection', baseUrl)):
+            rv = self.groups[kind].setdefault(key, [0, 0, 0, 0])
+            rv[0] += 1
+            rv[1] += error
+            rv[2] += seconds
+            rv[3] += size
+
+    def count(self, name: str) -> None:
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def pop(self) -> dict:
+        ''' Return and reset stage and group data (to send to parent). '''
+        rv = {'stages': self.stages, 'groups': self.groups}
+        self.stages = {}
+        self.groups = {'host': {}, 'collection': {}}
+        return rv
+
+    def merge(self, data: dict) -> None:
+        for stage, (buckets, seconds, size) in data['stages'].items():
+            rv = self.stages.setdefault(
+                stage, [[0] * (len(METRICS_BUCKETS) + 1), 0, 0])
+            rv[0] = [a + b for a, b in zip(rv[0], buckets)]
+            rv[1] += seconds
+            rv[2] += size
+        for kind, groups in data['groups'].items():
+            for key, values in groups.items():
+                rv = self.groups[kind].setdefault(key, [0, 0, 0, 0])
+                rv[:] = [a + b for a, b in zip(rv, values)]
+
+    def saveIfDue(self) -> None:
+        if time.monotonic() - self._lastSave >= METRICS_INTERVAL:
+            self.save()
+
+    def save(self) -> None:
+        ''' Write `data/metrics.json` and `data/metrics.prom` '''
+        self._lastSave = time.monotonic()
+        data = {
+            'started': self.started,
+            'updated': time.time(),
+            'buckets': METRICS_BUCKETS,
+            'counts': self.counts,
+            'stages': self.stages,
+            'groups': self.groups,
+        }
+        for ext, text in (('.json', json.dumps(data)),
+                          ('.prom', self.prometheus())):
+            tmp = CACHE_DIR / f'metrics{ext}.tmp'
+            with open(tmp, 'w') as fp:
+                fp.write(text)
+            os.replace(tmp, CACHE_DIR / f'metrics{ext}')
+
+    def prometheus(self) -> str:
+        rv = ['# TYPE ipa_archive_stage_seconds histogram']
+        for stage, (buckets, seconds, _) in sorted(self.stages.items()):
+            label = f'stage="{stage}"'
+            for bound, total in zip(METRICS_BUCKETS + ('+Inf',),
+                                    accumulate(buckets)):
+                rv.append(f'ipa_archive_stage_seconds_bucket'
+                          f'{{{label},le="{bound}"}} {total}')
+            rv.append(f'ipa_archive_stage_seconds_sum{{{label}}} {seconds}')
+            rv.append(f'ipa_archive_stage_seconds_count{{{label}}} '
+                      f'{sum(buckets)}')
+        rv.append('# TYPE ipa_archive_stage_bytes_total counter')
+        for stage, (_, _, size) in sorted(self.stages.items()):
+            if size:
+                rv.append(f'ipa_archive_stage_bytes_total{{stage="{stage}"}}'
+                          f' {size}')
+        rv.append('# TYPE ipa_archive_items_total counter')
+        for name, value in sorted(self.counts.items()):
+            rv.append(f'ipa_archive_items_total{{result="{name}"}} {value}')
+        return '\n'.join(rv) + '\n'
+
+
+def _quantile(buckets: 'list[int]', q: float) -> float:
+    ''' Upper bound of histogram bucket containing quantile `q` '''
+    rank = q * sum(buckets)
+    for bound, total in zip(METRICS_BUCKETS, accumulate(buckets)):
+        if total >= rank:
+            return bound
+    return float('inf')
+
+
+def printStats(*, top: int = 5) -> None:
+    ''' Summary of last `run` (`data/metrics.json`) and DB state. '''
+    try:
+        with open(CACHE_DIR / 'metrics.json') as fp:
+            data = json.load(fp)
+    except FileNotFoundError:
+        data = None
+    if data and data.get('buckets') == list(METRICS_BUCKETS):
+        elapsed = data['updated'] - data['started']
+        counts = data['counts']
+        items = sum(counts.values())
+        stages = data['stages']
+        received = sum(x[2] for x in stages.values())
+        started = time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(data['started']))
+        print(f'Last run: {started}, {elapsed:.0f}s, {items} items ('
+              + ', '.join(f'{v} {k}' for k, v in sorted(counts.items()))
+              + f'), {items / (elapsed or 1):.2f} items/s,'
+              f' {received / 1024 / 1024 / (elapsed or 1):.2f} MiB/s')
+        print()
+        print(f'{"stage":12} {"count":>8} {"total":>9} {"avg":>9}'
+              f' {"p50":>8} {"p95":>8} {"MiB":>9}')
+        for stage, (buckets, seconds, size) in sorted(
+                stages.items(), key=lambda x: -x[1][1]):
+            count = sum(buckets)
+            print(f'{stage:12} {count:8} {seconds:8.1f}s'
+                  f' {seconds / (count or 1) * 1000:7.1f}ms'
+                  f' {_quantile(buckets, 0.5) * 1000:6.0f}ms'
+                  f' {_quantile(buckets, 0.95) * 1000:6.0f}ms'
+                  f' {size / 1024 / 1024:9.2f}')
+        for kind, groups in data['groups'].items():
+            print()
+            print(f'Slowest {kind}s (avg per item):')
+            for key, (num, errors, seconds, size) in sorted(
+                    groups.items(), key=lambda x: -x[1][2] / x[1][0])[:top]:
+                print(f'  {seconds / num:6.2f}s {num:6} items'
+                      f' {errors / num:6.1%} err'
+                      f' {size / num / 1024:8.1f} KiB  {key}')
+    else:
+        print('No metrics yet. Run `run` first.')
+
+    print()
+    print('DB entries by done state:')
+    DB = CacheDB()
+    byState = DB.countByDone()
+    total = sum(byState.values())
+    names = {0: 'queued', 1: 'done', 2: 'in progress', 3: 'error',
+             4: 'permanent error'}
+    for done, num in sorted(byState.items()):
+        print(f'  {done} {names.get(done, "?"):16} {num:8} '
+              f'{num / (total or 1):7.1%}')
+    retries = DB.countRetries()
+    if retries:
+        print(f'    (of which {retries} waiting for retry)')
+    leases = DB.leaseOwners()
+    if leases:
+        print()
+        print('Claimed by (`err release` to requeue if no worker is running):')
+    for owner, num, until in leases:
+        dead = ' (dead)' if isDeadLocalWorker(owner) else ''
+        expires = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(until))
+        print(f'  {num:8} {owner}{dead}, lease until {expires}')
+
+
+###############################################
+# [explain] Query plans
+###############################################
+
+def printQueryPlans() -> None:
+    ''' Show how sqlite executes the hot queries '''
+    for name, sql, plan in CacheDB().queryPlans():
+        print(f'{name}:\n  {sql}')
+        for depth, detail in plan:
+            # a full scan of idx is fine for export, but not for lookups
+            warn = detail in ('SCAN idx', 'SCAN dup') \
+                or detail.startswith('USE TEMP B-TREE')
+            print('    ' + '  ' * depth + detail + ('  <--' if warn else ''))
+        print()
+
+
+###############################################
+# Process IPA zip
+###############################################
+
+def loadIpa(uid: int, url: str, *, overwrite: bool = False,
+            image_only: bool = False, fsize: int = 0,
+            metrics: 'Metrics|None' = None) -> 'IpaInfo|None':
+    ''' :returns: Metadata of `Info.plist` or `None` if there is none '''
+    if not overwrite and blobStore().exists(uid, '.plist'):
+        return localIpaInfo(uid)
+    steps = ipaSteps(uid, image_only=image_only, fsize=fsize, metrics=metrics)
+    try:
+        ranges = next(steps)
+        while True:
+            url, chunks = fetchRanges(url, ranges, metrics=metrics)
+            ranges = steps.send(chunks)
+    except StopIteration as ret:
+        return ret.value
+
+
+###############################################
+# HTTP range requests
+###############################################
+_HTTP_CONNECTIONS = {}  # type: dict[tuple[str, str, int], HTTPConnection]
+_NO_MULTI_RANGE = set()  # type: set[str]
+
+
+class ResponseTooLarge(ValueError):
+    pass
+
+
+def fetchRanges(url: str, ranges: 'list[tuple[int, int]]', *,
+                metrics: 'Metrics|None' = None) \
+        -> 'tuple[str, list[tuple[int, bytes]]]':
+    '''
+    Load multiple byte ranges with a single (multi-range) request.
+    Connections are kept alive and reused (per thread).
+    :returns: `(final_url, [(offset, data), ...])` with redirects resolved.
+    '''
+    host = urlsplit(url).netloc
+    if len(ranges) > 1 and host in _NO_MULTI_RANGE:
+        chunks = []
+        for rng in ranges:
+            url, chunk = fetchRanges(url, [rng], metrics=metrics)
+            chunks += chunk
+        return url, chunks
+    for _ in range(5):  # max redirects
+        try:
+            status, headers, body = httpGet(
+                url, {'Range': makeRangeHeader(ranges)},
+                limit=rangeResponseLimit(ranges), metrics=metrics)
+        except ResponseTooLarge:
+            if len(ranges) == 1:
+                raise
+            _NO_MULTI_RANGE.add(host)  # server ignored multi-range request
+            return fetchRanges(url, ranges, metrics=metrics)
+        if status in (301, 302, 303, 307, 308) and 'location' in headers:
+            url = urljoin(url, headers['location'])
+            host = urlsplit(url).netloc
+            continue
+        if status in (200, 206):
+            return url, splitRangeResponse(status, headers, body, ranges)
+        raise HTTPError(url, status, responses.get(status, ''), headers, None)
+    raise HTTPError(url, status, 'Too many redirects', headers, None)
+
+
+def httpGet(url: str, headers: 'dict[str, str]', *, limit: int,
+            metrics: 'Metrics|None' = None) \
+        -> 'tuple[int, dict[str, str], bytes]':
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc, get_ident())
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    while True:
+        conn = _HTTP_CONNECTIONS.get(key)
+        reused = conn is not None
+        if not conn:
+            if parts.scheme == 'https':
+                conn = HTTPSConnection(parts.netloc, timeout=60)
+            else:
+                conn = HTTPConnection(parts.netloc, timeout=60)
+            _HTTP_CONNECTIONS[key] = conn
+        try:
+            if conn.sock is None and metrics:  # TCP (+ TLS) handshake
+                with metrics.timed('connect'):
+                    conn.connect()
+            conn.request('GET', path, headers={
+                'Accept-Encoding': 'identity', **headers})
+            res = conn.getresponse()
+            size = res.getheader('Content-Length')
+            if size and int(size) > limit:
+                raise ResponseTooLarge(f'response exceeds {limit} bytes')
+            body = res.read(limit + 1)
+            if len(body) > limit:
+                raise ResponseTooLarge(f'response exceeds {limit} bytes')
+            res.read()  # mark response as complete
+        except (OSError, HTTPException) as e:
+            conn.close()
+            del _HTTP_CONNECTIONS[key]
+            if reused and isinstance(e, (ConnectionError, BadStatusLine)):
+                continue  # server closed idle keep-alive connection
+            raise
+        except BaseException:
+            conn.close()
+            del _HTTP_CONNECTIONS[key]
+            raise
+        return res.status, {k.lower(): v for k, v in res.getheaders()}, body
+
+
+def makeRangeHeader(ranges: 'list[tuple[int, int]]') -> str:
+    return 'bytes=' + ','.join(str(start) if start < 0 else f'{start}-{end}'
+                               for start, end in ranges)
+
+
+def rangeResponseLimit(ranges: 'list[tuple[int, int]]') -> int:
+    ''' Upper bound for response size. Prevents loading a whole ipa file. '''
+    total = sum(-start if start < 0 else end - start + 1
+                for start, end in ranges)
+    return max(total + 256 * len(ranges), 1 << 22)  # + multipart headers
+
+
+def splitRangeResponse(
+    status: int, headers: 'dict[str, str]', body: bytes,
+    ranges: 'list[tuple[int, int]]'
+) -> 'list[tuple[int, bytes]]':
+    ''' :returns: `(offset, data)` for each requested range '''
+    contentType = headers.get('content-type', '')
+    if status == 206 and contentType.startswith('multipart/byteranges'):
+        segments = parseMultipartRanges(body, contentType)
+    elif status == 206:
+        match = re_content_range.match(headers.get('content-range', ''))
+        if not match:
+            raise ValueError('invalid Content-Range header')
+        segments = [(int(match.group(1)), body)]
+    else:  # server ignored range (or file is small)
+        segments = [(0, body)]
+
+    if len(ranges) == 1 and ranges[0][0] < 0:  # suffix range
+        offset, data = segments[-1]
+        if status == 200:
+            return [(max(0, len(data) + ranges[0][0]),
+                     data[ranges[0][0]:])]
+        return [(offset, data)]
+
+    rv = []
+    for start, end in ranges:
+        for offset, data in segments:
+            if offset <= start < offset + len(data):
+                rv.append((start, data[start - offset:end - offset + 1]))
+                break
+        else:
+            raise ValueError(f'server did not return range {start}-{end}')
+    return rv
+
+
+def parseMultipartRanges(body: bytes, contentType: str) \
+        -> 'list[tuple[int, bytes]]':
+    boundary = contentType.split('boundary=', 1)[-1].strip('"')
+    delimiter = b'--' + boundary.encode()
+    rv = []
+    pos = body.find(delimiter)
+    while pos >= 0 and body[pos + len(delimiter):][:2] != b'--':
+        headEnd = body.find(b'\r\n\r\n', pos)
+        match = re_content_range.search(body[pos:headEnd].decode('latin-1'))
+        if headEnd < 0 or not match:
+            raise ValueError('invalid multipart/byteranges response')
+        start, end = int(match.group(1)), int(match.group(2))
+        headEnd += 4
+        rv.append((start, body[headEnd:headEnd + end - start + 1]))
+        pos = body.find(delimiter, headEnd + end - start + 1)
+    return rv
+
+
+###############################################
+# Remote zip (sans-IO)
+###############################################
+ZIP_TAIL_SIZE = 1 << 16  # EOCD (22 bytes) + max comment length (64 KiB)
+ZIP_TAIL_MAX = 1 << 22  # max. size of speculative central directory read
+ZIP_CD_RATIO = 400  # guessed ratio of filesize to central directory size
+ZIP_COALESCE_GAP = 1 << 15  # merge ranges if less than 32 KiB apart
+ZIP_LOCAL_HEADER_SLACK = 1024  # local extra field may differ from central
+
+
+class ZipEntry(NamedTuple):
+    filename: str
+    file_size: int
+    compress_size: int
+    compress_type: int
+    header_offset: int
+    flag_bits: int
+
+
+class RangeCache:
+    ''' Already loaded byte ranges of a remote file. '''
+
+    def __init__(self, metrics: 'Metrics|None' = None) -> None:
+        self.segments = []  # type: list[tuple[int, bytes]]
+        self.received = 0
+        self.requests = 0
+        self.metrics = metrics or Metrics()
+
+    def get(self, start: int, end: int) -> 'bytes|None':
+        for offset, data in self.segments:
+            if offset <= start and end < offset + len(data):
+                return data[start - offset:end - offset + 1]
+        return None
+
+    def fetch(self, ranges: 'list[tuple[int, int]]', stage: str) \
+            -> 'Generator[list, list, list[tuple[int, bytes]]]':
+        '''
+        Sub-generator of `ipaSteps()`. Request ranges in one go.
+        :stage: metrics name. Measures the time until data is sent back.
+        '''
+        if not ranges:
+            return []
+        start = time.perf_counter()
+        chunks = yield ranges
+        self.requests += 1
+        size = 0
+        for offset, data in chunks:
+            size += len(data)
+            self.segments.append((offset, data))
+        self.received += size
+        self.metrics.observe(stage, time.perf_counter() - start, size)
+        return chunks
+
+
+def ipaSteps(uid: int, *, image_only: bool = False, fsize: int = 0,
+             metrics: 'Metrics|None' = None) -> (
+    'Generator[list[tuple[int, int]], list[tuple[int, bytes]], IpaInfo|None]'
+):
+    '''
+    I/O-free implementation of `loadIpa()`. Yields a list of byte ranges
+    `(start, end)` (`end` inclusive, `start < 0` for a suffix range) and
+    expects a list of `(offset, data)` in return – one for each range.
+    :fsize: (if known) used to fetch EOCD and central directory at once.
+    '''
+    store = blobStore()
+    cache = RangeCache(metrics)
+    metrics = cache.metrics
+
+    tailSize = ZIP_TAIL_SIZE
+    if fsize > 0:
+        tailSize = min(max(fsize // ZIP_CD_RATIO, tailSize), ZIP_TAIL_MAX)
+    [(tailOffset, tail)] = yield from cache.fetch([(-tailSize, -1)], 'tail')
+    filesize = tailOffset + len(tail)
+
+    cdOffset, cdSize = parseZipTail(tail, tailOffset)
+    if cdOffset >= tailOffset:
+        cd = tail[cdOffset - tailOffset:cdOffset - tailOffset + cdSize]
+    else:  # only load the part which is not already in tail
+        [(_, cd)] = yield from cache.fetch([(cdOffset, tailOffset - 1)],
+                                           'central_dir')
+        cd += tail[:cdOffset + cdSize - tailOffset]
+
+    with metrics.timed('parse_cd'):
+        listing = ZipListing(cd, cdOffset)
+    artwork = listing.find('iTunesArtwork')
+    app_name = None
+    plist_entry = None
+    for name, _ in listing.listDir('Payload/'):
+        if name.endswith('/'):  # first app folder with Info.plist
+            plist_entry = listing.find(f'Payload/{name}Info.plist')
+            if plist_entry:
+                app_name = name[:-1]
+                break
+
+    if not listing.hasPrefix('Payload/'):
+        print(f'ERROR: [{uid}] ipa has no "Payload/" root folder', file=stderr)
+
+    # load everything in one request. Include icons if they are close-by
+    required = [x for x in [artwork, None if image_only else plist_entry] if x]
+    optional = [] if not app_name or artwork and artwork.file_size else [
+        x for x in (listing[slot] for name, slot in listing.listDir(
+            f'Payload/{app_name}/') if not name.endswith('/'))
+        if isIconCandidate(x, app_name)]
+    yield from cache.fetch(coalesceRanges(
+        [(x.header_offset, listing.entryEnd(x)) for x in required],
+        [(x.header_offset, listing.entryEnd(x)) for x in optional]),
+        'entries')
+
+    icon_name = None
+    if artwork:
+        data = yield from readZipEntry(cache, artwork, listing)
+        with metrics.timed('store'):
+            store.write(uid, '.png', data)
+        icon_name = artwork.filename if data else None
+    plist = None
+    if plist_entry and not image_only:
+        data = yield from readZipEntry(cache, plist_entry, listing)
+        with metrics.timed('store'):
+            store.write(uid, '.plist', data)
+        with metrics.timed('plist'):
+            plist = parsePlist(data, uid)
+    elif store.exists(uid, '.plist'):
+        plist = parsePlist(store.read(uid, '.plist'), uid)
+
+    # if no iTunesArtwork found, load file referenced in plist
+    if not icon_name and app_name and plist is not None:
+        icon = expandImageName(listing, app_name, iconNameFromPlist(plist))
+        if icon:
+            data = yield from readZipEntry(cache, icon, listing)
+            with metrics.timed('store'):
+                store.write(uid, '.png', data)
+            icon_name = icon.filename
+
+    print(f'[{uid}] fetched {cache.received} of {filesize} bytes '
+          f'({cache.received / (filesize or 1):.2%}) '
+          f'in {cache.requests} requests')
+    if plist is None:
+        return None
+    return ipaInfoFromPlist(plist, icon=icon_name, filesize=filesize
+                            if USE_ZIP_FILESIZE else onceReadSizeFromFile(uid))
+
+
+def isIconCandidate(entry: ZipEntry, appName: str) -> bool:
+    ''' Image in app root folder which could be referenced in plist. '''
+    fn = entry.filename.lstrip('/')
+    prefix = f'Payload/{appName}/'
+    return fn.startswith(prefix) and '/' not in fn[len(prefix):] \
+        and 'icon' in fn.lower() and entry.compress_size < (1 << 19)
+
+
+def coalesceRanges(
+    required: 'list[tuple[int, int]]', optional: 'list[tuple[int, int]]' = [],
+    *, gap: int = ZIP_COALESCE_GAP
+) -> 'list[tuple[int, int]]':
+    '''
+    Merge ranges which are less than `gap` bytes apart.
+    `optional` ranges are only included if close to a required range.
+    '''
+    groups = []  # type: list[list[int]]
+    for start, end in sorted(required):
+        if groups and start - groups[-1][1] <= gap:
+            groups[-1][1] = max(groups[-1][1], end)
+        else:
+            groups.append([start, end])
+    for start, end in sorted(optional):
+        for group in groups:
+            if start - group[1] <= gap and group[0] - end <= gap:
+                group[0] = min(group[0], start)
+                group[1] = max(group[1], end)
+                break
+    rv = []  # type: list[tuple[int, int]]
+    for start, end in sorted(groups):  # optional may cause overlaps
+        if rv and start - rv[-1][1] <= gap:
+            rv[-1] = (rv[-1][0], max(rv[-1][1], end))
+        else:
+            rv.append((start, end))
+    return rv
+
+
+def readZipEntry(cache: RangeCache, entry: ZipEntry, listing: 'ZipListing') \
+        -> 'Generator[list[tuple[int, int]], list[tuple[int, bytes]], bytes]':
+    ''' Sub-generator of `ipaSteps()`. Load and decompress single file. '''
+    start = entry.header_offset
+    end = listing.entryEnd(entry)
+    data = cache.get(start, end)
+    if data is None:
+        [(_, data)] = yield from cache.fetch([(start, end)], 'entries')
+    if data[:4] != b'PK\x03\x04':
+        raise BadZipFile(f'Bad local file header for {entry.filename}')
+    nameLen, extraLen = struct.unpack_from('<2H', data, 26)
+    dataStart = 30 + nameLen + extraLen
+    if len(data) < dataStart + entry.compress_size:
+        [(_, more)] = yield from cache.fetch([(
+            start + len(data), start + dataStart + entry.compress_size - 1)],
+            'entries')
+        data += more
+    raw = data[dataStart:dataStart + entry.compress_size]
+    if entry.flag_bits & 0x1:
+        raise BadZipFile(f'{entry.filename} is encrypted')
+    if entry.compress_type == 0:  # stored
+        return raw
+    if entry.compress_type == 8:  # deflate
+        with cache.metrics.timed('extract'):
+            return zlib.decompress(raw, -15)
+    raise BadZipFile(f'Unsupported compression {entry.compress_type}')
+
+
+def parseZipTail(tail: bytes, tailOffset: int) -> 'tuple[int, int]':
+    ''' :returns: `(offset, size)` of central directory '''
+    pos = tail.rfind(b'PK\x05\x06')
+    if pos < 0 or len(tail) - pos < 22:
+        raise BadZipFile('End of central directory not found')
+    count, cdSize, cdOffset = struct.unpack_from('<H2L', tail, pos + 10)
+    if count == 0xFFFF or 0xFFFFFFFF in (cdSize, cdOffset):  # zip64
+        loc = pos - 20
+        if loc < 0 or tail[loc:loc + 4] != b'PK\x06\x07':
+            raise BadZipFile('zip64 end of central directory not found')
+        rec = struct.unpack_from('<Q', tail, loc + 8)[0] - tailOffset
+        if rec < 0 or tail[rec:rec + 4] != b'PK\x06\x06':
+            raise BadZipFile('zip64 end of central directory not found')
+        cdSize, cdOffset = struct.unpack_from('<2Q', tail, rec + 40)
+    return cdOffset, cdSize
+
+
+class ZipListing:
+    '''
+    Compact central directory. One slot per entry (position of its record
+    in `cd`), `ZipEntry` tuples are only created for entries actually used.
+    Paths (without leading "/") are sorted for prefix and folder lookups.
+    '''
+
+    def __init__(self, cd: bytes, cdOffset: int) -> None:
+        self.cd = cd
+        self.cdOffset = cdOffset
+        self._records = array('Q')  # slot: record position in `cd`
+        offsets = array('Q')
+        paths = []  # type: list[str]
+        pos = 0
+        while cd.startswith(b'PK\x01\x02', pos):
+            flag, nameLen, extraLen, commentLen, offset = struct.unpack_from(
+                '<8xH18xHHH8xL', cd, pos)
+            self._records.append(pos)
+            name = cd[pos + 46:pos + 46 + nameLen].decode(
+                'utf-8' if flag & 0x800 else 'cp437')
+            if offset == 0xFFFFFFFF:
+                offset = self._entryAt(pos).header_offset
+            offsets.append(offset)
+            paths.append(name.lstrip('/'))
+            pos += 46 + nameLen + extraLen + commentLen
+        order = sorted(range(len(paths)), key=paths.__getitem__)
+        self._paths = [paths[i] for i in order]
+        self._slots = array('L', order)
+        self._offsets = array('Q', sorted(offsets))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __getitem__(self, slot: int) -> ZipEntry:
+        return self._entryAt(self._records[slot])
+
+    def _entryAt(self, pos: int) -> ZipEntry:
+        (flag, method, compSize, size, nameLen, extraLen, _, offset
+         ) = struct.unpack_from('<8xHH8xLLHHH8xL', self.cd, pos)
+        pos += 46
+        name = self.cd[pos:pos + nameLen].decode(
+            'utf-8' if flag & 0x800 else 'cp437')
+        if 0xFFFFFFFF in (compSize, size, offset):
+            size, compSize, offset = _zip64Extra(
+                self.cd[pos + nameLen:pos + nameLen + extraLen],
+                size, compSize, offset)
+        return ZipEntry(name, size, compSize, method, offset, flag)
+
+    def find(self, path: str) -> 'ZipEntry|None':
+        ''' Entry with exactly this path (first in zip order) '''
+        i = bisect_left(self._paths, path)
+        if i < len(self._paths) and self._paths[i] == path:
+            return self[self._slots[i]]
+        return None
+
+    def hasPrefix(self, prefix: str) -> bool:
+        i = bisect_left(self._paths, prefix)
+        return i < len(self._paths) and self._paths[i].startswith(prefix)
+
+    def prefix(self, prefix: str) -> 'Iterator[tuple[str, int]]':
+        ''' :returns: `(path, slot)` of all paths starting with `prefix` '''
+        paths = self._paths
+        i = bisect_left(paths, prefix)
+        while i < len(paths) and paths[i].startswith(prefix):
+            yield paths[i], self._slots[i]
+            i += 1
+
+    def listDir(self, folder: str) -> 'Iterator[tuple[str, int]]':
+        '''
+        Direct children of `folder` (with trailing "/") as `(name, slot)`.
+        Sub-folders are returned once with trailing "/" (and the slot of
+        their first entry), their content is skipped.
+        '''
+        paths = self._paths
+        i = bisect_left(paths, folder)
+        while i < len(paths) and paths[i].startswith(folder):
+            name = paths[i][len(folder):]
+            sep = name.find('/')
+            if sep < 0:
+                if name:
+                    yield name, self._slots[i]
+                i += 1
+            else:
+                yield name[:sep + 1], self._slots[i]
+                # "0" is the character after "/"
+                i = bisect_left(paths, folder + name[:sep] + '0', i)
+
+    def entryEnd(self, entry: ZipEntry) -> int:
+        ''' Upper bound for the last byte of `entry` (incl. local header) '''
+        i = bisect_right(self._offsets, entry.header_offset)
+        nextOffset = self._offsets[i] if i < len(self._offsets) \
+            else self.cdOffset
+        maxEnd = entry.header_offset + 30 + len(entry.filename.encode()) \
+            + entry.compress_size + ZIP_LOCAL_HEADER_SLACK
+        return max(min(nextOffset, maxEnd), entry.header_offset + 30) - 1
+
+
+def _zip64Extra(extra: bytes, size: int, compSize: int, offset: int) \
+        -> 'tuple[int, int, int]':
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from('<2H', extra, pos)
+        if tag == 1:
+            values = list(struct.unpack_from(
+                f'<{length // 8}Q', extra, pos + 4))
+            if size == 0xFFFFFFFF:
+                size = values.pop(0)
+            if compSize == 0xFFFFFFFF:
+                compSize = values.pop(0)
+            if offset == 0xFFFFFFFF:
+                offset = values.pop(0)
+            break
+        pos += 4 + length
+    return size, compSize, offset
+
+
+###############################################
+# Info.plist metadata
+###############################################
+
+class IpaInfo(NamedTuple):
+    min_os: 'int|None'
+    platform: 'int|None'
+    title: 'str|None'
+    bundle_id: 'str|None'
+    version: 'str|None'
+    filesize: 'int|None' = None
+    icon: 'str|None' = None  # zip path of the extracted image
+
+
+def localIpaInfo(uid: int) -> 'IpaInfo|None':
+    ''' Read metadata of an already downloaded plist (and `.size` file) '''
+    data = blobStore().read(uid, '.plist')
+    if data is None:
+        return None
+    plist = parsePlist(data, uid)
+    return ipaInfoFromPlist(plist, filesize=onceReadSizeFromFile(uid))
+
+
+def ipaInfoFromPlist(plist: dict, *, filesize: 'int|None' = None,
+                     icon: 'str|None' = None) -> IpaInfo:
+    bundleId = plist.get('CFBundleIdentifier')
+    title = plist.get('CFBundleDisplayName') or plist.get('CFBundleName')
+    v_short = str(plist.get('CFBundleShortVersionString', ''))
+    v_long = str(plist.get('CFBundleVersion', ''))
+    version = v_short or v_long
+    if version != v_long and v_long:
+        version += f' ({v_long})'
+    minOS = [int(x) for x in plist.get('MinimumOSVersion', '0').split('.')]
+    minOS += [0, 0, 0]  # ensures at least 3 components are given
+    platforms = sum(1 << int(x) for x in plist.get('UIDeviceFamily', []))
+    if not platforms and minOS[0] in [0, 1, 2, 3]:
+        platforms = 1 << 1  # fallback to iPhone for old versions
+
+    return IpaInfo(
+        (minOS[0] * 10000 + minOS[1] * 100 + minOS[2]) or None,
+        platforms or None,
+        title or None,
+        bundleId or None,
+        version or None,
+        filesize,
+        icon,
+    )
+
+
+def parsePlist(data: bytes, uid: int = 0) -> dict:
+    '''
+    Parse XML, binary, JSON or OpenStep (old-style ASCII) plist.
+    :raises ValueError: if none of the formats match
+    '''
+    try:
+        rv = plistlib.loads(data)
+    except Exception as e:
+        try:
+            rv = parseOpenStepPlist(data.decode('utf-8-sig'))
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError(f'PLIST: {e}') from None
+    if not isinstance(rv, dict):
+        raise ValueError('PLIST: root is not a dictionary')
+    return rv
+
+
+_OPENSTEP_UNQUOTED = re.compile(r'[\w.$/:+-]+')
+_OPENSTEP_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'a': '\a',
+                     'b': '\b', 'f': '\f', 'v': '\v'}
+
+
+def parseOpenStepPlist(text: str) -> 'dict|list|str':
+    '''
+    Parse OpenStep plist (`{ key = value; }`, `( a, b )`, `<hex>`).
+    Also accepts JSON (`{"key": value, ...}`) as used by some ipa files.
+    '''
+    pos = 0
+
+    def skip() -> None:
+        nonlocal pos
+        while pos < len(text):
+            if text[pos].isspace():
+                pos += 1
+            elif text.startswith('//', pos):
+                pos = text.find('\n', pos)
+                pos = len(text) if pos < 0 else pos
+            elif text.startswith('/*', pos):
+                end = text.find('*/', pos + 2)
+                if end < 0:
+                    raise ValueError('unterminated comment')
+                pos = end + 2
+            else:
+                break
+
+    def expect(chars: str) -> str:
+        nonlocal pos
+        skip()
+        if pos >= len(text) or text[pos] not in chars:
+            raise ValueError(f'expected "{chars}" at {pos}')
+        pos += 1
+        return text[pos - 1]
+
+    def value() -> 'dict|list|str|bool|int|float|bytes|None':
+        nonlocal pos
+        skip()
+        if pos >= len(text):
+            raise ValueError('unexpected end of plist')
+        char = text[pos]
+        if char in '{':
+            pos += 1
+            rv = {}
+            while True:
+                skip()
+                if text[pos:pos + 1] == '}':
+                    pos += 1
+                    return rv
+                key = value()
+                expect('=:')
+                rv[str(key)] = value()
+                if expect(';,}') == '}':
+                    return rv
+        if char in '([':
+            pos += 1
+            close = ')' if char == '(' else ']'
+            rv = []
+            while True:
+                skip()
+                if text[pos:pos + 1] == close:
+                    pos += 1
+                    return rv
+                rv.append(value())
+                if expect(',' + close) == close:
+                    return rv
+        if char == '<':
+            end = text.find('>', pos)
+            if end < 0:
+                raise ValueError('unterminated data')
+            hexData = re.sub(r'\s', '', text[pos + 1:end])
+            pos = end + 1
+            return bytes.fromhex(hexData)
+        if char in '"\'':
+            return string(char)
+        match = _OPENSTEP_UNQUOTED.match(text, pos)
+        if not match:
+            raise ValueError(f'unexpected "{char}" at {pos}')
+        pos = match.end()
+        return match.group()
+
+    def string(quote: str) -> str:
+        nonlocal pos
+        pos += 1
+        rv = []
+        while pos < len(text) and text[pos] != quote:
+            char = text[pos]
+            pos += 1
+            if char != '\\':
+                rv.append(char)
+                continue
+            char = text[pos:pos + 1]
+            pos += 1
+            if char in 'uU':  # \U1234
+                rv.append(chr(int(text[pos:pos + 4], 16)))
+                pos += 4
+            else:
+                rv.append(_OPENSTEP_ESCAPES.get(char, char))
+        if pos >= len(text):
+            raise ValueError('unterminated string')
+        pos += 1
+        return ''.join(rv)
+
+    rv = value()
+    skip()
+    if pos < len(text):
+        raise ValueError(f'unexpected data at {pos}')
+    if isinstance(rv, str) and not text.lstrip().startswith(('"', "'")):
+        raise ValueError('not a plist')
+    return rv
+
+
+###############################################
+# Icon name extraction
+###############################################
+RESOLUTION_ORDER = ['3x', '2x', '180', '167', '152', '120']
+
+
+def expandImageName(
+    listing: 'ZipListing', appName: str, iconList: 'list[str]'
+) -> 'ZipEntry|None':
+    folder = f'Payload/{appName}/'
+    for iconName in iconList + ['Icon', 'icon']:
+        # in zip order, equal resolution keeps the first file
+        matches = sorted((slot, path[len(folder):])
+                         for path, slot in listing.prefix(folder + iconName))
+        slots = {}  # type: dict[str, int]
+        for slot, name in matches:
+            if name not in slots and listing[slot].file_size > 0:
+                slots[name] = slot
+        if slots:
+            bestName = sortedByResolution(list(slots))[0]
+            return listing[slots[bestName]]
+    return None
+
+
+def unpackNameListFromPlistDict(bundleDict: 'dict|None') -> 'list[str]|None':
+    if not bundleDict:
+        return None
+    primaryDict = bundleDict.get('CFBundlePrimaryIcon', {})
+    icons = primaryDict.get('CFBundleIconFiles')
+    if not icons:
+        singular = primaryDict.get('CFBundleIconName')
+        if singular:
+            return [singular]
+    return icons
 
 
 def resolutionIndex(icon_name: str):
@@ -668,46 +3288,120 @@ def iconNameFromPlist(plist: dict) -> 'list[str]':
 # [json] Export to json
 ###############################################
 
-def export_json():
+def export_json(*, incremental: bool = False, processes: int = 4):
     DB = CacheDB()
-    url_map = DB.jsonUrlMap()
-    maxUrlId = max(url_map.keys())
-    # just a visual separator
-    maxUrlId += 1
-    url_map[maxUrlId] = '---'
-    submap = {}
+    if incremental:
+        updateJsonShards(DB)
+        return
+    seq, _ = DB.jsonChanges()
+    rows = DB.enumJsonIpa(done=1)
     total = DB.count(done=1)
+    url_map = DB.jsonUrlMap()
+    search_fields = []
     with open(CACHE_DIR / 'ipa.json', 'w') as fp:
         fp.write('[')
-        for i, entry in enumerate(DB.enumJsonIpa(done=1)):
+        for i, entry in enumerate(withSubdirUrls(rows, url_map)):
             if i % 113 == 0:
                 print(f'\rprocessing [{i}/{total}]', end='')
-            # if path_name is in a subdirectory, reindex URLs
-            if '/' in entry[7]:
-                baseurl = url_map[entry[6]]
-                sub_dir, sub_file = entry[7].split('/', 1)
-                newurl = baseurl + '/' + sub_dir
-                subIdx = submap.get(newurl, None)
-                if subIdx is None:
-                    maxUrlId += 1
-                    submap[newurl] = maxUrlId
-                    subIdx = maxUrlId
-                entry = list(entry)
-                entry[6] = subIdx
-                entry[7] = sub_file
-
             if i > 0:
                 fp.write(',\n')
             fp.write(json.dumps(entry, separators=(',', ':')))
+            search_fields.append(SearchIndex.fields(entry))
         fp.write(']')
         print('\r', end='')
     print(f'write ipa.json: {total} entries')
 
-    for newurl, newidx in submap.items():
-        url_map[newidx] = newurl
+    data = buildSearchIndex(search_fields)
+    with open(CACHE_DIR / 'search.idx', 'wb') as fp:
+        fp.write(data)
+    print(f'write search.idx: {len(data)} bytes')
+
     with open(CACHE_DIR / 'urls.json', 'w') as fp:
         fp.write(json.dumps(url_map, separators=(',\n', ':'), sort_keys=True))
     print(f'write urls.json: {len(url_map)} entries')
+    # shards do not know about these changes, next -incremental rebuilds them
+    # (and until then, the web client uses ipa.json again)
+    manifest_path = CACHE_DIR / 'ipa' / 'manifest.json'
+    if manifest_path.exists():
+        os.remove(manifest_path)
+    DB.clearJsonChanges(upToSeq=seq)
+    publishArtefacts(processes=processes)
+
+
+def withSubdirUrls(
+    entries: 'Iterable[list|tuple]', url_map: 'dict[int, str]'
+) -> 'Iterable[list|tuple]':
+    '''
+    If path_name is in a subdirectory, reindex URLs.
+    New base URLs are added to `url_map` while iterating.
+    '''
+    maxUrlId = max(url_map.keys())
+    # just a visual separator
+    maxUrlId += 1
+    url_map[maxUrlId] = '---'
+    submap = {}
+    for entry in entries:
+        if '/' in entry[7]:
+            baseurl = url_map[entry[6]]
+            sub_dir, sub_file = entry[7].split('/', 1)
+            newurl = baseurl + '/' + sub_dir
+            subIdx = submap.get(newurl, None)
+            if subIdx is None:
+                maxUrlId += 1
+                submap[newurl] = maxUrlId
+                url_map[maxUrlId] = newurl
+                subIdx = maxUrlId
+            entry = list(entry)
+            entry[6] = subIdx
+            entry[7] = sub_file
+        yield entry
+
+
+def updateJsonShards(DB: CacheDB) -> None:
+    '''
+    Regenerate `data/ipa/<bucket>.json` for all buckets with changes since
+    the last run. `manifest.json` lists content hashes of all shards and the
+    base urls. If it exists, the web client loads shards instead of ipa.json.
+    '''
+    shard_dir = CACHE_DIR / 'ipa'
+    shard_dir.mkdir(exist_ok=True)
+    manifest_path = shard_dir / 'manifest.json'
+    seq, dirty = DB.jsonChanges()
+    if manifest_path.exists():
+        with open(manifest_path, 'r') as fp:
+            shards = json.load(fp)['shards']  # type: dict[str, dict]
+    else:
+        shards = {}
+        dirty = DB.jsonBuckets()
+
+    updated = 0
+    removed = []
+    for bucket in sorted(dirty):
+        shard_path = shard_dir / f'{bucket}.json'
+        rows = list(DB.enumJsonIpa(done=1, bucket=bucket))
+        if not rows:
+            if shards.pop(str(bucket), None) or shard_path.exists():
+                removed.append(shard_path)
+            continue
+        data = ('[' + ',\n'.join(json.dumps(x, separators=(',', ':'))
+                                 for x in rows) + ']').encode()
+        sha1 = hashlib.sha1(data).hexdigest()
+        if shards.get(str(bucket), {}).get('sha1') != sha1:
+            print(f'update shard {bucket}: {len(rows)} entries')
+            _writeAtomic(shard_path, data)
+            shards[str(bucket)] = {'sha1': sha1, 'count': len(rows)}
+            updated += 1
+
+    # shards before manifest, clients must never see a missing shard
+    _writeAtomic(manifest_path, json.dumps({
+        'shards': shards, 'urls': DB.jsonUrlMap(),
+    }, indent=0, sort_keys=True).encode())
+    for shard_path in removed:
+        if shard_path.exists():
+            os.remove(shard_path)
+    DB.clearJsonChanges(upToSeq=seq)
+    print(f'write ipa/manifest.json: {len(shards)} shards, {updated} updated,'
+          f' {sum(x["count"] for x in shards.values())} entries')
 
 
 def export_filesize():
@@ -726,6 +3420,923 @@ def export_filesize():
     print(f'\r{written} files written. {ignored} ignored. done.')
 
 
+###############################################
+# [json] Precompressed, content-hashed artefacts
+###############################################
+# For static hosting: `data/<name>.<hash>.<ext>` (+ `.gz`, `.br`) never
+# change and can be cached forever. `data/artefacts.json` (stable name,
+# short cache lifetime) points to the current files.
+ARTEFACTS = ['ipa.json', 'urls.json', 'search.idx']
+ARTEFACT_ENCODINGS = {'gzip': '.gz', 'br': '.br'}
+re_artefact = re.compile(r'(.+)\.[0-9a-f]{12}(\.[^.]+)(\.gz|\.br)?')
+
+
+def publishArtefacts(names: 'list[str]' = ARTEFACTS, *,
+                     processes: int = 4) -> None:
+    '''
+    Copy export files to content-hashed names, compress all variants in
+    parallel and update the manifest. Existing variants are not compressed
+    again. Files of the previous manifest are kept (clients may have it
+    cached), older ones are deleted.
+    '''
+    manifest_path = CACHE_DIR / 'artefacts.json'
+    previous = {}  # type: dict[str, dict]
+    if manifest_path.exists():
+        with open(manifest_path, 'r') as fp:
+            previous = json.load(fp)
+    encodings = [x for x in ARTEFACT_ENCODINGS if x != 'br' or brotli]
+    if not brotli:
+        print('brotli not installed, skipping .br (pip install brotli)')
+
+    manifest = {}  # type: dict[str, dict]
+    files = {}  # type: dict[str, str]  # hashed name: name
+    queue = []  # type: list[tuple[str, str]]
+    for name in names:
+        src = CACHE_DIR / name
+        if not src.exists():
+            continue
+        data = src.read_bytes()
+        stem, ext = os.path.splitext(name)
+        fname = f'{stem}.{hashlib.sha1(data).hexdigest()[:12]}{ext}'
+        if not (CACHE_DIR / fname).exists():
+            _writeAtomic(CACHE_DIR / fname, data)
+        manifest[name] = {'file': fname, 'size': len(data)}
+        files[fname] = name
+        for encoding in encodings:
+            variant = CACHE_DIR / (fname + ARTEFACT_ENCODINGS[encoding])
+            if variant.exists():
+                manifest[name][encoding] = variant.stat().st_size
+            else:
+                queue.append((fname, encoding))
+
+    start = time.monotonic()
+    if queue:
+        # largest first, so the slowest one starts right away
+        queue.sort(key=lambda x: -manifest[files[x[0]]]['size'])
+        with Pool(processes=min(processes, len(queue))) as pool:
+            for fname, encoding, size in pool.imap_unordered(
+                    _compressArtefact, queue):
+                manifest[files[fname]][encoding] = size
+    _writeAtomic(manifest_path, json.dumps(
+        manifest, indent=1, sort_keys=True).encode())
+
+    keep = set(x['file'] for x in [*manifest.values(), *previous.values()])
+    for path in CACHE_DIR.iterdir():
+        match = re_artefact.fullmatch(path.name)
+        if not match or match.group(1) + match.group(2) not in ARTEFACTS:
+            continue
+        if (path.name[:match.start(3)] if match.group(3) else path.name) \
+                not in keep:
+            os.remove(path)
+
+    print(f'write artefacts.json: {len(queue)} variants compressed in '
+          f'{time.monotonic() - start:.1f}s')
+    for name, info in manifest.items():
+        print(f'  {info["file"]:24} {info["size"] / 1024:10.1f} KiB'
+              + ''.join(f'  {x} {info[x] / 1024:9.1f} KiB'
+                        f' ({info[x] / (info["size"] or 1):6.1%})'
+                        for x in encodings))
+
+
+def _compressArtefact(args: 'tuple[str, str]') -> 'tuple[str, str, int]':
+    fname, encoding = args
+    data = (CACHE_DIR / fname).read_bytes()
+    if encoding == 'br':
+        data = brotli.compress(data, quality=11)
+    else:  # mtime=0: same input, same output
+        data = gzip.compress(data, compresslevel=9, mtime=0)
+    _writeAtomic(CACHE_DIR / (fname + ARTEFACT_ENCODINGS[encoding]), data)
+    return fname, encoding, len(data)
+
+
+def _writeAtomic(path: Path, data: bytes) -> None:
+    ''' Never leave a partial file (existing variants are skipped) '''
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+
+
+###############################################
+# [json] Trigram search index
+###############################################
+
+# data/search.idx (uses the array/strings encoding of ipa.pack):
+#   magic, uint32 row count, trigrams (strings, sorted),
+#   posting offsets (array, one more than trigrams), postings blob.
+#   A posting list holds the varint-encoded deltas of ipa.json row offsets
+#   whose lowercased title, bundle_id or path_name contain the trigram.
+SEARCH_MAGIC = b'IPATRI\x00\x01'
+
+
+def buildSearchIndex(fields: 'list[tuple[str, ...]]') -> bytes:
+    ''' :fields: `SearchIndex.fields()` for each row in ipa.json order '''
+    postings = {}  # type: dict[str, list[int]]
+    for i, values in enumerate(fields):
+        grams = set()
+        for value in values:
+            grams.update(value[k:k + 3] for k in range(len(value) - 2))
+        for gram in grams:
+            postings.setdefault(gram, []).append(i)
+
+    trigrams = sorted(postings)
+    offsets = [0]
+    blob = bytearray()
+    for gram in trigrams:
+        prev = 0
+        for i in postings[gram]:
+            _writeVarint(blob, i - prev)
+            prev = i
+        offsets.append(len(blob))
+    return SEARCH_MAGIC + struct.pack('<I', len(fields)) \
+        + _packStrings(trigrams) + _packArray(offsets) + bytes(blob)
+
+
+class SearchIndex:
+    '''
+    Reader for `data/search.idx`. `search()` returns the same rows as the
+    search term filter of `applySearch()` in script.js.
+    '''
+    # stop intersecting and verify candidates directly
+    VERIFY_THRESHOLD = 64
+
+    def __init__(self, data: bytes, rows: 'list[list]') -> None:
+        if data[:len(SEARCH_MAGIC)] != SEARCH_MAGIC:
+            raise ValueError('Not a search.idx file')
+        offset = len(SEARCH_MAGIC)
+        total, = struct.unpack_from('<I', data, offset)
+        if total != len(rows):
+            raise ValueError('search.idx does not match ipa.json')
+        trigrams, offset = _unpackStrings(data, offset + 4)
+        ends, offset = _unpackArray(data, offset)
+        self._postings = {gram: (offset + ends[i], offset + ends[i + 1])
+                          for i, gram in enumerate(trigrams)}
+        self._data = data
+        self._fields = [self.fields(x) for x in rows]
+
+    @staticmethod
+    def fields(entry: 'list|tuple') -> 'tuple[str, str, str]':
+        ''' Searchable columns: title, bundle_id, path_name (lowercase) '''
+        return (entry[3].lower(), entry[4].lower(), entry[7].lower())
+
+    def search(self, term: str) -> 'list[int]':
+        ''' :returns: Row offsets (ipa.json order) matching `term` '''
+        term = term.lower()
+        if len(term) < 3:
+            return self.scan(term)
+        grams = set(term[k:k + 3] for k in range(len(term) - 2))
+        if any(x not in self._postings for x in grams):
+            return []
+        # shortest posting lists first
+        ranges = sorted((self._postings[x] for x in grams),
+                        key=lambda x: x[1] - x[0])
+        candidates = None  # type: set[int]|None
+        for start, end in ranges:
+            if candidates is not None and \
+                    len(candidates) <= self.VERIFY_THRESHOLD:
+                break
+            rows = _readVarintDeltas(self._data, start, end)
+            candidates = set(rows) if candidates is None \
+                else candidates.intersection(rows)
+        return [i for i in sorted(candidates or [])
+                if any(term in x for x in self._fields[i])]
+
+    def scan(self, term: str) -> 'list[int]':
+        ''' Linear scan over all rows (same as script.js) '''
+        term = term.lower()
+        return [i for i, values in enumerate(self._fields)
+                if any(term in x for x in values)]
+
+
+def _writeVarint(buffer: bytearray, value: int) -> None:
+    while value > 0x7F:
+        buffer.append(0x80 | (value & 0x7F))
+        value >>= 7
+    buffer.append(value)
+
+
+def _readVarintDeltas(data: bytes, start: int, end: int) -> 'list[int]':
+    rv = []
+    prev = 0
+    value = 0
+    shift = 0
+    for byte in data[start:end]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            prev += value
+            rv.append(prev)
+            value = 0
+            shift = 0
+    return rv
+
+
+###############################################
+# [packed] Export to columnar binary
+###############################################
+
+# data/ipa.pack (all integers little-endian):
+#   magic, uint32 row count, url ids (array), urls (strings)
+#   followed by one block per column (same order as ipa.json entries):
+#     uint:  array(values)
+#     uint0: array(values), 0 is null
+#     dict:  strings(dictionary), array(index), index 0 is null
+#     front: array(shared chars with previous row), strings(suffix)
+#   array:   uint8 width, uint32 count, count * width bytes
+#   strings: array(char length), uint32 byte length, concatenated utf-8
+PACK_MAGIC = b'IPAPACK\x01'
+PACK_COLUMNS = [
+    ('pk', 'uint'), ('platform', 'uint0'), ('min_os', 'uint'),
+    ('title', 'front'), ('bundle_id', 'dict'), ('version', 'dict'),
+    ('base_url', 'uint'), ('path_name', 'front'), ('size', 'uint'),
+]
+_PACK_WIDTH = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+def export_packed():
+    DB = CacheDB()
+    url_map = DB.jsonUrlMap()
+    rows = list(withSubdirUrls(DB.enumJsonIpa(done=1), url_map))
+    data = packRows(rows, url_map)
+    with open(CACHE_DIR / 'ipa.pack', 'wb') as fp:
+        fp.write(data)
+    print(f'write ipa.pack: {len(rows)} entries, {len(data)} bytes')
+
+
+def packRows(rows: 'list[list|tuple]', url_map: 'dict[int, str]') -> bytes:
+    ''' Encode `ipa.json` rows and `urls.json` map into columnar binary. '''
+    url_ids = sorted(url_map)
+    rv = bytearray(PACK_MAGIC)
+    rv += struct.pack('<I', len(rows))
+    rv += _packArray(url_ids)
+    rv += _packStrings(url_map[x] for x in url_ids)
+    for col, (_, kind) in enumerate(PACK_COLUMNS):
+        values = [row[col] for row in rows]
+        if kind == 'uint':
+            rv += _packArray(values)
+        elif kind == 'uint0':
+            rv += _packArray([x or 0 for x in values])
+        elif kind == 'dict':
+            lookup = {None: 0}  # type: dict[str|None, int]
+            index = [lookup.setdefault(x, len(lookup)) for x in values]
+            rv += _packStrings(list(lookup)[1:])
+            rv += _packArray(index)
+        elif kind == 'front':
+            prefix = []
+            suffix = []
+            prev = ''
+            for value in values:
+                n = len(os.path.commonprefix([prev, value]))
+                prefix.append(n)
+                suffix.append(value[n:])
+                prev = value
+            rv += _packArray(prefix)
+            rv += _packStrings(suffix)
+    return bytes(rv)
+
+
+def unpackRows(data: bytes) -> 'tuple[list[list], dict[int, str]]':
+    ''' Reference decoder for `packRows()`. Returns `(rows, url_map)` '''
+    if data[:len(PACK_MAGIC)] != PACK_MAGIC:
+        raise ValueError('Not an ipa.pack file')
+    offset = len(PACK_MAGIC)
+    total, = struct.unpack_from('<I', data, offset)
+    url_ids, offset = _unpackArray(data, offset + 4)
+    urls, offset = _unpackStrings(data, offset)
+    url_map = dict(zip(url_ids, urls))
+
+    columns = []
+    for _, kind in PACK_COLUMNS:
+        if kind == 'uint':
+            values, offset = _unpackArray(data, offset)
+        elif kind == 'uint0':
+            values, offset = _unpackArray(data, offset)
+            values = [x or None for x in values]
+        elif kind == 'dict':
+            lookup, offset = _unpackStrings(data, offset)
+            lookup.insert(0, None)
+            index, offset = _unpackArray(data, offset)
+            values = [lookup[x] for x in index]
+        elif kind == 'front':
+            prefix, offset = _unpackArray(data, offset)
+            suffix, offset = _unpackStrings(data, offset)
+            values = []
+            prev = ''
+            for n, tail in zip(prefix, suffix):
+                prev = prev[:n] + tail
+                values.append(prev)
+        if len(values) != total:
+            raise ValueError('Corrupt ipa.pack file')
+        columns.append(values)
+    return [list(x) for x in zip(*columns)], url_map
+
+
+def _packArray(values: 'list[int]') -> bytes:
+    maxValue = max(values, default=0)
+    width = next(w for w in _PACK_WIDTH if maxValue < 1 << (8 * w))
+    return struct.pack(f'<BI{len(values)}{_PACK_WIDTH[width]}',
+                       width, len(values), *values)
+
+
+def _unpackArray(data: bytes, offset: int) -> 'tuple[list[int], int]':
+    width, count = struct.unpack_from('<BI', data, offset)
+    offset += 5
+    values = struct.unpack_from(f'<{count}{_PACK_WIDTH[width]}', data, offset)
+    return list(values), offset + count * width
+
+
+def _packStrings(strings: 'Iterable[str]') -> bytes:
+    strings = list(strings)
+    blob = ''.join(strings).encode('utf-8')
+    return _packArray([len(x) for x in strings]) \
+        + struct.pack('<I', len(blob)) + blob
+
+
+def _unpackStrings(data: bytes, offset: int) -> 'tuple[list[str], int]':
+    lengths, offset = _unpackArray(data, offset)
+    size, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    text = data[offset:offset + size].decode('utf-8')
+    ends = list(accumulate(lengths))
+    return [text[i:k] for i, k in zip([0] + ends, ends)], offset + size
+
+
+###############################################
+# [get] Segmented ipa download
+###############################################
+
+DOWNLOAD_SEGMENT_SIZE = 8 * 1024 * 1024
+
+
+def downloadIpas(pks: 'list[int]', dir: Path, *, workers: int = 8) -> None:
+    '''
+    Download ipa files in parallel byte-range segments. Progress is stored
+    in a `.part.json` sidecar so interrupted downloads can resume.
+    Finished files are verified with the crc32 of the archive.org listing.
+    '''
+    DB = CacheDB()
+    downloads = []
+    for pk in pks:
+        baseUrlId, path_name, fsize, crc32 = DB.getIpaFile(pk)
+        url = DB.getUrl(pk)
+        print(pk, ': load ipa', url)
+        if fsize <= 0:  # size unknown, cannot split into segments
+            urlretrieve(url, dir / f'{pk}.ipa', printProgress)
+            print(end='\r')
+            continue
+        downloads.append(SegmentedDownload(
+            pk, url, dir / f'{pk}.ipa', fsize,
+            crc32 or lookupCrc32(baseUrlId, path_name)))
+
+    total = sum(x.size for x in downloads)
+    loaded = sum(x.loaded for x in downloads)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for download in downloads:
+            if not download.pending:  # interrupted before verification
+                download.finish()
+            for segment in download.pending:
+                futures[pool.submit(download.fetch, segment)] = \
+                    (download, segment)
+        for future in as_completed(futures):
+            download, segment = futures[future]
+            try:
+                loaded += future.result()
+            except Exception as e:
+                print(f'\r[{download.uid}] segment {segment}: {e}',
+                      file=stderr)
+                download.failed = True
+                continue
+            download.markDone(segment)
+            printProgress(loaded, 1, total)
+            if not download.pending:
+                print(end='\r')
+                download.finish()
+    for download in downloads:
+        if download.failed:
+            print(f'[{download.uid}] incomplete. Run again to resume.',
+                  file=stderr)
+
+
+def lookupCrc32(baseUrlId: int, path_name: str) -> 'str|None':
+    ''' Fallback for rows added before crc32 was stored in `idx` '''
+    json_file = pathToListJson(baseUrlId)
+    if not json_file.exists():
+        return None
+    for name, _, crc in readListArchiveOrg(json_file):
+        if name == path_name:
+            return crc
+    return None
+
+
+class SegmentedDownload:
+    def __init__(self, uid: int, url: str, dest: Path, size: int,
+                 crc32: 'str|None') -> None:
+        self.uid = uid
+        self.url = url
+        self.dest = dest
+        self.size = size
+        self.crc32 = crc32
+        self.failed = False
+        self._part = dest.with_suffix('.ipa.part')
+        self._state_file = dest.with_suffix('.ipa.part.json')
+        self._state = {'url': url, 'size': size,
+                       'segment': DOWNLOAD_SEGMENT_SIZE, 'done': []}
+        count = -(-size // DOWNLOAD_SEGMENT_SIZE)  # ceil
+        if not self._resume():
+            with open(self._part, 'wb') as fp:
+                fp.truncate(size)
+        self.pending = set(range(count)) - set(self._state['done'])
+
+    def _resume(self) -> bool:
+        ''' Load previous state if the download parameters still match. '''
+        if not self._state_file.exists() or not self._part.exists():
+            return False
+        with open(self._state_file, 'r') as fp:
+            state = json.load(fp)
+        if {**state, 'done': []} != self._state:
+            return False
+        self._state = state
+        return True
+
+    @property
+    def loaded(self) -> int:
+        return sum(len(self._range(x)) for x in self._state['done'])
+
+    def _range(self, segment: int) -> range:
+        start = segment * DOWNLOAD_SEGMENT_SIZE
+        return range(start, min(start + DOWNLOAD_SEGMENT_SIZE, self.size))
+
+    def fetch(self, segment: int) -> int:
+        ''' Download a single segment (thread-safe). :returns: bytes '''
+        rng = self._range(segment)
+        url, chunks = fetchRanges(self.url, [(rng.start, rng.stop - 1)])
+        self.url = url  # skip redirect for remaining segments
+        data = chunks[0][1]
+        if len(data) != len(rng):
+            raise ValueError(f'got {len(data)} of {len(rng)} bytes')
+        with open(self._part, 'r+b') as fp:
+            fp.seek(rng.start)
+            fp.write(data)
+        return len(data)
+
+    def markDone(self, segment: int) -> None:
+        self.pending.discard(segment)
+        self._state['done'].append(segment)
+        with open(self._state_file, 'w') as fp:
+            json.dump(self._state, fp)
+
+    def finish(self) -> None:
+        if self.failed:
+            return
+        if self.crc32:
+            crc = 0
+            with open(self._part, 'rb') as fp:
+                while True:
+                    block = fp.read(1 << 20)
+                    if not block:
+                        break
+                    crc = zlib.crc32(block, crc)
+            if f'{crc:08x}' != self.crc32.lower():
+                print(f'[{self.uid}] crc32 mismatch ({crc:08x} != '
+                      f'{self.crc32}). Removing download.', file=stderr)
+                os.remove(self._part)
+                os.remove(self._state_file)
+                return
+        os.replace(self._part, self.dest)
+        os.remove(self._state_file)
+        print(f'[{self.uid}] saved {self.dest}'
+              + ('' if self.crc32 else ' (no crc32 to verify)'))
+
+
+###############################################
+# [optimize-images] Convert icons to jpg
+###############################################
+
+def optimizeImages(*, maxSize: int = 128, processes: int = 4) -> None:
+    '''
+    Downscale all `.png` icons to `.jpg` and remove the `.png`.
+    Works with both, file and pack storage (the pool only decodes, this
+    process is the single writer).
+    '''
+    if Image is None:
+        print('[ERROR] optimize-images requires Pillow (pip install Pillow)',
+              file=stderr)
+        return
+    store = blobStore()
+    queue = []
+    skipped = 0
+    for uid, ext in store.keys():
+        if ext == '.png':
+            if store.isNewer(uid, '.jpg', '.png'):
+                skipped += 1  # already converted (e.g., by image_optim.sh)
+            else:
+                queue.append(uid)
+    if not queue:
+        print(f'Nothing to do. {skipped} skipped (.jpg is newer)')
+        return
+
+    start = time.monotonic()
+    failed = 0
+    with Pool(processes=processes) as pool:
+        for i, (uid, jpg, error) in enumerate(pool.imap_unordered(
+                _optimizeImage, ((x, maxSize) for x in queue), chunksize=8)):
+            if error:
+                failed += 1
+                print(f'\rERROR: [{uid}] {error}', file=stderr)
+            else:
+                store.write(uid, '.jpg', jpg)
+                store.delete(uid, '.png')
+            if i % 23 == 0:
+                print(f'\r[{i + 1}/{len(queue)}] images', end='')
+    elapsed = time.monotonic() - start
+    print(f'\r{len(queue) - failed} images in {elapsed:.1f}s'
+          f' ({len(queue) / elapsed:.1f} images/s). {skipped} skipped'
+          f' (.jpg is newer), {failed} failed')
+
+
+def _optimizeImage(args: 'tuple[int, int]') \
+        -> 'tuple[int, bytes|None, str|None]':
+    uid, maxSize = args
+    try:
+        data, premultiplied = normalizeCgbiPng(blobStore().read(uid, '.png'))
+        with Image.open(BytesIO(data)) as img:
+            if img.mode in ('P', 'LA', 'PA'):
+                img = img.convert('RGBA')
+            if img.mode == 'RGBA' and not premultiplied:
+                # same as premultiplied alpha (on black background)
+                bg = Image.new('RGBA', img.size, (0, 0, 0, 255))
+                img = Image.alpha_composite(bg, img)
+            img = img.convert('RGB')
+            img.thumbnail((maxSize, maxSize), Image.LANCZOS)
+            rv = BytesIO()
+            img.save(rv, 'JPEG', quality=85, optimize=True, progressive=True)
+        return uid, rv.getvalue(), None
+    except Exception as e:
+        return uid, None, str(e) or type(e).__name__
+
+
+def normalizeCgbiPng(data: bytes) -> 'tuple[bytes, bool]':
+    '''
+    Convert Apple's CgBI-"optimized" png (raw deflate, BGRA) into a regular
+    png. Pixel values stay premultiplied by alpha.
+    :returns: `(png_data, was_cgbi)`
+    '''
+    if data[12:16] != b'CgBI':
+        return data, False
+    chunks = []  # type: list[tuple[bytes, bytes]]
+    idat = b''
+    pos = 8
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack_from('>L4s', data, pos)
+        body = data[pos + 8:pos + 8 + size]
+        pos += 12 + size
+        if kind == b'IDAT':
+            idat += body
+        elif kind != b'CgBI':
+            chunks.append((kind, body))
+        if kind == b'IEND':
+            break
+
+    width, height, depth, color, _, _, interlace = \
+        struct.unpack('>LLBBBBB', chunks[0][1])
+    if depth != 8 or color != 6 or interlace:
+        raise ValueError('unsupported CgBI png format')
+    raw = bytearray(zlib.decompressobj(-15).decompress(idat))
+    # swap BGRA -> RGBA. Filters work per channel, so no need to unfilter
+    stride = width * 4 + 1
+    for y in range(height):
+        row = y * stride + 1
+        raw[row:row + stride - 1:4], raw[row + 2:row + stride - 1:4] = \
+            raw[row + 2:row + stride - 1:4], raw[row:row + stride - 1:4]
+
+    rv = bytearray(data[:8])
+    for kind, body in chunks:
+        if kind == b'IEND':
+            rv += _pngChunk(b'IDAT', zlib.compress(bytes(raw)))
+        rv += _pngChunk(kind, body)
+    return bytes(rv), True
+
+
+def _pngChunk(kind: bytes, body: bytes) -> bytes:
+    return struct.pack('>L4s', len(body), kind) + body \
+        + struct.pack('>L', zlib.crc32(kind + body))
+
+
+###############################################
+# Blob storage (plist & images)
+###############################################
+# data/pack/ (used instead of data/<bucket>/ if the folder exists):
+#   NNNNN.pack: concatenated file contents (append-only)
+#   index: magic, followed by fixed-size records
+#     uint32 uid, uint8 extension, uint16 pack number, uint64 offset,
+#     uint32 length (all little-endian). The last record of a (uid, ext)
+#     wins. Pack number 0xFFFF marks a deleted entry.
+
+BLOB_EXTENSIONS = ('.plist', '.png', '.jpg')
+PACK_DIR = CACHE_DIR / 'pack'
+PACK_TMP_DIR = CACHE_DIR / 'pack.tmp'  # incomplete copy (source intact)
+PACK_NEW_DIR = CACHE_DIR / 'pack.new'  # complete copy, not yet in place
+PACK_OLD_DIR = CACHE_DIR / 'pack.old'  # replaced, to be deleted
+PACK_MAGIC_INDEX = b'IPABLOB\x01'
+PACK_RECORD = struct.Struct('<IBHQI')
+PACK_DELETED = 0xFFFF
+PACK_FILE_SIZE = 256 * 1024 * 1024  # start a new pack file after this size
+_BLOB_STORE = None  # type: FileStore|PackStore|None
+
+
+def blobStore() -> 'FileStore|PackStore':
+    ''' Packed storage if `data/pack/` exists, else one file per blob. '''
+    global _BLOB_STORE
+    if _BLOB_STORE is None:
+        _BLOB_STORE = PackStore(PACK_DIR) if PACK_DIR.is_dir() \
+            else FileStore(CACHE_DIR)
+    return _BLOB_STORE
+
+
+class FileStore:
+    ''' One file per blob: `<root>/<uid // 1000>/<uid><ext>` '''
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    def path(self, uid: int, ext: str) -> Path:
+        return self.root / str(uid // 1000) / f'{uid}{ext}'
+
+    def exists(self, uid: int, ext: str) -> bool:
+        return self.path(uid, ext).exists()
+
+    def read(self, uid: int, ext: str) -> 'bytes|None':
+        try:
+            with open(self.path(uid, ext), 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def isNewer(self, uid: int, ext: str, than: str) -> bool:
+        ''' :returns: True if blob `ext` was written after blob `than` '''
+        try:
+            return self.path(uid, ext).stat().st_mtime \
+                >= self.path(uid, than).stat().st_mtime
+        except FileNotFoundError:
+            return False
+
+    def write(self, uid: int, ext: str, data: bytes) -> None:
+        fname = self.path(uid, ext)
+        fname.parent.mkdir(exist_ok=True)
+        with open(fname, 'wb') as fp:
+            fp.write(data)
+
+    def delete(self, uid: int, ext: str) -> None:
+        fname = self.path(uid, ext)
+        if fname.exists():
+            os.remove(fname)
+
+    def copy(self, srcUid: int, uid: int) -> None:
+        for ext in BLOB_EXTENSIONS:
+            src = self.path(srcUid, ext)
+            if src.exists():
+                dest = self.path(uid, ext)
+                dest.parent.mkdir(exist_ok=True)
+                shutil.copyfile(src, dest)
+
+    def keys(self) -> 'list[tuple[int, str]]':
+        ''' :returns: sorted list of `(uid, ext)` '''
+        rv = []
+        for fname in self.root.glob('*/*'):
+            if fname.suffix in BLOB_EXTENSIONS and fname.stem.isdigit() \
+                    and fname.parent.name.isdigit():
+                rv.append((int(fname.stem), fname.suffix))
+        return sorted(rv)
+
+
+class PackStore:
+    '''
+    Append-only pack files plus index, read via mmap. Writes are serialized
+    with a file lock on the index, so multiple processes can write at once.
+    '''
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        root.mkdir(exist_ok=True)
+        self._indexPath = root / 'index'
+        if not self._indexPath.exists():
+            with open(self._indexPath, 'wb') as fp:
+                fp.write(PACK_MAGIC_INDEX)
+        with open(self._indexPath, 'rb') as fp:
+            if fp.read(len(PACK_MAGIC_INDEX)) != PACK_MAGIC_INDEX:
+                raise ValueError(f'{self._indexPath} is not a pack index')
+        self._index = {}  # type: dict[tuple[int, int], tuple[int, int, int]]
+        self._indexPos = len(PACK_MAGIC_INDEX)
+        self._maps = {}  # type: dict[int, mmap.mmap]
+        self._refresh()
+
+    def _refresh(self) -> None:
+        ''' Load records appended (by any process) since last call. '''
+        if self._indexPath.stat().st_size - self._indexPos < PACK_RECORD.size:
+            return
+        with open(self._indexPath, 'rb') as fp:
+            fp.seek(self._indexPos)
+            data = fp.read()
+        # ignore incomplete record (interrupted write)
+        data = data[:len(data) - len(data) % PACK_RECORD.size]
+        for uid, ext, pack, offset, size in PACK_RECORD.iter_unpack(data):
+            if pack == PACK_DELETED:
+                self._index.pop((uid, ext), None)
+            else:
+                self._index[uid, ext] = (pack, offset, size)
+        self._indexPos += len(data)
+
+    def _pack(self, pack: int) -> Path:
+        return self.root / f'{pack:05d}.pack'
+
+    @contextmanager
+    def _locked(self):
+        ''' Exclusive write access. Yields index file handle. '''
+        with open(self._indexPath, 'ab') as fp:
+            if fcntl:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                if os.fstat(fp.fileno()).st_size > self._indexPos:
+                    fp.truncate(self._indexPos)  # drop incomplete record
+                yield fp
+            finally:
+                if fcntl:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _append(self, fp, records: 'list[tuple[int, int, int, int, int]]') \
+            -> None:
+        fp.write(b''.join(PACK_RECORD.pack(*x) for x in records))
+        fp.flush()
+        self._refresh()
+
+    def exists(self, uid: int, ext: str) -> bool:
+        key = (uid, BLOB_EXTENSIONS.index(ext))
+        if key not in self._index:
+            self._refresh()
+        return key in self._index
+
+    def read(self, uid: int, ext: str) -> 'bytes|None':
+        if not self.exists(uid, ext):
+            return None
+        pack, offset, size = self._index[uid, BLOB_EXTENSIONS.index(ext)]
+        if not size:
+            return b''
+        mm = self._maps.get(pack)
+        if mm is None or len(mm) < offset + size:  # pack file has grown
+            if mm is not None:
+                mm.close()
+            with open(self._pack(pack), 'rb') as fp:
+                mm = self._maps[pack] = mmap.mmap(
+                    fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return mm[offset:offset + size]
+
+    def isNewer(self, uid: int, ext: str, than: str) -> bool:
+        ''' Append-only: later writes have a higher `(pack, offset)` '''
+        if not self.exists(uid, ext) or not self.exists(uid, than):
+            return False
+        a = self._index[uid, BLOB_EXTENSIONS.index(ext)]
+        b = self._index[uid, BLOB_EXTENSIONS.index(than)]
+        return a[:2] >= b[:2]
+
+    def write(self, uid: int, ext: str, data: bytes) -> None:
+        with self._locked() as fp:
+            pack = max((int(x.stem) for x in self.root.glob('*.pack')),
+                       default=0)
+            if self._pack(pack).exists() \
+                    and self._pack(pack).stat().st_size >= PACK_FILE_SIZE:
+                pack += 1
+            with open(self._pack(pack), 'ab') as fp_pack:
+                offset = fp_pack.tell()
+                fp_pack.write(data)
+            # record is written after data. Interrupted writes leave no trace
+            self._append(fp, [(uid, BLOB_EXTENSIONS.index(ext), pack, offset,
+                               len(data))])
+
+    def delete(self, uid: int, ext: str) -> None:
+        if self.exists(uid, ext):
+            with self._locked() as fp:
+                self._append(fp, [(uid, BLOB_EXTENSIONS.index(ext),
+                                   PACK_DELETED, 0, 0)])
+
+    def copy(self, srcUid: int, uid: int) -> None:
+        ''' Adds index records only. Both uids point to the same data. '''
+        with self._locked() as fp:
+            self._append(fp, [
+                (uid, ext, *self._index[srcUid, ext])
+                for ext in range(len(BLOB_EXTENSIONS))
+                if (srcUid, ext) in self._index])
+
+    def keys(self) -> 'list[tuple[int, str]]':
+        ''' :returns: sorted list of `(uid, ext)` '''
+        self._refresh()
+        return sorted((uid, BLOB_EXTENSIONS[ext]) for uid, ext in self._index)
+
+    def close(self) -> None:
+        for mm in self._maps.values():
+            mm.close()
+        self._maps.clear()
+
+
+def migrateBlobStore(target: str) -> None:
+    '''
+    Move all blobs to `pack` or `files` storage. Running `pack` on an
+    existing pack store will compact it (drop deleted and replaced data).
+    The source is only deleted after the copy is complete and in place.
+    '''
+    global _BLOB_STORE
+    src = blobStore()
+    if target == 'files' and isinstance(src, FileStore):
+        print('Nothing to do. Already using file storage.')
+        return
+    if PACK_TMP_DIR.exists():  # aborted copy, source is still complete
+        shutil.rmtree(PACK_TMP_DIR)
+    dest = PackStore(PACK_TMP_DIR) if target == 'pack' \
+        else FileStore(CACHE_DIR)
+
+    def writeOrder(key: 'tuple[int, str]') -> 'tuple[int, bool]':
+        ''' Keep which one of .png and .jpg is newer (`optimizeImages`) '''
+        uid, ext = key
+        if ext not in ('.png', '.jpg'):
+            return uid, False
+        newer = '.jpg' if src.isNewer(uid, '.jpg', '.png') else '.png'
+        return uid, ext == newer
+
+    keys = sorted(src.keys(), key=writeOrder)
+    size = 0
+    start = time.monotonic()
+    for i, (uid, ext) in enumerate(keys):
+        data = src.read(uid, ext)
+        if data is None:
+            raise RuntimeError(f'[{uid}] cannot read {ext} blob. Migration '
+                               'aborted, source storage is unchanged.')
+        size += len(data)
+        dest.write(uid, ext, data)
+        if i % 113 == 0:
+            print(f'\r[{i + 1}/{len(keys)}] blobs', end='')
+    print(f'\r{len(keys)} blobs ({size / 1024 / 1024:.1f} MiB)'
+          f' copied in {time.monotonic() - start:.1f}s')
+
+    if isinstance(src, PackStore):
+        src.close()
+    if isinstance(dest, PackStore):
+        dest.close()
+        os.rename(PACK_TMP_DIR, PACK_NEW_DIR)  # copy is complete
+    elif isinstance(src, PackStore):
+        os.rename(PACK_DIR, PACK_OLD_DIR)
+    recoverPackDir()  # move new pack in place, delete old one
+    if isinstance(src, FileStore):
+        for uid, ext in keys:
+            src.delete(uid, ext)
+        for bucket in CACHE_DIR.iterdir():  # remove empty buckets
+            if bucket.name.isdigit() and not any(bucket.iterdir()):
+                bucket.rmdir()
+    _BLOB_STORE = None
+    print(f'Now using {target} storage.')
+
+
+def recoverPackDir() -> None:
+    '''
+    Finish an interrupted `migrate`: a complete `pack.new` replaces
+    `pack`, and `pack.old` is deleted once its replacement is in place.
+    '''
+    if PACK_NEW_DIR.is_dir():
+        if PACK_DIR.is_dir():
+            os.rename(PACK_DIR, PACK_OLD_DIR)
+        os.rename(PACK_NEW_DIR, PACK_DIR)
+    if PACK_OLD_DIR.is_dir():
+        shutil.rmtree(PACK_OLD_DIR)
+
+
+def export_files(dir: Path, extensions: 'Iterable[str]') -> None:
+    '''
+    Materialize the per-file layout (`<dir>/<uid // 1000>/<uid><ext>`),
+    e.g., for the static web page. Unchanged files are not rewritten.
+    '''
+    store = blobStore()
+    if isinstance(store, FileStore) and store.root.resolve() == dir.resolve():
+        print('Nothing to do. Files are stored in this directory already.')
+        return
+    dir.mkdir(parents=True, exist_ok=True)
+    dest = FileStore(dir)
+    written = 0
+    unchanged = 0
+    for i, (uid, ext) in enumerate(store.keys()):
+        if ext not in extensions:
+            continue
+        data = store.read(uid, ext) or b''
+        if dest.read(uid, ext) == data:
+            unchanged += 1
+        else:
+            dest.write(uid, ext, data)
+            written += 1
+        if i % 113 == 0:
+            print(f'\r{written} files written. {unchanged} unchanged', end='')
+    print(f'\r{written} files written. {unchanged} unchanged. done.')
+
+
 ###############################################
 # Helper
 ###############################################
@@ -734,6 +4345,14 @@ def diskPath(uid: int, ext: str) -> Path:
     return CACHE_DIR / str(uid // 1000) / f'{uid}{ext}'
 
 
+def deleteCacheFiles(uids: 'Iterable[int]') -> None:
+    ''' Delete all plist, and image files for each uid in blob storage '''
+    store = blobStore()
+    for uid in uids:
+        for ext in BLOB_EXTENSIONS:
+            store.delete(uid, ext)
+
+
 def printProgress(blocknum, bs, size):
     if size == 0:
         return
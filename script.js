@@ -35,11 +35,39 @@ function loadDB() {
     } catch (error) {
         alert(error);
     }
+    loadFile('data/ipa/manifest.json', setMessage, function (data) {
+        // written by `export json -incremental`, removed by full export
+        var manifest = null;
+        try {
+            manifest = JSON.parse(data);
+        } catch (error) {}
+        if (manifest && manifest.shards) {
+            loadDBShards(config, manifest);
+        } else {
+            loadDBArtefacts(config);
+        }
+    });
+}
+
+function loadDBArtefacts(config) {
+    loadFile('data/artefacts.json', setMessage, function (data) {
+        // content-hashed file names (cacheable), older exports have none
+        var files = {};
+        try {
+            files = JSON.parse(data);
+        } catch (error) {}
+        loadDBFiles(config, function (name) {
+            return 'data/' + (files[name] ? files[name].file : name);
+        });
+    });
+}
+
+function loadDBFiles(config, pathFn) {
     setMessage('Loading base-urls ...');
-    loadFile('data/urls.json', setMessage, function (data) {
+    loadFile(pathFn('urls.json'), setMessage, function (data) {
         baseUrls = JSON.parse(data);
         setMessage('Loading database ...');
-        loadFile('data/ipa.json', setMessage, function (data) {
+        loadFile(pathFn('ipa.json'), setMessage, function (data) {
             DB = JSON.parse(data);
             setMessage('ready. Links in database: ' + DB.length);
             if (config && (config.page > 0 || config.search || config.bundleid)) {
@@ -49,6 +77,54 @@ function loadDB() {
     });
 }
 
+function loadDBShards(config, manifest) {
+    baseUrls = manifest.urls;
+    const buckets = Object.keys(manifest.shards);
+    var parts = [];
+    var missing = buckets.length;
+    setMessage('Loading database ...');
+    if (missing === 0) {
+        DB = [];
+        setMessage('ready. Links in database: 0');
+    }
+    buckets.forEach(function (bucket) {
+        // content hash in query, unchanged shards stay cached
+        const url = 'data/ipa/' + bucket + '.json?' + manifest.shards[bucket].sha1;
+        loadFile(url, setMessage, function (data) {
+            parts.push(JSON.parse(data));
+            missing -= 1;
+            if (missing > 0) {
+                return;
+            }
+            DB = sortEntries([].concat.apply([], parts));
+            setMessage('ready. Links in database: ' + DB.length);
+            if (config && (config.page > 0 || config.search || config.bundleid)) {
+                searchIPA(true);
+            }
+        });
+    });
+}
+
+function sortEntries(entries) {
+    // same order as ipa.json: title (NOCASE), minOS, platform, version, pk
+    // NOCASE only folds ASCII. Strings compare by UTF-16 code units, but
+    // ipa.json by code points: move astral chars behind U+E000-U+FFFF
+    const keyed = entries.map(function (x) {
+        return [(x[3] || '').replace(/[A-Z]+/g, function (c) { return c.toLowerCase(); })
+            .replace(/[\uD800-\uDBFF][\uDC00-\uDFFF]/g, '\uFFFF$&'), x];
+    });
+    function cmp(a, b) {
+        return a === b ? 0 : (a === null ? -1 : (b === null ? 1 : (a < b ? -1 : 1)));
+    }
+    keyed.sort(function (a, b) {
+        const x = a[1];
+        const y = b[1];
+        return cmp(a[0], b[0]) || cmp(x[2], y[2]) || cmp(x[1], y[1])
+            || cmp(x[5], y[5]) || cmp(x[0], y[0]);
+    });
+    return keyed.map(function (x) { return x[1]; });
+}
+
 function loadConfig(chkServer) {
     if (!location.hash) {
         return; // keep default values
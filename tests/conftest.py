@@ -0,0 +1,114 @@
+'''
+Shared fixtures. Synthetic ipa files (see `tools/bench_crawler.py`) are
+served by `tools/fake_archive.py` in-process. Each test runs its own copy
+of `ipa_archive.py`, because the script keeps `data/` next to itself.
+'''
+from typing import Callable, Iterator
+from http.server import ThreadingHTTPServer
+from contextlib import closing
+from threading import Thread
+from pathlib import Path
+import subprocess
+import sqlite3
+import shutil
+import sys
+import os
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / 'tools'))
+sys.path.insert(0, str(ROOT))
+
+from fake_archive import FakeArchive  # noqa: E402
+from bench_crawler import generateCorpus  # noqa: E402
+
+# 2 items with 8 ipa files each, one per kind in `bench_crawler.KINDS`
+CORPUS_ITEMS = ['bench0', 'bench1']
+CORPUS_IPAS = 8
+LARGE_SIZE = 4 * 1024 * 1024
+# `broken` (cut off zip) and `no-payload` are errors, the rest is done
+EXPECTED_DONE = {1: 12, 3: 4}
+
+
+class Workdir:
+    ''' Copy of `ipa_archive.py` (with own `data/`) using `host` '''
+
+    def __init__(self, path: Path, host: str) -> None:
+        path.mkdir(parents=True)
+        shutil.copy(ROOT / 'ipa_archive.py', path / 'ipa_archive.py')
+        self.path = path
+        self.host = host
+        self.env = dict(os.environ, ARCHIVE_ORG=host)
+        self.env.pop('ARCHIVE_ORG_METADATA', None)
+
+    @property
+    def data(self) -> Path:
+        return self.path / 'data'
+
+    def itemUrl(self, name: str) -> str:
+        return f'{self.host}/details/{name}'
+
+    def __call__(self, *args: str, timeout: float = 120) -> str:
+        ''' Run `ipa_archive.py args`. :returns: stdout and stderr '''
+        proc = subprocess.run(
+            [sys.executable, 'ipa_archive.py', *args], cwd=self.path,
+            env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, timeout=timeout)
+        assert proc.returncode == 0, proc.stdout
+        return proc.stdout
+
+    def query(self, sql: str, params: 'list' = []) -> 'list[tuple]':
+        with closing(sqlite3.connect(self.data / 'ipa_cache.db')) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def doneStates(self) -> 'dict[int, int]':
+        return dict(self.query(
+            'SELECT done, COUNT() FROM idx GROUP BY done ORDER BY done'))
+
+    def blobs(self) -> 'dict[str, bytes]':
+        ''' :returns: all plist and image files (relative path: content) '''
+        return {x.relative_to(self.data).as_posix(): x.read_bytes()
+                for x in sorted(self.data.glob('[0-9]*/*'))}
+
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory) -> Path:
+    root = tmp_path_factory.mktemp('items')
+    generateCorpus(root, items=len(CORPUS_ITEMS), ipas=CORPUS_IPAS,
+                   largeSize=LARGE_SIZE)
+    return root
+
+
+@pytest.fixture
+def archive(corpus: Path, monkeypatch) -> 'Iterator[str]':
+    '''
+    Start `FakeArchive` serving `corpus`. Change its settings (`maxRps`,
+    `resetRate`, `root`, ...) with `monkeypatch`. :returns: base url
+    '''
+    monkeypatch.setattr(FakeArchive, 'root', corpus)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeArchive)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    FakeArchive.resetStats()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def newWork(tmp_path: Path, archive: str) -> 'Callable[[str], Workdir]':
+    ''' :returns: factory for independent `Workdir`s '''
+    return lambda name: Workdir(tmp_path / name, archive)
+
+
+@pytest.fixture
+def work(newWork) -> Workdir:
+    return newWork('work')
+
+
+@pytest.fixture
+def added(work: Workdir) -> Workdir:
+    ''' `work` with all corpus items added (nothing processed yet) '''
+    work('add', *(work.itemUrl(x) for x in CORPUS_ITEMS))
+    return work
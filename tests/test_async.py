@@ -0,0 +1,36 @@
+'''
+`run -async` must produce the same files and done states as `run`
+(`loadIpa()`), see user-001.
+'''
+from fake_archive import FakeArchive
+
+from conftest import CORPUS_ITEMS, EXPECTED_DONE
+
+COLUMNS = 'pk, done, min_os, platform, title, bundle_id, version, fsize'
+
+
+def test_async_matches_sync(newWork):
+    results = []
+    for engine in [[], ['-async']]:
+        work = newWork('async' if engine else 'sync')
+        work('add', *(work.itemUrl(x) for x in CORPUS_ITEMS))
+        work('run', *engine)
+        assert work.doneStates() == EXPECTED_DONE
+        results.append((work.query(f'SELECT {COLUMNS} FROM idx ORDER BY pk'),
+                        work.blobs()))
+    (syncRows, syncBlobs), (asyncRows, asyncBlobs) = results
+    assert asyncRows == syncRows
+    assert asyncBlobs.keys() == syncBlobs.keys()
+    assert asyncBlobs == syncBlobs
+    # a plist and an image for each done entry
+    assert len(syncBlobs) == 2 * EXPECTED_DONE[1]
+
+
+def test_async_uses_range_requests(added, corpus):
+    FakeArchive.resetStats()
+    added('run', '-async', '-concurrency', '4', '-per-host', '2')
+    stats = FakeArchive.resetStats()
+    large = sum(x.stat().st_size for x in corpus.glob('*/large/*.ipa'))
+    # only central directories, Info.plist and icons (never whole ipas)
+    assert 0 < stats['download']['bytes'] < large / 2
+    assert added.doneStates() == EXPECTED_DONE
@@ -0,0 +1,50 @@
+'''
+`ipa.pack` must decode to the same rows and urls as `ipa.json` and
+`urls.json`, see user-006.
+'''
+import json
+
+import pytest
+
+from ipa_archive import PACK_MAGIC, packRows, unpackRows
+from conftest import EXPECTED_DONE
+
+
+def test_packed_matches_json_export(added):
+    added('run')
+    added('export', 'json')
+    added('export', 'packed')
+    with open(added.data / 'ipa.json') as fp:
+        expectedRows = json.load(fp)
+    with open(added.data / 'urls.json') as fp:
+        expectedUrls = {int(k): v for k, v in json.load(fp).items()}
+
+    rows, url_map = unpackRows((added.data / 'ipa.pack').read_bytes())
+    assert len(rows) == EXPECTED_DONE[1]
+    assert rows == expectedRows
+    assert url_map == expectedUrls
+    # corpus files are in subdirectories (e.g., `small/00008.ipa`)
+    assert all('/' not in x[7] for x in rows)
+    assert {url_map[x[6]].rsplit('/', 1)[-1] for x in rows} >= {'small'}
+
+
+def test_round_trip_edge_cases():
+    rows = [
+        [1, None, 0, '', None, None, 1, 'a.ipa', 0],
+        [2, 1, 100, 'Über App', 'org.x', '1.0', 1, 'a b.ipa', 255],
+        [3, 2, 170000, 'Über App 2 \U0001f600', 'org.x', '1.0', 2,
+         'a b 2.ipa', 1 << 40],
+        [1 << 33, 3, 70000, 'Ü', 'org.y', None, 2, 'ü.ipa', 65536],
+    ]
+    url_map = {1: 'https://archive.org/download/a', 2: 'ü', 7: '---'}
+    assert unpackRows(packRows(rows, url_map)) == (rows, url_map)
+    assert unpackRows(packRows([], {})) == ([], {})
+
+
+def test_invalid_data():
+    with pytest.raises(ValueError, match='Not an ipa.pack'):
+        unpackRows(b'[1,2,3]')
+    data = packRows([[1, 1, 1, 'a', 'b', 'c', 1, 'd', 1]], {1: 'x'})
+    with pytest.raises(ValueError, match='Corrupt'):
+        # pretend there are 2 rows
+        unpackRows(PACK_MAGIC + b'\x02' + data[len(PACK_MAGIC) + 1:])
@@ -0,0 +1,99 @@
+'''
+Throttling (HTTP 429) and connection resets are retried with backoff,
+broken ipa files are not, see user-019.
+'''
+from http.client import RemoteDisconnected
+from urllib.error import HTTPError, URLError
+from zipfile import BadZipFile
+import asyncio
+import random
+import time
+import re
+
+import pytest
+
+from fake_archive import FakeArchive
+from ipa_archive import classifyError
+from conftest import CORPUS_ITEMS, CORPUS_IPAS, EXPECTED_DONE
+
+ENGINES = pytest.mark.parametrize('engine', [[], ['-async']],
+                                  ids=['sync', 'async'])
+TOTAL = len(CORPUS_ITEMS) * CORPUS_IPAS
+
+
+@ENGINES
+def test_connection_resets_are_retried(added, engine, monkeypatch):
+    monkeypatch.setattr(FakeArchive, 'resetRate', 0.1)
+    random.seed(31)  # first download is dropped
+    FakeArchive.resetStats()
+    out = added('run', *engine, '-retry-delay', '0.1', '-max-attempts', '10')
+    assert FakeArchive.resetStats()['reset']['requests'] > 0
+    assert 'transient, retry 1/10' in out
+    assert added.doneStates() == EXPECTED_DONE
+    assert added.query('SELECT COUNT() FROM idx WHERE done=1 AND '
+                       '(attempts>0 OR next_attempt NOT NULL)') == [(0,)]
+
+
+@ENGINES
+def test_throttling_slows_down(added, engine, monkeypatch):
+    monkeypatch.setattr(FakeArchive, 'maxRps', 10)
+    FakeArchive.resetStats()
+    out = added('run', *engine, '-retry-delay', '0.1', '-max-attempts', '10',
+                '-max-rate', '20')
+    assert FakeArchive.resetStats()['throttled']['requests'] > 0
+    assert 'throttled, retry 1/10' in out
+    assert added.doneStates() == EXPECTED_DONE
+    # token bucket was halved and has not fully recovered
+    rate = re.search(r'Rate per host: \S+ ([\d.]+)/s', out)
+    assert rate and float(rate.group(1)) < 20
+
+
+@ENGINES
+def test_retries_exhausted(added, engine, monkeypatch):
+    monkeypatch.setattr(FakeArchive, 'resetRate', 1)
+    added('run', *engine, '-retry-delay', '0.1', '-max-attempts', '2')
+    assert added.doneStates() == {3: TOTAL}
+    assert added.query('SELECT attempts, next_attempt, COUNT() FROM idx '
+                       'GROUP BY 1, 2') == [(2, None, TOTAL)]
+
+
+@ENGINES
+def test_retry_queue_persists(added, engine, monkeypatch):
+    monkeypatch.setattr(FakeArchive, 'resetRate', 1)
+    start = time.time()
+    out = added('run', *engine, '-retry-delay', '600', '-max-wait', '1')
+    assert 'Nothing due within 1s' in out
+    assert time.time() - start < 60
+    assert added.doneStates() == {0: TOTAL}
+    rows = added.query('SELECT attempts, next_attempt FROM idx')
+    assert all(attempts == 1 and due > start + 400 for attempts, due in rows)
+
+    # next run skips rows which are not due yet
+    monkeypatch.setattr(FakeArchive, 'resetRate', 0)
+    FakeArchive.resetStats()
+    added('run', *engine, '-max-wait', '1')
+    assert 'download' not in FakeArchive.resetStats()
+    assert added.doneStates() == {0: TOTAL}
+
+
+def httpError(code: int, headers: 'dict[str, str]' = {}) -> HTTPError:
+    return HTTPError('http://x', code, 'msg', headers, None)
+
+
+@pytest.mark.parametrize('error, expected', [
+    (httpError(429, {'Retry-After': '7'}), ('throttled', 7)),
+    (httpError(503), ('throttled', 0)),
+    (httpError(502), ('transient', 0)),
+    (httpError(404), ('broken', 0)),
+    (ConnectionResetError(), ('transient', 0)),
+    (RemoteDisconnected(), ('transient', 0)),
+    (TimeoutError(), ('transient', 0)),
+    (asyncio.IncompleteReadError(b'', 10), ('transient', 0)),
+    (URLError(ConnectionRefusedError()), ('transient', 0)),
+    (URLError('unknown url type'), ('broken', 0)),
+    (BadZipFile(), ('broken', 0)),
+    (PermissionError(), ('broken', 0)),
+    (KeyError('Info.plist'), ('broken', 0)),
+])
+def test_classify_error(error, expected):
+    assert classifyError(error) == expected
@@ -0,0 +1,68 @@
+'''
+`add -search` pages through the scrape API and adds all items with ipa
+files in bulk, see user-022.
+'''
+from pathlib import Path
+import shutil
+
+import pytest
+
+from fake_archive import FakeArchive
+import ipa_archive
+
+ITEMS = ['bench0', 'bench1', 'bench2']
+
+
+@pytest.fixture
+def searchCorpus(tmp_path: Path, corpus: Path, monkeypatch) -> Path:
+    '''
+    Items `bench0-2` (one ipa each), `other` (not matching "bench") and
+    `benchdocs` (no ipa files).
+    '''
+    root = tmp_path / 'items'
+    for name in ITEMS + ['other']:
+        shutil.copytree(corpus / 'bench0' / 'icons', root / name / 'icons')
+    (root / 'benchdocs').mkdir()
+    (root / 'benchdocs' / 'readme.txt').write_text('no ipa here')
+    monkeypatch.setattr(FakeArchive, 'root', root)
+    return root
+
+
+def test_add_search(work, searchCorpus):
+    out = work('add', '-search', 'bench')
+    assert '4 new items found (0 known)' in out
+    assert 'collections/min: 3 added, 0 known, 1 no-ipa, 0 failed' in out
+    # inserted in order of completion
+    assert work.query('SELECT url FROM urls ORDER BY url') == [
+        (f'{work.host}/download/{x}',) for x in ITEMS]
+    assert work.query('SELECT base_url, path_name, done FROM idx '
+                      'ORDER BY base_url') == [
+        (pk, 'icons/00002.ipa', 0) for pk in [1, 2, 3]]
+    # file list and validators stored, no temporary files left
+    assert work.query('SELECT COUNT() FROM urls WHERE etag NOT NULL') \
+        == [(3,)]
+    assert sorted(x.name for x in (work.data / 'url_cache').iterdir()) == [
+        f'{pk}.{ext}' for pk in [1, 2, 3] for ext in ['json.gz', 'lst']]
+
+    work('run')
+    assert work.doneStates() == {1: 3}
+
+
+def test_add_search_again(work, searchCorpus):
+    work('add', '-search', 'bench')
+    FakeArchive.resetStats()
+    out = work('add', '-search', 'bench')
+    assert '1 new items found (3 known)' in out
+    assert 'collections/min: 0 added, 3 known, 1 no-ipa, 0 failed' in out
+    # only the item without ipa files is fetched again
+    assert FakeArchive.resetStats()['metadata']['requests'] == 1
+    assert work.query('SELECT COUNT() FROM idx') == [(3,)]
+
+
+def test_search_paging(archive, searchCorpus, monkeypatch):
+    monkeypatch.setattr(ipa_archive, 'ARCHIVE_ORG', archive)
+    FakeArchive.resetStats()
+    found = list(ipa_archive.searchArchiveOrg('bench', pageSize=3))
+    assert found == ITEMS + ['benchdocs']
+    assert FakeArchive.resetStats()['search']['requests'] == 2
+    assert list(ipa_archive.searchArchiveOrg('nothing')) == []
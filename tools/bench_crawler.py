@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''
+End-to-end benchmark of `ipa_archive.py` against `tools/fake_archive.py`.
+Generates synthetic ipa files (small, large, many entries, iTunesArtwork,
+plist-referenced icons, OpenStep plist, no Payload folder, broken zip),
+serves them with configurable latency, bandwidth, request rate limit (429)
+and connection resets, and times `add`, `run`, `update` (+ `run` again)
+and `export json` in a temporary copy.
+Results (seconds, requests, bytes transferred) are written as JSON.
+'''
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from threading import Thread
+from http.server import ThreadingHTTPServer
+from datetime import datetime, timezone
+from pathlib import Path
+from io import BytesIO
+import subprocess
+import plistlib
+import sqlite3
+import zipfile
+import random
+import shutil
+import struct
+import shlex
+import zlib
+import json
+import time
+import sys
+import os
+
+from fake_archive import FakeArchive
+
+ROOT = Path(__file__).parent.parent
+KINDS = ['small', 'artwork', 'icons', 'many', 'large', 'openstep',
+         'no-payload', 'broken']
+
+
+###############################################
+# Synthetic ipa files
+###############################################
+
+def makePng(size: int, seed: int) -> bytes:
+    ''' Valid RGBA png (solid color) '''
+    def chunk(kind: bytes, body: bytes) -> bytes:
+        return struct.pack('>L4s', len(body), kind) + body \
+            + struct.pack('>L', zlib.crc32(kind + body))
+    row = b'\x00' + bytes([seed % 256, 80, 160, 255]) * size
+    return b'\x89PNG\r\n\x1a\n' \
+        + chunk(b'IHDR', struct.pack('>LLBBBBB', size, size, 8, 6, 0, 0, 0)) \
+        + chunk(b'IDAT', zlib.compress(row * size)) + chunk(b'IEND', b'')
+
+
+def makeInfoPlist(kind: str, num: int) -> bytes:
+    info = {
+        'CFBundleIdentifier': f'org.bench.app{num}',
+        'CFBundleDisplayName': f'Bench App {num}',
+        'CFBundleShortVersionString': f'1.{num % 10}',
+        'CFBundleVersion': str(100 + num),
+        'MinimumOSVersion': f'{4 + num % 12}.0',
+        'UIDeviceFamily': [1, 2] if num % 2 else [1],
+    }
+    if kind == 'icons':
+        info['CFBundleIcons'] = {'CFBundlePrimaryIcon': {
+            'CFBundleIconFiles': ['AppIcon60x60', 'AppIcon40x40']}}
+    else:
+        info['CFBundleIconFile'] = 'Icon.png'
+    if kind == 'openstep':
+        lines = []
+        for key, value in info.items():
+            if isinstance(value, list):
+                value = '(' + ', '.join(str(x) for x in value) + ')'
+            else:
+                value = f'"{value}"'
+            lines.append(f'    {key} = {value};')
+        return ('{\n' + '\n'.join(lines) + '\n}\n').encode()
+    return plistlib.dumps(info)
+
+
+def makeIpa(kind: str, num: int, *, largeSize: int) -> bytes:
+    rnd = random.Random(num)
+    app = f'Payload/App{num}.app/'
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        if kind == 'artwork':
+            zf.writestr('iTunesArtwork', makePng(512, num))
+        if kind == 'large':  # incompressible binary in front of the plist
+            zf.writestr(app + f'App{num}', rnd.randbytes(largeSize),
+                        compress_type=zipfile.ZIP_STORED)
+        else:
+            zf.writestr(app + f'App{num}', rnd.randbytes(64 * 1024))
+        if kind == 'many':
+            for i in range(5000):
+                zf.writestr(app + f'res/{i}.dat', rnd.randbytes(32))
+        if kind == 'no-payload':
+            app = f'App{num}.app/'
+        zf.writestr(app + 'Info.plist', makeInfoPlist(kind, num))
+        if kind == 'icons':
+            for name in ['AppIcon60x60@2x.png', 'AppIcon60x60@3x.png',
+                         'AppIcon40x40@2x.png']:
+                zf.writestr(app + name, makePng(120, num))
+        else:
+            zf.writestr(app + 'Icon.png', makePng(57, num))
+        zf.writestr(app + '_CodeSignature/CodeResources', rnd.randbytes(2048))
+    data = buffer.getvalue()
+    if kind == 'broken':  # cut off central directory
+        return data[:len(data) * 2 // 3]
+    return data
+
+
+def generateCorpus(root: Path, *, items: int, ipas: int, largeSize: int) \
+        -> 'dict[str, int]':
+    num = 0
+    size = 0
+    for item in range(items):
+        for i in range(ipas):
+            num += 1
+            kind = KINDS[num % len(KINDS)]
+            data = makeIpa(kind, num, largeSize=largeSize)
+            fname = root / f'bench{item}' / f'{kind}/{num:05d}.ipa'
+            fname.parent.mkdir(parents=True, exist_ok=True)
+            fname.write_bytes(data)
+            size += len(data)
+    return {'items': items, 'ipas': num, 'bytes': size}
+
+
+def mutateCorpus(root: Path, *, largeSize: int) -> None:
+    ''' Per item: delete one, replace one and add one ipa '''
+    for item in sorted(root.iterdir()):
+        files = sorted(item.rglob('*.ipa'))
+        files[0].unlink()
+        files[1].write_bytes(makeIpa('small', 90000 + len(files),
+                                     largeSize=largeSize))
+        new = item / 'small' / f'new-{item.name}.ipa'
+        new.write_bytes(makeIpa('icons', 80000 + len(files),
+                                largeSize=largeSize))
+
+
+###############################################
+# Benchmark
+###############################################
+
+def step(name: str, args: 'list[str]', work: Path, env: 'dict[str, str]',
+         results: 'dict[str, dict]') -> None:
+    FakeArchive.resetStats()
+    start = time.perf_counter()
+    with open(work / f'{name}.log', 'w') as log:
+        proc = subprocess.run([sys.executable, 'ipa_archive.py', *args],
+                              cwd=work, env=env, stdout=log,
+                              stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - start
+    stats = FakeArchive.resetStats()
+    results[name] = {
+        'seconds': round(seconds, 3),
+        'requests': sum(x['requests'] for x in stats.values()),
+        'bytes': sum(x['bytes'] for x in stats.values()),
+        'exit': proc.returncode,
+        'transfer': stats,
+    }
+    print(f'{name:8} {seconds:8.2f}s {results[name]["requests"]:8} req'
+          f' {results[name]["bytes"] / 1024 / 1024:9.2f} MiB'
+          + (f'  (exit {proc.returncode}, see {name}.log)'
+             if proc.returncode else ''))
+
+
+def doneStates(db: Path) -> 'dict[str, int]':
+    with sqlite3.connect(db) as conn:
+        return {str(k): v for k, v in conn.execute(
+            'SELECT done, COUNT(*) FROM idx GROUP BY done ORDER BY done')}
+
+
+def gitRevision(script: Path) -> 'str|None':
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=script.parent,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print(f'\nvs. baseline ({baseline.get("git")}, {baseline.get("date")})')
+    for name, new in results['steps'].items():
+        old = baseline.get('steps', {}).get(name)
+        if not old:
+            continue
+        print(f'{name:8}' + ''.join(
+            f' {key} {new[key] / old[key] - 1:+7.1%}' if old[key] else
+            f' {key} {"n/a":>7}' for key in ['seconds', 'requests', 'bytes']))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-script', type=Path, default=ROOT / 'ipa_archive.py',
+                        help='ipa_archive.py to test (e.g., older revision)')
+    parser.add_argument('-items', type=int, default=4,
+                        help='Number of collections')
+    parser.add_argument('-ipas', type=int, default=40,
+                        help='Number of ipa files per collection')
+    parser.add_argument('-large-mb', type=float, default=20,
+                        help='Size of "large" ipa files (in MiB)')
+    parser.add_argument('-latency', type=float, default=0.02,
+                        help='Server delay per response (in seconds)')
+    parser.add_argument('-rate', type=int, default=0,
+                        help='Max. bytes per second and response')
+    parser.add_argument('-max-rps', type=float, default=0,
+                        help='Max. download requests per second (else 429)')
+    parser.add_argument('-reset-rate', type=float, default=0,
+                        help='Probability to drop a download connection')
+    parser.add_argument('-search', action='store_true',
+                        help='Discover items with `add -search` instead')
+    parser.add_argument('-run-args', default='',
+                        help='Extra arguments for run, e.g. "-async"')
+    parser.add_argument('-o', type=Path,
+                        default=Path.cwd() / 'bench_results.json',
+                        help='Results file (JSON)')
+    parser.add_argument('-baseline', type=Path,
+                        help='Compare with previous results file')
+    parser.add_argument('-keep', type=Path,
+                        help='Use this directory and keep files afterwards')
+    args = parser.parse_args()
+
+    tmp = TemporaryDirectory()
+    base = args.keep or Path(tmp.name)
+    if args.keep and base.exists():
+        shutil.rmtree(base)
+    corpus = base / 'items'
+    work = base / 'work'
+    work.mkdir(parents=True)
+    shutil.copy(args.script, work / 'ipa_archive.py')
+    largeSize = int(args.large_mb * 1024 * 1024)
+
+    start = time.perf_counter()
+    info = generateCorpus(corpus, items=args.items, ipas=args.ipas,
+                          largeSize=largeSize)
+    print(f'corpus: {info["ipas"]} ipa files in {info["items"]} items,'
+          f' {info["bytes"] / 1024 / 1024:.1f} MiB'
+          f' ({time.perf_counter() - start:.1f}s)')
+
+    FakeArchive.root = corpus
+    FakeArchive.latency = args.latency
+    FakeArchive.rate = args.rate
+    FakeArchive.maxRps = args.max_rps
+    FakeArchive.resetRate = args.reset_rate
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeArchive)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    host = f'http://127.0.0.1:{server.server_port}'
+    env = dict(os.environ, ARCHIVE_ORG=host)
+    env.pop('ARCHIVE_ORG_METADATA', None)
+
+    steps = {}  # type: dict[str, dict]
+    items = [f'{host}/details/{x.name}' for x in sorted(corpus.iterdir())]
+    step('add', ['add', '-search', 'bench'] if args.search else
+         ['add', *items], work, env, steps)
+    step('run', ['run', *shlex.split(args.run_args)], work, env, steps)
+    mutateCorpus(corpus, largeSize=largeSize)
+    step('update', ['update', *items], work, env, steps)
+    step('rerun', ['run', *shlex.split(args.run_args)], work, env, steps)
+    step('export', ['export', 'json'], work, env, steps)
+    server.shutdown()
+
+    results = {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git': gitRevision(args.script),
+        'config': {k: str(v) if isinstance(v, Path) else v
+                   for k, v in vars(args).items()},
+        'corpus': info,
+        'steps': steps,
+        'done': doneStates(work / 'data' / 'ipa_cache.db'),
+    }
+    print('done states:', results['done'])
+    with open(args.o, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print(f'results written to {args.o}')
+    if args.baseline:
+        with open(args.baseline) as fp:
+            compare(results, json.load(fp))
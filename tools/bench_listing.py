@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''
+Peak memory and time of a file list `update` on a synthetic archive.org
+listing: previous approach (`json.load` of old and new list, set diff)
+vs. streaming parser + compact sorted cache (`.lst`) + linear merge.
+Each variant runs in its own process (peak RSS is per process).
+'''
+from argparse import ArgumentParser, SUPPRESS
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import subprocess
+import resource
+import random
+import gzip
+import json
+import time
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ipa_archive import diffListCaches, readListArchiveOrg, \
+    readListCache, writeListCache  # noqa: E402
+
+
+def makeListing(dest: Path, count: int, *, seed: int, mutate: bool) -> None:
+    ''' archive.org-like listing, every 10th file is not an ipa '''
+    rnd = random.Random(seed)
+    with gzip.open(dest, 'wt', encoding='utf-8', compresslevel=1) as fp:
+        fp.write('{"result": [')
+        for i in range(count):
+            if mutate and i % 100 == 1:
+                continue  # removed
+            name = f'Apps/{i % 977}/App Number {i} (v1.{i % 10}).ipa'
+            size = 1024 * 1024 + i * 7
+            if i % 10 == 9:
+                name = name[:-4] + '.png'
+            if mutate and i % 100 == 2:
+                size += 1  # changed
+            entry = {
+                'name': name, 'source': 'original',
+                'mtime': str(1300000000 + i), 'size': str(size),
+                'md5': f'{rnd.getrandbits(128):032x}',
+                'crc32': f'{(i * 2654435761) & 0xFFFFFFFF:08x}',
+                'sha1': f'{rnd.getrandbits(160):040x}',
+                'format': 'Unknown',
+            }
+            fp.write((', ' if i else '') + json.dumps(entry))
+            if mutate and i % 100 == 3:
+                fp.write(', ' + json.dumps(dict(entry, name=f'new/{i}.ipa')))
+        fp.write('], "created": 1700000000, "files_count": %d}' % count)
+
+
+def oldReadList(json_file: Path) -> 'list[tuple[str, int, str]]':
+    ''' previous `readListArchiveOrg` '''
+    with gzip.open(json_file, 'rb') as fp:
+        data = json.load(fp)
+    return [(x['name'], int(x.get('size', 0)), x.get('crc32'))
+            for x in data['result']
+            if x['source'] == 'original' and x['name'].endswith('.ipa')]
+
+
+def variant(mode: str, work: Path) -> dict:
+    old_json, new_json = work / 'old.json.gz', work / 'new.json.gz'
+    old_list, new_list = work / 'old.lst', work / 'new.lst'
+    start = time.perf_counter()
+    changed = None
+    if mode == 'json':
+        old_entries = set(oldReadList(old_json))
+        new_entries = set(oldReadList(new_json))
+        changed = len(set(x[0] for x in new_entries - old_entries))
+    elif mode == 'cache':  # one-time, for lists downloaded before .lst
+        writeListCache(readListArchiveOrg(old_json), old_list)
+    elif mode == 'merge':
+        writeListCache(readListArchiveOrg(new_json), new_list)
+        changed = sum(1 for _, new in diffListCaches(
+            readListCache(old_list), readListCache(new_list)) if new)
+    return {
+        'seconds': time.perf_counter() - start,
+        'rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'changed': changed,
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', type=int, default=500_000,
+                        help='Number of files in listing')
+    # internal: run single variant in child process
+    parser.add_argument('-variant', choices=['none', 'json', 'cache', 'merge'],
+                        help=SUPPRESS)
+    parser.add_argument('-work', type=Path, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:  # child process
+        print(json.dumps(variant(args.variant, args.work)))
+        sys.exit(0)
+
+    tmp = TemporaryDirectory()
+    work = Path(tmp.name)
+    start = time.perf_counter()
+    makeListing(work / 'old.json.gz', args.n, seed=1, mutate=False)
+    makeListing(work / 'new.json.gz', args.n, seed=2, mutate=True)
+    print(f'listing: {args.n} files, '
+          f'{(work / "new.json.gz").stat().st_size / 1024 / 1024:.1f} MiB'
+          f' gzip ({time.perf_counter() - start:.1f}s)')
+
+    labels = {
+        'none': 'interpreter + imports',
+        'json': 'json.load old + new, set diff',
+        'cache': 'build .lst from old json (once)',
+        'merge': 'stream new json to .lst, merge diff',
+    }
+    for mode, label in labels.items():
+        out = subprocess.run(
+            [sys.executable, __file__, '-variant', mode, '-work', str(work)],
+            capture_output=True, text=True, check=True).stdout
+        res = json.loads(out)
+        changed = '' if res['changed'] is None else \
+            f'  ({res["changed"]} changed)'
+        print(f'{label:36} {res["seconds"]:7.2f}s  '
+              f'peak RSS {res["rss_mib"]:7.1f} MiB{changed}')
+    size = (work / 'old.lst').stat().st_size
+    print(f'.lst size: {size / 1024 / 1024:.1f} MiB')
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+'''
+Round-trip `data/ipa.pack` against `data/ipa.json` and `data/urls.json`.
+Compare file size (raw & gzip) and decode time of both formats.
+Run `ipa_archive.py export json` and `ipa_archive.py export packed` first.
+'''
+from argparse import ArgumentParser
+from pathlib import Path
+import gzip
+import json
+import time
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ipa_archive import CACHE_DIR, unpackRows  # noqa: E402
+
+
+def timeit(fn, repeat: int) -> 'tuple[float, object]':
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rv = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, rv
+
+
+def decodeJson(ipa: bytes, urls: bytes):
+    return json.loads(ipa), {int(k): v for k, v in json.loads(urls).items()}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-repeat', '-n', type=int, default=5)
+    args = parser.parse_args()
+
+    ipa = (CACHE_DIR / 'ipa.json').read_bytes()
+    urls = (CACHE_DIR / 'urls.json').read_bytes()
+    packed = (CACHE_DIR / 'ipa.pack').read_bytes()
+
+    t_json, expected = timeit(lambda: decodeJson(ipa, urls), args.repeat)
+    t_pack, actual = timeit(lambda: unpackRows(packed), args.repeat)
+    if actual != expected:
+        rows = sum(a != b for a, b in zip(actual[0], expected[0]))
+        print(f'round-trip FAILED: {rows} rows differ,'
+              f' urls equal: {actual[1] == expected[1]}')
+        sys.exit(1)
+    print(f'round-trip ok: {len(actual[0])} rows, {len(actual[1])} urls')
+
+    print(f'{"":8} {"raw":>12} {"gzip":>12} {"decode":>10}')
+    for name, data, sec in (('json', ipa + urls, t_json),
+                            ('packed', packed, t_pack)):
+        print(f'{name:8} {len(data):12,} {len(gzip.compress(data)):12,}'
+              f' {sec * 1000:8.1f}ms')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+'''
+Compare `data/search.idx` lookups against a linear scan over `data/ipa.json`.
+Both must return the same rows. Run `ipa_archive.py export json` first.
+'''
+from argparse import ArgumentParser
+from pathlib import Path
+import random
+import time
+import json
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ipa_archive import CACHE_DIR, SearchIndex  # noqa: E402
+
+
+def sampleTerms(rows: 'list[list]', count: int) -> 'list[str]':
+    ''' Random substrings of titles, bundle ids and path names. '''
+    rnd = random.Random(0)
+    rv = []
+    while len(rv) < count:
+        value = rnd.choice(rnd.choice(rows)[3:8:2])
+        size = rnd.choice([2, 3, 4, 5, 6, 8, 12])
+        start = rnd.randrange(max(1, len(value) - size + 1))
+        rv.append(value[start:start + size])
+    return rv
+
+
+def bench(fn, terms: 'list[str]') -> 'tuple[float, list]':
+    start = time.perf_counter()
+    rv = [fn(term) for term in terms]
+    return time.perf_counter() - start, rv
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('terms', metavar='TERM', nargs='*',
+                        help='Search terms (default: random sample)')
+    parser.add_argument('-n', type=int, default=200,
+                        help='Number of random terms')
+    args = parser.parse_args()
+
+    with open(CACHE_DIR / 'ipa.json', 'r') as fp:
+        rows = json.load(fp)
+    start = time.perf_counter()
+    index = SearchIndex((CACHE_DIR / 'search.idx').read_bytes(), rows)
+    print(f'load index: {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    terms = args.terms or sampleTerms(rows, args.n)
+    t_scan, expected = bench(index.scan, terms)
+    t_index, actual = bench(index.search, terms)
+    failed = [term for term, a, b in zip(terms, actual, expected) if a != b]
+    if failed:
+        print(f'FAILED: {len(failed)} terms differ, e.g. {failed[:5]}')
+        sys.exit(1)
+
+    hits = sum(len(x) for x in expected)
+    print(f'{len(terms)} queries, {hits} hits, results identical')
+    print(f'scan:  {t_scan * 1000 / len(terms):8.2f}ms / query')
+    print(f'index: {t_index * 1000 / len(terms):8.2f}ms / query')
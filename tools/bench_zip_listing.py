@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+'''
+Central directory parsing and icon resolution on a synthetic listing with
+many entries (Unity / Unreal style): previous approach (list of `ZipEntry`
++ linear scans per icon name) vs. `ZipListing` (slots + sorted path index).
+Measures time and memory (tracemalloc) of parse and lookup separately.
+'''
+from argparse import ArgumentParser
+from pathlib import Path
+import tracemalloc
+import struct
+import time
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ipa_archive import ZipEntry, ZipListing, expandImageName, \
+    isIconCandidate, re_info_plist, sortedByResolution  # noqa: E402
+
+APP = 'Payload/Game.app/'
+ICON_LIST = ['AppIcon60x60', 'AppIcon76x76', 'AppIcon83.5x83.5']
+ROOT_FILES = [
+    'Game', 'Info.plist', 'PkgInfo', 'embedded.mobileprovision',
+    'AppIcon60x60@2x.png', 'AppIcon60x60@3x.png', 'AppIcon76x76@2x~ipad.png',
+    'AppIcon83.5x83.5@2x~ipad.png', 'AppIcon40x40@2x.png', 'Icon.png',
+    'Assets.car', 'LaunchScreen-iPhone.png', '_CodeSignature/CodeResources',
+]
+
+
+def makeCentralDir(count: int) -> 'tuple[bytes, int]':
+    ''' Assets first (as written by the build tools), app root last '''
+    names = [f'{APP}Data/Raw/Assets{i // 1000}/bundle_{i:06d}.unity3d'
+             for i in range(count - len(ROOT_FILES))]
+    names += [APP + x for x in ROOT_FILES]
+    cd = bytearray()
+    offset = 0
+    for i, name in enumerate(names):
+        raw = name.encode()
+        size = 1000 + i % 5000
+        cd += struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, 20, 0x800, 8,
+                          0, 0, 0, size // 2, size, len(raw), 0, 0, 0, 0, 0,
+                          offset) + raw
+        offset += 30 + len(raw) + size // 2
+    return bytes(cd), offset
+
+
+def oldParseCentralDir(data: bytes) -> 'list[ZipEntry]':
+    ''' previous `parseCentralDir()` '''
+    rv = []
+    pos = 0
+    while data[pos:pos + 4] == b'PK\x01\x02':
+        (flag, method, compSize, size, nameLen, extraLen, commentLen, offset
+         ) = struct.unpack_from('<8xHH8xLLHHH8xL', data, pos)
+        pos += 46
+        name = data[pos:pos + nameLen].decode(
+            'utf-8' if flag & 0x800 else 'cp437')
+        rv.append(ZipEntry(name, size, compSize, method, offset, flag))
+        pos += nameLen + extraLen + commentLen
+    return rv
+
+
+def oldLookup(zip_listing: 'list[ZipEntry]') -> 'tuple[str, int, str]':
+    ''' previous `ipaSteps()` scan, icon candidates and `expandImageName()` '''
+    app_name = None
+    plist_entry = None
+    for entry in zip_listing:
+        fn = entry.filename.lstrip('/')
+        plist_match = re_info_plist.match(fn)
+        if plist_match:
+            app_name = plist_match.group(1)
+            plist_entry = entry
+    assert app_name and plist_entry
+    candidates = [x for x in zip_listing if isIconCandidate(x, app_name)]
+    for iconName in ICON_LIST + ['Icon', 'icon']:
+        zipPath = f'Payload/{app_name}/{iconName}'
+        matchingNames = [x.filename.split('/', 2)[-1] for x in zip_listing
+                         if x.filename.lstrip('/').startswith(zipPath)]
+        if len(matchingNames) > 0:
+            for bestName in sortedByResolution(matchingNames):
+                bestPath = f'Payload/{app_name}/{bestName}'
+                for x in zip_listing:
+                    if x.filename.lstrip('/') == bestPath and x.file_size > 0:
+                        return plist_entry.filename, len(candidates), \
+                            x.filename
+    raise AssertionError('no icon')
+
+
+def newLookup(listing: ZipListing) -> 'tuple[str, int, str]':
+    ''' same steps as in `ipaSteps()` '''
+    app_name = None
+    plist_entry = None
+    for name, _ in listing.listDir('Payload/'):
+        if name.endswith('/'):
+            plist_entry = listing.find(f'Payload/{name}Info.plist')
+            if plist_entry:
+                app_name = name[:-1]
+                break
+    assert app_name and plist_entry
+    candidates = [x for x in (listing[slot] for name, slot in listing.listDir(
+        f'Payload/{app_name}/') if not name.endswith('/'))
+        if isIconCandidate(x, app_name)]
+    icon = expandImageName(listing, app_name, list(ICON_LIST))
+    assert icon
+    return plist_entry.filename, len(candidates), icon.filename
+
+
+def timed(fn, *args, repeat: int) -> float:
+    ''' :returns: best of `repeat` in seconds '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def retained(fn, *args) -> 'tuple[object, int]':
+    ''' :returns: `(result, size in bytes of all objects it keeps alive)` '''
+    tracemalloc.start()
+    rv = fn(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return rv, size
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', type=int, default=200_000,
+                        help='Number of entries in central directory')
+    parser.add_argument('-repeat', type=int, default=5,
+                        help='Best of N for timings')
+    args = parser.parse_args()
+
+    cd, cdOffset = makeCentralDir(args.n)
+    print(f'central directory: {args.n} entries, '
+          f'{len(cd) / 1024 / 1024:.1f} MiB')
+
+    results = {}
+    for label, parse, lookup in [
+        ('list[ZipEntry] + scans', oldParseCentralDir, oldLookup),
+        ('ZipListing + path index', lambda cd: ZipListing(cd, cdOffset),
+         newLookup),
+    ]:
+        listing, size = retained(parse, cd)
+        found = lookup(listing)
+        parseTime = timed(parse, cd, repeat=args.repeat)
+        lookupTime = timed(lookup, listing, repeat=args.repeat)
+        results[label] = found
+        print(f'{label:24} parse {parseTime * 1000:7.1f} ms'
+              f' ({size / 1024 / 1024:6.1f} MiB)'
+              f'  lookup {lookupTime * 1000:8.2f} ms  -> {found[2]}')
+    if len(set(results.values())) != 1:
+        print('MISMATCH:', results)
+        sys.exit(1)
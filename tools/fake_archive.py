@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for archive.org. Each subdirectory of ROOT is an item.
+- /download/<id>/<path>  serve file (supports single and multi `Range`)
+- /metadata/<id>/files   gzipped file listing (same format as archive.org)
+                         with `ETag` (supports `If-None-Match`)
+- /services/search/v1/scrape?q=&count=&cursor=
+                         cursor-paged search over item ids (all terms
+                         must be part of the id, `*` matches all)
+Responses can be delayed (`-latency`) and throttled (`-rate`).
+Downloads can be rate limited with HTTP 429 (`-max-rps`) and connections
+dropped at random (`-reset-rate`) to test retry handling.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from argparse import ArgumentParser
+from threading import Lock
+from pathlib import Path
+from urllib.parse import parse_qs, unquote
+import hashlib
+import random
+import zlib
+import gzip
+import json
+import time
+import re
+
+re_range = re.compile(r'(\d*)-(\d*)$')
+
+
+class FakeArchive(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    root = Path('.')
+    latency = 0.0
+    rate = 0  # bytes per second and response, 0 = unlimited
+    maxRps = 0.0  # download requests per second (all clients), 0 = unlimited
+    resetRate = 0.0  # probability to close connection without response
+    _tokens = 0.0
+    _tokensUpdated = 0.0
+    # requests and body bytes sent, per kind (metadata, download, error)
+    stats = {}  # type: dict[str, list[int]]
+    _statsLock = Lock()
+
+    @classmethod
+    def resetStats(cls) -> 'dict[str, dict[str, int]]':
+        ''' :returns: counters since last reset '''
+        with cls._statsLock:
+            rv = {k: {'requests': v[0], 'bytes': v[1]}
+                  for k, v in cls.stats.items()}
+            cls.stats = {}
+        return rv
+
+    def count(self, kind: str, size: int, *, request: bool = False):
+        with self._statsLock:
+            counter = self.stats.setdefault(kind, [0, 0])
+            counter[0] += request
+            counter[1] += size
+
+    def write(self, kind: str, data: bytes):
+        ''' Send body, throttled to `rate` bytes per second '''
+        block = max(1024, self.rate // 20) if self.rate else len(data)
+        for i in range(0, len(data), block):
+            self.wfile.write(data[i:i + block])
+            if self.rate:
+                time.sleep(len(data[i:i + block]) / self.rate)
+        self.count(kind, len(data))
+
+    @classmethod
+    def allowRequest(cls) -> bool:
+        ''' Global token bucket with `maxRps` tokens per second '''
+        if not cls.maxRps:
+            return True
+        with cls._statsLock:
+            now = time.monotonic()
+            cls._tokens = min(cls.maxRps, cls._tokens
+                              + (now - cls._tokensUpdated) * cls.maxRps)
+            cls._tokensUpdated = now
+            if cls._tokens < 1:
+                return False
+            cls._tokens -= 1
+            return True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        path, _, query = self.path.partition('?')
+        parts = unquote(path).strip('/').split('/', 2)
+        if path == '/services/search/v1/scrape':
+            self.count('search', 0, request=True)
+            self.sendSearch(parse_qs(query))
+        elif len(parts) == 3 and parts[0] == 'metadata' and \
+                parts[2] == 'files':
+            self.count('metadata', 0, request=True)
+            self.sendListing(self.root / parts[1])
+        elif len(parts) == 3 and parts[0] == 'download':
+            if self.resetRate and random.random() < self.resetRate:
+                self.count('reset', 0, request=True)
+                self.close_connection = True
+                return
+            if not self.allowRequest():
+                self.count('throttled', 0, request=True)
+                return self.sendStatus(429, {'Retry-After': '1'})
+            self.count('download', 0, request=True)
+            self.sendFile(self.root / parts[1] / parts[2])
+        else:
+            self.count('error', 0, request=True)
+            self.sendStatus(404)
+
+    def sendStatus(self, status: int, headers: 'dict[str, str]' = {}):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def sendSearch(self, params: 'dict[str, list[str]]'):
+        terms = [x.split(':', 1)[-1].strip('"*').lower()
+                 for x in params.get('q', ['*'])[0].split()
+                 if x not in ('AND', 'OR')]
+        ids = sorted(x.name for x in self.root.iterdir() if x.is_dir()
+                     and all(term in x.name.lower() for term in terms))
+        count = int(params.get('count', ['100'])[0])
+        offset = int(params.get('cursor', ['0'])[0])
+        result = {
+            'items': [{'identifier': x} for x in ids[offset:offset + count]],
+            'count': len(ids[offset:offset + count]),
+            'total': len(ids),
+        }
+        if offset + count < len(ids):
+            result['cursor'] = str(offset + count)
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write('search', body)
+
+    def sendListing(self, item: Path):
+        if not item.is_dir():
+            return self.sendStatus(404)
+        result = []
+        for file in sorted(item.rglob('*')):
+            if file.is_file():
+                data = file.read_bytes()
+                result.append({
+                    'name': file.relative_to(item).as_posix(),
+                    'source': 'original',
+                    'mtime': str(int(file.stat().st_mtime)),
+                    'size': str(len(data)),
+                    'crc32': f'{zlib.crc32(data):08x}',
+                })
+        body = gzip.compress(json.dumps({'result': result}).encode(), mtime=0)
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.sendStatus(304, {'ETag': etag})
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write('metadata', body)
+
+    def sendFile(self, file: Path):
+        if not file.is_file():
+            return self.sendStatus(404)
+        size = file.stat().st_size
+        ranges = []
+        for rng in self.headers.get('Range', '').split('=', 1)[-1].split(','):
+            match = re_range.match(rng.strip())
+            if not match or not (match.group(1) or match.group(2)):
+                continue
+            if not match.group(1):  # suffix range
+                start, end = max(0, size - int(match.group(2))), size - 1
+            else:
+                start = int(match.group(1))
+                end = min(size - 1, int(match.group(2) or size - 1))
+            if start <= end:
+                ranges.append((start, end))
+        if not ranges and self.headers.get('Range'):
+            return self.sendStatus(416, {'Content-Range': f'bytes */{size}'})
+
+        with open(file, 'rb') as fp:
+            if len(ranges) > 1:
+                boundary = 'FAKEARCHIVEBOUNDARY'
+                body = b''
+                for start, end in ranges:
+                    fp.seek(start)
+                    body += (f'--{boundary}\r\n'
+                             'Content-Type: application/octet-stream\r\n'
+                             f'Content-Range: bytes {start}-{end}/{size}'
+                             '\r\n\r\n').encode()
+                    body += fp.read(end - start + 1) + b'\r\n'
+                body += f'--{boundary}--\r\n'.encode()
+                self.send_response(206)
+                self.send_header('Content-Type',
+                                 f'multipart/byteranges; boundary={boundary}')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.write('download', body)
+                return
+
+            start, end = ranges[0] if ranges else (0, size - 1)
+            if ranges:
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            fp.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = fp.read(min(remaining, 1 << 16))
+                if not block:
+                    break
+                self.write('download', block)
+                remaining -= len(block)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('root', type=Path, help='Directory with items')
+    parser.add_argument('-port', type=int, default=8027)
+    parser.add_argument('-latency', type=float, default=0,
+                        help='Delay each response (in seconds)')
+    parser.add_argument('-rate', type=int, default=0,
+                        help='Max. bytes per second and response')
+    parser.add_argument('-max-rps', type=float, default=0,
+                        help='Max. download requests per second (else 429)')
+    parser.add_argument('-reset-rate', type=float, default=0,
+                        help='Probability to drop a download connection')
+    args = parser.parse_args()
+
+    FakeArchive.root = args.root
+    FakeArchive.latency = args.latency
+    FakeArchive.rate = args.rate
+    FakeArchive.maxRps = args.max_rps
+    FakeArchive.resetRate = args.reset_rate
+    webServer = ThreadingHTTPServer(('127.0.0.1', args.port), FakeArchive)
+    print('Server started http://127.0.0.1:%s' % args.port)
+    try:
+        webServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    webServer.server_close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+'''
+Load test for `tools/plist_server.py`. Starts the server and a local
+upstream stand-in (for `?r=`) in-process and measures requests per second
+and latency for manifest generation (`?d=`) and proxy (`?r=`).
+With `-cache`, the `?r=` proxy uses an on-disk cache.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.client import HTTPConnection
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from threading import Thread
+from base64 import b64encode
+from pathlib import Path
+import time
+import json
+
+from plist_server import PlistServer, ProxyCache
+
+
+class Upstream(BaseHTTPRequestHandler):
+    ''' Slow iTunes lookup stand-in '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.05
+    maxAge = 300
+    body = json.dumps({'resultCount': 1, 'results': [
+        {'trackName': 'x' * 1000, 'artworkUrl512': 'y' * 100}]}).encode()
+    etag = '"v1"'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Cache-Control', f'max-age={self.maxAge}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Cache-Control', f'max-age={self.maxAge}')
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+def serve(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def client(host: str, paths: 'list[str]', latencies: 'list[float]'):
+    conn = HTTPConnection(host, timeout=30)
+    for path in paths:
+        start = time.perf_counter()
+        conn.request('GET', path)
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f'HTTP {response.status} for {path}')
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def run(host: str, paths: 'list[str]', clients: int) -> str:
+    latencies = []  # type: list[float]
+    threads = [Thread(target=client, args=(host, paths[i::clients],
+                                           latencies))
+               for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return f'{len(latencies) / wall:8.0f} req/s, p50 {p50 * 1000:6.1f} ms,' \
+        f' p99 {p99 * 1000:6.1f} ms'
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000,
+                        help='Number of requests per action')
+    parser.add_argument('-clients', type=int, default=16,
+                        help='Parallel keep-alive connections')
+    parser.add_argument('-unique', type=int, default=100,
+                        help='Number of distinct manifests')
+    parser.add_argument('-latency', type=float, default=0.05,
+                        help='Upstream delay for ?r= (in seconds)')
+    parser.add_argument('-max-age', type=int, default=300,
+                        help='Upstream Cache-Control max-age (0 = revalidate)')
+    parser.add_argument('-cache', action='store_true',
+                        help='Enable proxy cache (in temporary directory)')
+    parser.add_argument('-server', metavar='HOST:PORT',
+                        help='Test running server instead (e.g., php)')
+    args = parser.parse_args()
+
+    Upstream.latency = args.latency
+    Upstream.maxAge = args.max_age
+    upstream = serve(Upstream)
+    tmpDir = TemporaryDirectory()
+    if args.cache:
+        PlistServer.cache = ProxyCache(Path(tmpDir.name), 64 * 1024 * 1024)
+    host = args.server or '127.0.0.1:%d' % serve(PlistServer).server_port
+
+    manifests = []
+    for i in range(args.n):
+        data = {'u': f'https://example.org/{i % args.unique}.ipa',
+                'n': 'Title', 'b': 'com.example', 'v': '1.0', 'i': 'x.jpg'}
+        manifests.append('/?d=' + b64encode(json.dumps(data).encode())
+                         .decode().rstrip('='))
+    lookup = f'http://127.0.0.1:{upstream.server_port}/lookup?id='
+    print(f'?d= {run(host, manifests, args.clients)}')
+    lookups = [f'/?r={lookup}{i % args.unique}' for i in range(args.n)]
+    print(f'?r= {run(host, lookups, args.clients)}')
+    if PlistServer.cache:
+        print(PlistServer.cache.info())
@@ -1,9 +1,26 @@
 #!/usr/bin/env python3
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.request import urlopen
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from argparse import ArgumentParser
+from collections import OrderedDict
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
+from threading import Lock, get_ident
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
 from base64 import b64decode
+from pathlib import Path
+import hashlib
 import socket
 import json
+import time
+import os
+import re
+
+MANIFEST_CACHE_SIZE = 1024  # number of generated manifests
+PROXY_TIMEOUT = 15  # seconds (connect & read)
+PROXY_BUFFER_SIZE = 64 * 1024
+PROXY_CACHE_DIR = Path(__file__).parent / 'proxy_cache'
+re_max_age = re.compile(r'(?:^|,)\s*(s-maxage|max-age)\s*=\s*"?(\d+)')
 
 
 def generatePlist(data: dict) -> str:
@@ -24,39 +41,319 @@ def generatePlist(data: dict) -> str:
 </dict></dict></array></dict></plist>'''  # noqa: E501
 
 
+class LRUCache:
+    ''' Thread-safe dict with at most `maxsize` entries. '''
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # type: OrderedDict[str, bytes]
+        self._lock = Lock()
+
+    def get(self, key: str) -> 'bytes|None':
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class ProxyCache:
+    '''
+    On-disk cache for proxied responses (`<sha1>.body` + `<sha1>.json`).
+    Honours Cache-Control (max-age, no-cache, no-store) and Expires.
+    Stale entries with ETag or Last-Modified are revalidated.
+    Least recently used entries are evicted above `maxBytes`.
+    '''
+
+    def __init__(self, directory: Path, maxBytes: int) -> None:
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0,
+                      'stored': 0, 'evicted': 0,
+                      'bytes_from_cache': 0, 'bytes_from_upstream': 0}
+        self._lock = Lock()
+        self._size = 0
+        self._lru = OrderedDict()  # type: OrderedDict[str, int]
+        directory.mkdir(parents=True, exist_ok=True)
+        for file in sorted(directory.glob('*.json'),
+                           key=lambda x: x.stat().st_mtime):
+            body = file.with_suffix('.body')
+            if body.exists():
+                self._lru[file.stem] = body.stat().st_size
+                self._size += body.stat().st_size
+            else:
+                os.remove(file)
+        for file in directory.glob('*.tmp'):
+            os.remove(file)
+
+    def info(self) -> dict:
+        with self._lock:
+            return {**self.stats, 'entries': len(self._lru),
+                    'size': self._size, 'max_size': self.maxBytes}
+
+    def count(self, key: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += value
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def lookup(self, url: str) -> 'dict|None':
+        ''' :returns: Metadata or `None` if not cached. '''
+        key = self.key(url)
+        try:
+            with open(self.directory / f'{key}.json', 'r') as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+        os.utime(self.directory / f'{key}.json')
+        return meta
+
+    def bodyPath(self, url: str) -> Path:
+        return self.directory / f'{self.key(url)}.body'
+
+    def tempPath(self, url: str, ext: str = 'body') -> Path:
+        return self.directory / f'{self.key(url)}.{get_ident()}.{ext}.tmp'
+
+    def store(self, url: str, meta: dict, tmpBody: 'Path|None') -> bool:
+        '''
+        Save or refresh `meta`. If `tmpBody` is set, replace cached body.
+        :returns: `False` if not stored (body evicted or too large)
+        '''
+        key = self.key(url)
+        if tmpBody and meta['size'] > self.maxBytes:
+            os.remove(tmpBody)
+            return False
+        meta_path = self.directory / f'{key}.json'
+        tmpMeta = self.tempPath(url, 'json')
+        with open(tmpMeta, 'w') as fp:
+            json.dump({**meta, 'url': url}, fp)
+        with self._lock:
+            if not tmpBody and key not in self._lru:  # evicted meanwhile
+                os.remove(tmpMeta)
+                return False
+            if tmpBody:
+                os.replace(tmpBody, self.directory / f'{key}.body')
+                self._size -= self._lru.pop(key, 0)
+                self._lru[key] = meta['size']
+                self._size += meta['size']
+                self.stats['stored'] += 1
+            os.replace(tmpMeta, meta_path)
+            while self._size > self.maxBytes and self._lru:
+                oldKey, size = self._lru.popitem(last=False)
+                for ext in ['.json', '.body']:
+                    try:
+                        os.remove(self.directory / f'{oldKey}{ext}')
+                    except FileNotFoundError:
+                        pass
+                self._size -= size
+                self.stats['evicted'] += 1
+        return True
+
+    @staticmethod
+    def freshUntil(headers) -> 'float|None':
+        '''
+        :returns: Expiry timestamp, `0` if revalidation is required,
+            or `None` if response must not be stored.
+        '''
+        control = (headers.get('Cache-Control') or '').lower()
+        if 'no-store' in control:
+            return None
+        if 'no-cache' in control:
+            return 0
+        ages = dict(re_max_age.findall(control))
+        maxAge = ages.get('s-maxage', ages.get('max-age'))
+        if maxAge is not None:
+            age = headers.get('Age') or '0'
+            return time.time() + int(maxAge) - int(age if age.isdigit() else 0)
+        if headers.get('Expires'):
+            try:
+                expires = parsedate_to_datetime(headers['Expires'])
+                date = parsedate_to_datetime(headers['Date']) \
+                    if headers.get('Date') else None
+                lifetime = expires.timestamp() - (date.timestamp() if date
+                                                  else time.time())
+                return time.time() + lifetime
+            except (TypeError, ValueError):
+                return 0
+        return 0
+
+
 class PlistServer(BaseHTTPRequestHandler):
-    def makeHeader(self, contentType):
-        self.send_response(200)
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are sent separately
+    manifests = LRUCache(MANIFEST_CACHE_SIZE)
+    cache = None  # type: ProxyCache|None
+
+    def log_message(self, format, *args):
+        pass
+
+    def makeHeader(self, contentType, contentLength=None, status=200,
+                   cacheStatus=None):
+        self.send_response(status)
         self.send_header('Access-Control-Allow-Origin', '*')
+        if cacheStatus:
+            self.send_header('X-Cache', cacheStatus)
         if contentType:
             self.send_header('Content-type', contentType)
+        if contentLength is None:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(contentLength))
         self.end_headers()
 
+    def sendError(self, status):
+        self.makeHeader(None, 0, status=status)
+
     def do_GET(self):
+        if self.path.split('?', 1)[0] == '/stats':
+            rv = json.dumps(self.cache.info() if self.cache else {}).encode()
+            self.makeHeader('application/json', len(rv))
+            self.wfile.write(rv)
+            return
         try:
             action, value = self.path.split('?', 1)[-1].split('=', 1)
+        except ValueError:
+            return self.sendError(400)
+        try:
             if action == 'r':
-                # http.client.HTTPResponse
-                with urlopen(value) as response:
-                    mimeType = response.headers.get('Content-Type')
-                    self.makeHeader(mimeType)
-
-                    while True:
-                        tmp = response.read(8096)
-                        if not tmp:
-                            break
-                        self.wfile.write(tmp)
-
+                self.proxy(value)
             elif action == 'd':
+                self.manifest(value)
+            else:
+                self.sendError(400)
+        except Exception as e:
+            print(e)
+            # response may be incomplete
+            self.close_connection = True
+
+    def manifest(self, value: str):
+        rv = self.manifests.get(value)
+        if rv is None:
+            try:
                 data = json.loads(b64decode(value + '=='))  # type: dict
-                rv = bytes(generatePlist(data), 'utf-8')
-                self.makeHeader('application/xml')
-                self.wfile.write(rv)
+            except ValueError:
+                return self.sendError(400)
+            rv = bytes(generatePlist(data), 'utf-8')
+            self.manifests.set(value, rv)
+        self.makeHeader('application/xml', len(rv))
+        self.wfile.write(rv)
 
-            else:
+    def proxy(self, url: str):
+        cache = self.cache
+        meta = cache.lookup(url) if cache else None
+        if meta and meta['expires'] > time.time():
+            if self.sendCached(url, meta, 'HIT'):
+                cache.count('hits')
+                return
+            meta = None
+
+        req = Request(url)
+        if meta and meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta and meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+        response = None
+        try:
+            # http.client.HTTPResponse
+            response = urlopen(req, timeout=PROXY_TIMEOUT)
+        except HTTPError as e:
+            if e.code != 304 or not meta or not cache:
+                print(e)
+                return self.sendError(502)
+            cache.count('revalidated')
+            meta['expires'] = cache.freshUntil(e.headers) or 0
+            if cache.store(url, meta, None) and \
+                    self.sendCached(url, meta, 'REVALIDATED'):
                 return
         except Exception as e:
             print(e)
+            return self.sendError(502)
+        if response is None:
+            # body was evicted during revalidation, load unconditionally
+            try:
+                response = urlopen(Request(url), timeout=PROXY_TIMEOUT)
+            except Exception as e:
+                print(e)
+                return self.sendError(502)
+
+        with response:
+            mimeType = response.headers.get('Content-Type')
+            size = response.headers.get('Content-Length')
+            chunked = size is None
+            expires = cache.freshUntil(response.headers) if cache else None
+            etag = response.headers.get('ETag')
+            lastModified = response.headers.get('Last-Modified')
+            # do not store what can never be used again
+            if expires is not None and expires <= time.time() and \
+                    not etag and not lastModified:
+                expires = None
+            # larger than the whole cache, would evict everything else
+            if cache and size and int(size) > cache.maxBytes:
+                expires = None
+            tmpPath = cache.tempPath(url) if cache and expires is not None \
+                else None
+            if cache:
+                cache.count('misses')
+            self.makeHeader(mimeType, None if chunked else int(size),
+                            cacheStatus='MISS' if cache else None)
+            received = 0
+            with open(tmpPath, 'wb') if tmpPath else nullcontext() as fp:
+                while True:
+                    tmp = response.read1(PROXY_BUFFER_SIZE)
+                    if not tmp:
+                        break
+                    received += len(tmp)
+                    if fp:
+                        fp.write(tmp)
+                    if chunked:
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(tmp), tmp))
+                    else:
+                        self.wfile.write(tmp)
+                if chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+            if cache:
+                cache.count('bytes_from_upstream', received)
+            if tmpPath:
+                if chunked or received == int(size):
+                    cache.store(url, {
+                        'expires': expires, 'etag': etag,
+                        'last_modified': lastModified,
+                        'content_type': mimeType, 'size': received,
+                    }, tmpPath)
+                else:
+                    os.remove(tmpPath)
+
+    def sendCached(self, url: str, meta: dict, cacheStatus: str) -> bool:
+        ''' :returns: `False` if entry was evicted in the meantime '''
+        cache = self.cache
+        try:
+            fp = open(cache.bodyPath(url), 'rb')
+        except FileNotFoundError:
+            return False
+        with fp:
+            self.makeHeader(meta['content_type'], meta['size'],
+                            cacheStatus=cacheStatus)
+            while True:
+                tmp = fp.read(PROXY_BUFFER_SIZE)
+                if not tmp:
+                    break
+                self.wfile.write(tmp)
+        cache.count('bytes_from_cache', meta['size'])
+        return True
 
 
 def getLocalIp():
@@ -68,8 +365,22 @@ def getLocalIp():
 
 
 if __name__ == '__main__':
-    webServer = HTTPServer(('0.0.0.0', 8026), PlistServer)
-    print('Server started http://%s:%s' % (getLocalIp(), 8026))
+    parser = ArgumentParser()
+    parser.add_argument('-port', type=int, default=8026)
+    parser.add_argument('-host', default='0.0.0.0')
+    parser.add_argument('-cache-dir', type=Path, default=PROXY_CACHE_DIR,
+                        help='On-disk cache for ?r= responses')
+    parser.add_argument('-cache-size', type=int, default=256,
+                        help='Max. size of proxy cache in MB (0 = disable)')
+    args = parser.parse_args()
+
+    if args.cache_size > 0:
+        PlistServer.cache = ProxyCache(args.cache_dir,
+                                       args.cache_size * 1024 * 1024)
+
+    webServer = ThreadingHTTPServer((args.host, args.port), PlistServer)
+    webServer.daemon_threads = True
+    print('Server started http://%s:%s' % (getLocalIp(), args.port))
     try:
         webServer.serve_forever()
     except KeyboardInterrupt: